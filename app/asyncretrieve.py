@@ -0,0 +1,235 @@
+"""
+The asyncretrieve module retrieves JSONs from Instagram with asyncio. Many page requests are
+kept in flight from a single process, bounded globally and per proxy.
+"""
+import asyncio
+import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+from .retrieve import LINKS, NOT_MODIFIED, SharedDataExtractor
+
+
+class AsyncRetrieve():
+    """
+    AsyncRetrieve fetches the pages for a Retrieve instance concurrently. The network part runs
+    on the event loop, the blocking storage part (files, S3, DynamoDB) runs on a thread pool
+    through the save_location, save_user and save_picture methods of Retrieve.
+    """
+    def __init__(self,
+                 retrieve,
+                 concurrency=1000,
+                 proxy_concurrency=10,
+                 storage_threads=20,
+                 timeout=60):
+        """
+        :param retrieve: Retrieve instance that provides proxies and storage
+        :param concurrency: Maximum number of requests in flight over all proxies
+        :param proxy_concurrency: Maximum number of requests in flight per proxy
+        :param storage_threads: Number of threads for saving the fetched JSONs
+        :param timeout: Timeout per request in seconds
+        """
+        self.log = logging.getLogger(__name__)
+        self.retrieve = retrieve
+        self.concurrency = concurrency
+        self.proxy_concurrency = proxy_concurrency
+        self.storage_threads = storage_threads
+        self.timeout = timeout
+        self.proxy_semaphores = {}
+        self.storagepool = None
+        self.save = {
+            'location': retrieve.save_location,
+            'user': retrieve.save_user,
+            'picture': retrieve.save_picture
+        }
+
+    def proxy_semaphore(self, proxy):
+        """
+        Returns the semaphore that limits the concurrent requests of a proxy
+        :param proxy: Proxy as string, e.g. '1.1.1.1:8080', None if no proxy is used
+        :return: asyncio.Semaphore
+        """
+        if proxy not in self.proxy_semaphores:
+            if proxy is None:
+                self.proxy_semaphores[proxy] = asyncio.Semaphore(self.concurrency)
+            else:
+                self.proxy_semaphores[proxy] = asyncio.Semaphore(self.proxy_concurrency)
+        return self.proxy_semaphores[proxy]
+
+    async def grabjson(self, session, link, chosenproxy, validators=None):
+        """
+        Asynchronous counterpart of grabjson
+        :param session: aiohttp.ClientSession
+        :param link: Link that should be grabbed
+        :param chosenproxy: Tuple of proxy and user agent
+        :param validators: Optional validators for a conditional request, see grabjson
+        :return: The fetched JSON as list, like grabjson
+        """
+        headers = {}
+        proxy = None
+        if validators is not None:
+            if validators.get('etag') is not None:
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified') is not None:
+                headers['If-Modified-Since'] = validators['last_modified']
+        if self.retrieve.useproxy is True:
+            proxy, useragent = chosenproxy
+            headers['User-Agent'] = useragent
+            proxy = 'http://{}'.format(proxy)
+
+        jsonstarttime = time.time()
+        async with session.get(link, headers=headers, proxy=proxy) as resp:
+            if resp.status == 404:
+                self.log.info('Page not found, 404: %s', link)
+                resp.raise_for_status()
+
+            if resp.status == 429:
+                self.log.info('Too many requests for %s', link)
+                resp.raise_for_status()
+
+            if resp.status == 304:
+                self.log.debug('Not modified: %s', link)
+                return NOT_MODIFIED
+
+            if validators is not None:
+                validators['etag'] = resp.headers.get('ETag')
+                validators['last_modified'] = resp.headers.get('Last-Modified')
+
+            extractor = SharedDataExtractor()
+            async for chunk in resp.content.iter_chunked(16384):
+                if extractor.feed(chunk):
+                    break
+        jsonendtime = time.time()
+
+        self.log.debug('%s: Time to retrieve (%s)', jsonendtime - jsonstarttime, link)
+        return extractor.shareddata()
+
+    async def retrieve_one(self, session, semaphore, category, key):
+        """
+        Fetch one item and hand it over to the storage thread pool
+        :param session: aiohttp.ClientSession
+        :param semaphore: Global semaphore for all requests
+        :param category: 'location', 'user' or 'picture'
+        :param key: Key of the item, e.g. the location ID
+        :return: None
+        """
+        chosenproxy = self.retrieve.proxypool.choose()
+        link = LINKS[category].format(key)
+        validators = self.retrieve.validators(category, key)
+        fetchedjson = ''
+
+        # Without proxies all requests go out directly and only the global limit applies
+        proxykey = self.retrieve.proxykey(chosenproxy)
+
+        async with semaphore, self.proxy_semaphore(proxykey):
+            wait = self.retrieve.ratelimiter.reserve(proxykey)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            starttime = time.time()
+            try:
+                fetchedjson = await self.grabjson(session, link, chosenproxy, validators)
+            except (aiohttp.ClientProxyConnectionError, aiohttp.ClientHttpProxyError):
+                self.retrieve.report_failure(chosenproxy, 'proxy')
+                raise
+            except aiohttp.ClientResponseError as error:
+                if error.status == 429:
+                    self.retrieve.report_failure(chosenproxy, '429')
+                else:
+                    self.retrieve.report_success(chosenproxy, time.time() - starttime)
+                self.log.exception('Http Error when retrieving the JSON')
+                # Only a missing location is saved as deleted, a 429 says nothing about it
+                if category != 'location' or error.status == 429:
+                    raise
+            except asyncio.TimeoutError:
+                self.retrieve.report_failure(chosenproxy, 'timeout')
+                raise
+            except aiohttp.ClientError:
+                self.retrieve.report_failure(chosenproxy, 'other')
+                raise
+            else:
+                self.retrieve.report_success(chosenproxy, time.time() - starttime)
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.storagepool, self.save[category], key, fetchedjson,
+                                   validators)
+
+    async def worker(self, session, semaphore, queue, category, stats, done=None):
+        """
+        Worker that processes keys from the queue until it receives None
+        :param session: aiohttp.ClientSession
+        :param semaphore: Global semaphore for all requests
+        :param queue: asyncio.Queue with (number, key) tuples
+        :param category: 'location', 'user' or 'picture'
+        :param stats: Dictionary with 'completed' and 'failed' counters
+        :param done: Optional function called with the key and None or the error message
+        :return: None
+        """
+        while True:
+            entry = await queue.get()
+            if entry is None:
+                queue.task_done()
+                break
+            number, key = entry
+            self.log.info('#%s: %s - Retrieving data from Instagram', number, key)
+            try:
+                await self.retrieve_one(session, semaphore, category, key)
+                stats['completed'] += 1
+                error = None
+            except Exception as exception:
+                self.log.exception('#%s: %s - Retrieving failed', number, key)
+                stats['failed'] += 1
+                error = repr(exception)
+            if done is not None:
+                done(key, error)
+            queue.task_done()
+
+    async def retrieve_many(self, category, keys, done=None):
+        """
+        Retrieve all keys of a category concurrently
+        :param category: 'location', 'user' or 'picture'
+        :param keys: Iterable of keys, consumed lazily
+        :param done: Optional function called per key with None or the error message
+        :return: Dictionary with the number of completed and failed items
+        """
+        stats = {'completed': 0, 'failed': 0}
+        semaphore = asyncio.Semaphore(self.concurrency)
+        queue = asyncio.Queue(maxsize=self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=0)
+
+        self.storagepool = ThreadPoolExecutor(max_workers=self.storage_threads)
+        try:
+            async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+                workers = [asyncio.ensure_future(self.worker(session, semaphore, queue,
+                                                             category, stats, done))
+                           for _ in range(self.concurrency)]
+                # A lazy iterable may block on a database scan, read it off the loop
+                loop = asyncio.get_running_loop()
+                entries = enumerate(keys, 1)
+                while True:
+                    entry = await loop.run_in_executor(None, next, entries, None)
+                    if entry is None:
+                        break
+                    await queue.put(entry)
+                for _ in workers:
+                    await queue.put(None)
+                await asyncio.gather(*workers)
+        finally:
+            self.storagepool.shutdown(wait=True)
+
+        self.log.info('%s: %s items retrieved, %s failed',
+                      category, stats['completed'], stats['failed'])
+        return stats
+
+    def run(self, category, keys, done=None):
+        """
+        Blocking entry point that runs retrieve_many on a new event loop
+        :param category: 'location', 'user' or 'picture'
+        :param keys: Iterable of keys
+        :param done: Optional function called per key with None or the error message
+        :return: Dictionary with the number of completed and failed items
+        """
+        return asyncio.run(self.retrieve_many(category, keys, done))
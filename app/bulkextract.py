@@ -0,0 +1,291 @@
+"""
+The bulkextract module re-extracts the archived JSONs offline into columnar files, without
+DynamoDB. It uses the same parse functions as Extract, so a changed extraction rule can be
+backfilled over the whole archive in one run.
+
+The output is one Parquet file per chunk of records if pyarrow is installed, otherwise one
+NumPy .npz file per chunk, with numeric columns as arrays and text columns as integer codes
+into a table of strings.
+"""
+import json
+import logging
+import multiprocessing as mp
+import os
+
+from decimal import Decimal
+
+from .extract import parse_location, parse_picture, parse_user
+from .geofence import GeoFence
+from .jsondecode import getloads, graphqldata
+from .segments import SegmentReader
+from .storage import loaddictionary, readrecord
+from .tags import batch_tags
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+PAGES = {
+    'location': ('json/location', 'LocationsPage', 'location'),
+    'user': ('json/user', 'ProfilePage', 'user'),
+    'picture': ('json/post', 'PostPage', 'shortcode_media')
+}
+
+
+def parse_record(category, key, retrieved_at_time, datastore, loads, tags=None):
+    """
+    Extract one record into a row
+    :param category: 'location', 'user' or 'picture'
+    :param key: Location ID, username or shortcode
+    :param retrieved_at_time: Retrieval time as unix timestamp
+    :param datastore: The GraphQL data of the record, see graphqldata
+    :param loads: Function to decode the JSON strings within the data
+    :param tags: Optional (hashtags, mentions) of a picture from batch_tags
+    :return: Dictionary of column -> value
+    """
+    if category == 'location':
+        attributes = parse_location(key, datastore, loads)
+    elif category == 'user':
+        attributes = parse_user(key, datastore, loads)
+    else:
+        attributes = parse_picture(key, datastore, retrieved_at_time, tags)
+
+    row = {'key': str(key), 'retrieved_at_time': retrieved_at_time}
+    for name, value in attributes.items():
+        if isinstance(value, Decimal):
+            value = float(value)
+        elif isinstance(value, dict):
+            value = json.dumps(value)
+        row[name] = value
+    return row
+
+
+def columns(rows):
+    """
+    Turn rows into columns, missing values become None
+    :param rows: List of dictionaries
+    :return: Dictionary of column -> list of values
+    """
+    names = []
+    for row in rows:
+        for name in row:
+            if name not in names:
+                names.append(name)
+    return {name: [row.get(name) for row in rows] for name in names}
+
+
+def numpycolumns(table):
+    """
+    Arrays for np.savez. Columns of bools or numbers become arrays, with -1 for missing bools
+    and NaN for missing numbers. All other columns become an array of codes
+    ('<column>.codes', -1 for missing) into an array of strings ('<column>.strings'); lists
+    are stored as JSON.
+    :param table: Dictionary of column -> list of values
+    :return: Dictionary of array name -> numpy array
+    """
+    arrays = {}
+    for name, values in table.items():
+        present = [value for value in values if value is not None]
+        if len(present) > 0 and all(isinstance(value, bool) for value in present):
+            if len(present) == len(values):
+                arrays[name] = numpy.array(values, dtype=bool)
+            else:
+                arrays[name] = numpy.array([-1 if value is None else int(value)
+                                            for value in values], dtype=numpy.int8)
+        elif len(present) > 0 and all(isinstance(value, (int, float)) and
+                                      not isinstance(value, bool) for value in present):
+            if len(present) == len(values) and all(isinstance(value, int) for value in values):
+                arrays[name] = numpy.array(values, dtype=numpy.int64)
+            else:
+                arrays[name] = numpy.array([numpy.nan if value is None else value
+                                            for value in values], dtype=numpy.float64)
+        else:
+            strings = {}
+            codes = []
+            for value in values:
+                if value is None:
+                    codes.append(-1)
+                    continue
+                if not isinstance(value, str):
+                    value = json.dumps(value)
+                codes.append(strings.setdefault(value, len(strings)))
+            arrays[name + '.codes'] = numpy.array(codes, dtype=numpy.int32)
+            arrays[name + '.strings'] = numpy.array(list(strings), dtype=str)
+    return arrays
+
+
+def add_regions(rows, regions_file):
+    """
+    Add the region of the location rows like Extract.location_details does, all rows of a chunk
+    are located at once
+    :param rows: List of location rows
+    :param regions_file: GeoJSON file of the regions
+    :return: None
+    """
+    located = [row for row in rows if row.get('lat') is not None and row.get('lng') is not None]
+    regions = GeoFence(regions_file).locate_many([(row['lat'], row['lng']) for row in located])
+    for row, region in zip(located, regions):
+        if region is not None:
+            row['region'] = region
+
+
+def writechunk(output, number, rows):
+    """
+    Write the rows of a chunk as a columnar file
+    :param output: Output directory
+    :param number: Chunk number for the file name
+    :param rows: List of dictionaries
+    :return: Path of the written file, None for no rows
+    """
+    if len(rows) == 0:
+        return None
+    table = columns(rows)
+    if pyarrow is not None:
+        path = os.path.join(output, 'part-{:05d}.parquet'.format(number))
+        pyarrow.parquet.write_table(pyarrow.table(table), path)
+    elif numpy is not None:
+        path = os.path.join(output, 'part-{:05d}.npz'.format(number))
+        numpy.savez_compressed(path, **numpycolumns(table))
+    else:
+        raise ImportError('Columnar output needs pyarrow or numpy: pip install pyarrow')
+    return path
+
+
+def extract_task(task):
+    """
+    Extract a chunk of records and write it. Runs in a worker process.
+    :param task: Dictionary with category, output, number, source, directory, keys or
+    segment, json_backend, zstd_dictionary and regions_file
+    :return: Tuple of the number of rows, the number of failed records and the file path
+    """
+    log = logging.getLogger(__name__)
+    loads = getloads(task['json_backend'])
+    dictionary = loaddictionary(task['zstd_dictionary'])
+
+    if task['source'] == 'segments':
+        reader = SegmentReader(task['directory'], dictionary=dictionary)
+        records = reader.records(task['segment'])
+    else:
+        records = ((key,) + readrecord(task['directory'], key, dictionary)
+                   for key in task['keys'])
+
+    _, page, entity = PAGES[task['category']]
+    decoded = []
+    failed = 0
+    for key, retrieved_at_time, rawjson in records:
+        try:
+            decoded.append((key, retrieved_at_time, graphqldata(rawjson, page, entity, loads)))
+        except (KeyError, IndexError, TypeError, ValueError):
+            log.exception('%s: Extraction failed', key)
+            failed += 1
+
+    # The tags of all pictures of the chunk share one cache of the normalized tags
+    tags = [None] * len(decoded)
+    if task['category'] == 'picture':
+        tags = batch_tags(datastore for _, _, datastore in decoded)
+
+    rows = []
+    for (key, retrieved_at_time, datastore), posttags in zip(decoded, tags):
+        try:
+            rows.append(parse_record(task['category'], key, retrieved_at_time, datastore, loads,
+                                     posttags))
+        except (KeyError, IndexError, TypeError, ValueError):
+            log.exception('%s: Extraction failed', key)
+            failed += 1
+    if task['category'] == 'location':
+        add_regions(rows, task['regions_file'])
+    return len(rows), failed, writechunk(task['output'], task['number'], rows)
+
+
+class BulkExtract():
+    """
+    BulkExtract walks the JSON directory or the segments of a category and extracts all
+    records on a process pool into columnar files. Segments can hold several retrievals of the
+    same key, their rows differ in retrieved_at_time.
+    """
+    def __init__(self,
+                 storage_directory='./downloads',
+                 processes=None,
+                 chunk_size=10000,
+                 json_backend='auto',
+                 zstd_dictionary=None,
+                 regions_file='./config/regions.geojson'):
+        """
+        :param storage_directory: Directory with the json and segments directories
+        :param processes: Number of processes, default is the number of CPUs
+        :param chunk_size: Records per output file when reading the JSON directories
+        :param json_backend: 'auto', 'orjson', 'simdjson' or 'json'
+        :param zstd_dictionary: Path of the zstd dictionary of the records
+        :param regions_file: GeoJSON file of the regions the locations are assigned to
+        """
+        self.log = logging.getLogger(__name__)
+        self.storage_directory = storage_directory
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.json_backend = json_backend
+        self.zstd_dictionary = zstd_dictionary
+        self.regions_file = regions_file
+
+    def tasks(self, category, output, source):
+        """
+        Split the archive of a category into tasks
+        :param category: 'location', 'user' or 'picture'
+        :param output: Output directory
+        :param source: 'objects' for the JSON directory, 'segments' for the segments
+        :return: List of task dictionaries for extract_task
+        """
+        storage_json = PAGES[category][0]
+        task = {
+            'category': category,
+            'output': output,
+            'source': source,
+            'json_backend': self.json_backend,
+            'zstd_dictionary': self.zstd_dictionary,
+            'regions_file': self.regions_file
+        }
+        tasks = []
+        if source == 'segments':
+            directory = os.path.join(self.storage_directory, 'segments', storage_json)
+            for number, segment in enumerate(SegmentReader(directory).segments()):
+                tasks.append(dict(task, number=number, directory=directory, segment=segment))
+        else:
+            directory = os.path.join(self.storage_directory, storage_json)
+            keys = sorted(set(filename.split('.json')[0] for filename in os.listdir(directory)
+                              if '.json' in filename))
+            for number, start in enumerate(range(0, len(keys), self.chunk_size)):
+                tasks.append(dict(task, number=number, directory=directory,
+                                  keys=keys[start:start + self.chunk_size]))
+        return tasks
+
+    def run(self, category, output, source='objects'):
+        """
+        Extract all archived records of a category
+        :param category: 'location', 'user' or 'picture'
+        :param output: Output directory
+        :param source: 'objects' for the JSON directory, 'segments' for the segments
+        :return: Dictionary with the number of rows, failed records and files written
+        """
+        if not os.path.exists(output):
+            os.makedirs(output)
+        tasks = self.tasks(category, output, source)
+        stats = {'rows': 0, 'failed': 0, 'files': 0}
+        done = 0
+
+        with mp.Pool(self.processes) as pool:
+            for rows, failed, path in pool.imap_unordered(extract_task, tasks):
+                done += 1
+                stats['rows'] += rows
+                stats['failed'] += failed
+                if path is not None:
+                    stats['files'] += 1
+                self.log.info('[%s]/[%s]: %s rows, %s failed', done, len(tasks), stats['rows'],
+                              stats['failed'])
+        return stats
@@ -0,0 +1,285 @@
+"""
+The dbwrite module coalesces DynamoDB writes. All attributes of a record are written with as
+few UpdateItem calls as the expression limits of DynamoDB allow, and discovered entities are
+inserted in batches.
+"""
+import logging
+import threading
+import time
+
+from botocore import errorfactory
+
+
+# DynamoDB limits an expression string to 4 KB and an UpdateExpression to 300 operators
+MAX_EXPRESSION_LENGTH = 4096
+MAX_ATTRIBUTES_PER_UPDATE = 100
+
+# Sparse attribute of the items that still wait for a pipeline step, 'discovered' until they
+# are retrieved and 'retrieved' until they are extracted. It is removed afterwards, so the
+# index over it only holds the pending items.
+STATUS_ATTRIBUTE = 'pipeline_status'
+STATUS_INDEX = 'pipeline_status-index'
+
+
+class WriteStats():
+    """
+    Counts the attributes written and the round trips needed for them
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = 0
+        self.attributes = 0
+        self.roundtrips = 0
+
+    def add(self, attributes, roundtrips):
+        """
+        Record one coalesced write
+        :param attributes: Number of attributes written
+        :param roundtrips: Number of UpdateItem calls used
+        :return: None
+        """
+        with self.lock:
+            self.records += 1
+            self.attributes += attributes
+            self.roundtrips += roundtrips
+
+    def merge(self, summary):
+        """
+        Add the counts of another WriteStats, e.g. from a worker process
+        :param summary: Result of WriteStats.summary
+        :return: None
+        """
+        with self.lock:
+            self.records += summary['records']
+            self.attributes += summary['attributes']
+            self.roundtrips += summary['roundtrips']
+
+    def saved(self):
+        """
+        Round trips saved compared to one UpdateItem per attribute
+        :return: Number of round trips
+        """
+        return self.attributes - self.roundtrips
+
+    def summary(self):
+        """
+        Summary for logging
+        :return: Dictionary with records, attributes, round trips and saved round trips
+        """
+        with self.lock:
+            return {'records': self.records,
+                    'attributes': self.attributes,
+                    'roundtrips': self.roundtrips,
+                    'saved': self.attributes - self.roundtrips}
+
+
+def build_updates(attributes, remove=()):
+    """
+    Split the attributes into SET expressions that stay within the DynamoDB limits. Attribute
+    names are always aliased, so reserved words like 'name' and names with dots work.
+    :param attributes: Dictionary of attribute name -> value
+    :param remove: Names of attributes to remove, added to the last expression
+    :return: List of (UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues)
+    """
+    updates = []
+    clauses = []
+    names = {}
+    values = {}
+    length = len('SET ')
+
+    for number, (name, value) in enumerate(attributes.items()):
+        clause = '#a{0} = :v{0}'.format(number)
+        if len(clauses) > 0 and (length + len(clause) + 2 > MAX_EXPRESSION_LENGTH or
+                                 len(clauses) >= MAX_ATTRIBUTES_PER_UPDATE):
+            updates.append(('SET ' + ', '.join(clauses), names, values))
+            clauses = []
+            names = {}
+            values = {}
+            length = len('SET ')
+        clauses.append(clause)
+        names['#a{}'.format(number)] = name
+        values[':v{}'.format(number)] = value
+        length += len(clause) + 2
+
+    if len(clauses) > 0:
+        updates.append(('SET ' + ', '.join(clauses), names, values))
+
+    if len(remove) > 0:
+        expression, names, values = updates.pop() if len(updates) > 0 else ('', {}, {})
+        clauses = []
+        for number, name in enumerate(remove):
+            clauses.append('#r{}'.format(number))
+            names['#r{}'.format(number)] = name
+        updates.append(((expression + ' REMOVE ' + ', '.join(clauses)).strip(), names, values))
+    return updates
+
+
+def update_attributes(table, key, attributes, stats=None, remove=()):
+    """
+    Write all attributes of a record with as few UpdateItem calls as possible
+    :param table: DynamoDB table resource
+    :param key: Key of the record, e.g. {'shortcode': 'BNKBq6LAzjq'}
+    :param attributes: Dictionary of attribute name -> value
+    :param stats: Optional WriteStats that counts the round trips
+    :param remove: Names of attributes to remove with the last call, e.g. [STATUS_ATTRIBUTE]
+    :return: Number of UpdateItem calls
+    """
+    log = logging.getLogger(__name__)
+    updates = build_updates(attributes, remove)
+
+    for expression, names, values in updates:
+        parameters = {}
+        if len(values) > 0:
+            parameters['ExpressionAttributeValues'] = values
+        table.update_item(
+            Key=key,
+            UpdateExpression=expression,
+            ExpressionAttributeNames=names,
+            **parameters
+        )
+
+    log.debug('%s: %s attributes written in %s round trips', key, len(attributes), len(updates))
+    if stats is not None:
+        stats.add(len(attributes), len(updates))
+    return len(updates)
+
+
+# DynamoDB limits BatchGetItem to 100 keys and BatchWriteItem to 25 requests
+BATCH_GET_SIZE = 100
+BATCH_WRITE_SIZE = 25
+
+
+def chunks(entries, size):
+    """
+    Split a list into chunks
+    :param entries: List
+    :param size: Maximum chunk size
+    :return: Generator of lists
+    """
+    for start in range(0, len(entries), size):
+        yield entries[start:start + size]
+
+
+def retry_unprocessed(call, requests, unprocessedkey, retries=8, backoff=0.05):
+    """
+    Call a batch operation and repeat it with exponential backoff for unprocessed requests
+    :param call: dynamo.batch_get_item or dynamo.batch_write_item
+    :param requests: RequestItems for the first call
+    :param unprocessedkey: 'UnprocessedKeys' or 'UnprocessedItems'
+    :param retries: Maximum number of repetitions
+    :param backoff: First backoff in seconds
+    :return: List of responses
+    """
+    responses = []
+    for attempt in range(retries + 1):
+        response = call(RequestItems=requests)
+        responses.append(response)
+        requests = response.get(unprocessedkey, {})
+        if len(requests) == 0:
+            return responses
+        time.sleep(backoff * 2 ** attempt)
+    raise RuntimeError('{} left after {} retries: {}'.format(unprocessedkey, retries, requests))
+
+
+def existing_keys(dynamo, entries):
+    """
+    Look up which keys already exist, for several tables at once
+    :param dynamo: DynamoDB service resource
+    :param entries: List of (table, key name, key value)
+    :return: Set of (table name, key value) that exist
+    """
+    existing = set()
+    for chunk in chunks(entries, BATCH_GET_SIZE):
+        requests = {}
+        for table, keyname, keyvalue in chunk:
+            request = requests.setdefault(table.name, {
+                'Keys': [],
+                'ProjectionExpression': '#k',
+                'ExpressionAttributeNames': {'#k': keyname}
+            })
+            request['Keys'].append({keyname: keyvalue})
+
+        for response in retry_unprocessed(dynamo.batch_get_item, requests, 'UnprocessedKeys'):
+            for tablename, items in response['Responses'].items():
+                keyname = requests[tablename]['ExpressionAttributeNames']['#k']
+                for item in items:
+                    existing.add((tablename, item[keyname]))
+    return existing
+
+
+def discover_items(dynamo, discoveries, strict=True, knownkeys=None):
+    """
+    Insert items whose key does not exist yet. The existing keys of all tables are looked up
+    with BatchGetItem and only new items are written, each with a conditional PutItem. Keys
+    the optional KnownKeys index already knows are skipped without a lookup. New items get the
+    'discovered' pipeline status.
+
+    Without strict the new items are written with BatchWriteItem instead. BatchWriteItem has
+    no conditions: an item inserted by another process between the lookup and the write
+    would be overwritten, so this is only safe when a single process discovers the keys.
+    :param dynamo: DynamoDB service resource
+    :param discoveries: List of (table, key name, list of items)
+    :param strict: Write new items with conditional PutItem calls, default is True
+    :param knownkeys: Optional knownkeys.KnownKeys index of existing keys
+    :return: Dictionary of table name -> list of inserted key values
+    """
+    log = logging.getLogger(__name__)
+    entries = []
+    newitems = {}
+    seen = set()
+    for table, keyname, items in discoveries:
+        keys = []
+        for item in items:
+            if (table.name, item[keyname]) in seen:
+                continue
+            seen.add((table.name, item[keyname]))
+            keys.append(item[keyname])
+            item = dict(item, **{STATUS_ATTRIBUTE: 'discovered'})
+            newitems[(table.name, item[keyname])] = (table, keyname, item)
+        if knownkeys is not None:
+            keys = knownkeys.unknown(table.name, keys)
+        entries.extend((table, keyname, key) for key in keys)
+
+    inserted = {table.name: [] for table, _, _ in discoveries}
+    if len(entries) == 0:
+        return inserted
+
+    newitems = {(table.name, key): newitems[(table.name, key)] for table, _, key in entries}
+    existing = existing_keys(dynamo, entries)
+    for key in existing:
+        newitems.pop(key, None)
+
+    if strict is True:
+        for table, keyname, item in newitems.values():
+            try:
+                table.put_item(
+                    Item=item,
+                    ConditionExpression='attribute_not_exists(#k)',
+                    ExpressionAttributeNames={
+                        '#k': keyname
+                    },
+                )
+                inserted[table.name].append(item[keyname])
+            except errorfactory.ClientError as error:
+                if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                existing.add((table.name, item[keyname]))
+    else:
+        for chunk in chunks(list(newitems.values()), BATCH_WRITE_SIZE):
+            requests = {}
+            for table, keyname, item in chunk:
+                requests.setdefault(table.name, []).append({'PutRequest': {'Item': item}})
+                inserted[table.name].append(item[keyname])
+            retry_unprocessed(dynamo.batch_write_item, requests, 'UnprocessedItems')
+
+    if knownkeys is not None:
+        knowntables = {}
+        for tablename, key in existing:
+            knowntables.setdefault(tablename, []).append(key)
+        for tablename, keys in inserted.items():
+            knowntables.setdefault(tablename, []).extend(keys)
+        for tablename, keys in knowntables.items():
+            knownkeys.add(tablename, keys)
+
+    log.debug('%s keys looked up, %s new items written', len(entries), len(newitems))
+    return inserted
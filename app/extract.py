@@ -10,7 +10,13 @@ from decimal import Decimal
 
 import boto3
 
-from botocore import errorfactory
+from .dbwrite import STATUS_ATTRIBUTE, WriteStats, discover_items, update_attributes
+from .geofence import GeoFence
+from .jsondecode import getloads, graphqldata
+from .knownkeys import KnownKeys
+from .storage import loaddictionary, readrecord
+from .tags import post_tags, post_texts, tokenize
+from .timeseries import TimeSeries
 
 
 def tag_extractor(text, category, keytag):
@@ -24,18 +30,222 @@ def tag_extractor(text, category, keytag):
 
     # category can be 'edge_media_to_caption' or 'edge_media_to_comment'
 
-    tag_list = set()
-    for comments in text[category]['edges']:
-        if keytag in comments['node']['text']:
-            splitted_tag_list = comments['node']['text'].split()
-            for tag in splitted_tag_list:
-                if keytag in tag:
-                    subtag_list = tag.split(keytag)
-                    for subtag in subtag_list:
-                        tag_list.add(subtag)
-    tag_list.discard('')
+    hashtags, mentions = tokenize(post_texts(text, [category]))
+    if keytag == '#':
+        return hashtags
+    return mentions
 
-    return tag_list
+
+def parse_location(locationid, datastore, loads=json.loads):
+    """
+    Location details from the GraphQL data of a location page
+    :param locationid: Location ID, for logging
+    :param datastore: The location GraphQL data
+    :param loads: Function to decode the embedded address JSON
+    :return: Dictionary of the location attributes
+    """
+    log = logging.getLogger(__name__)
+    location = {}
+
+    # Extract location details from JSON
+    locationdict = ['name', 'has_public_page', 'slug', 'blurb', 'website', 'phone',
+                    'primary_alias_on_fb']
+    for element in locationdict:
+        if datastore[element] not in ['', None]:
+            location[element] = datastore[element]
+
+    # Extract location coordinates as Decimal
+    locationcoordinates = ['lat', 'lng']
+    for element in locationcoordinates:
+        if datastore[element] not in ['', None]:
+            location[element] = Decimal(str(datastore[element]))
+
+    # Unpack and extract JSON location address details
+    if datastore['address_json'] not in ['', None]:
+        addressjson = loads(datastore['address_json'])
+        addressdict = ['street_address', 'zip_code', 'city_name', 'region_name', 'country_code',
+                       'exact_city_match', 'exact_region_match', 'exact_country_match']
+        for element in addressdict:
+            if addressjson[element] not in ['', None]:
+                location['json_' + element] = addressjson[element]
+
+    # Extract location directory details from JSON
+    try:
+        countryjson = datastore['directory']['country']
+        directorydict = ['id', 'name', 'slug']
+        cityjson = datastore['directory']['city']
+
+        for element in directorydict:
+            if countryjson[element] not in ['', None]:
+                location['country_' + element] = countryjson[element]
+
+        for element in directorydict:
+            if cityjson[element] not in ['', None]:
+                location['city_' + element] = cityjson[element]
+
+    except KeyError:
+        log.info('Location %s: No directory details available', locationid)
+
+    # Extract further location details
+    location['media_count'] = datastore['edge_location_to_media']['count']
+
+    return location
+
+
+def parse_picture(shortcode, datastore, retrieved_at_time, tags=None):
+    """
+    Picture details from the GraphQL data of a post page
+    :param shortcode: Picture shortcode, for logging
+    :param datastore: The shortcode_media GraphQL data
+    :param retrieved_at_time: Retrieval time of the page as unix timestamp
+    :param tags: Optional (hashtags, mentions) of the post from batch_tags
+    :return: Dictionary of the picture attributes
+    """
+    log = logging.getLogger(__name__)
+    picture = {}
+
+    # Extract picture details from JSON - 1st level
+    postlist = ['gating_info', 'display_url', 'accessibility_caption', 'is_video',
+                'should_log_client_event', 'caption_is_edited', 'has_ranked_comments',
+                'comments_disabled', 'taken_at_timestamp', 'is_ad']
+
+    for element in postlist:
+        try:
+            if datastore[element] not in ['', None]:
+                picture[element] = datastore[element]
+        except KeyError:
+            log.debug('Picture %s: %s not available within post', shortcode, element)
+    picture['id'] = int(datastore['id'])
+
+    # Extract picture details from JSON - Size details
+    sizelist = ['height', 'width']
+    for element in sizelist:
+        if datastore['dimensions'][element] not in ['', None]:
+            picture['size_' + element] = datastore['dimensions'][element]
+
+    # Extract picture details from JSON - edge_media_to_tagged_user
+    if len(datastore['edge_media_to_tagged_user']['edges']) > 0:
+        tagged_users = set()
+        for user in datastore['edge_media_to_tagged_user']['edges']:
+            tagged_users.add(user['node']['user']['username'])
+        picture['tagged_users'] = list(tagged_users)
+        picture['tagged_users_count'] = len(tagged_users)
+
+    else:
+        picture['tagged_users_count'] = 0
+
+    # Extract picture details from JSON - edge_media_to_caption
+    try:
+        picture['caption'] = datastore['edge_media_to_caption']['edges'][0]['node']['text']
+    except IndexError:
+        log.debug('Picture %s: No caption available', shortcode)
+
+    # Extract picture details from JSON - edge_media_to_comment
+    if len(datastore['edge_media_to_comment']['edges']) > 0:
+        picture_comments_commenters = set()
+        for user in datastore['edge_media_to_comment']['edges']:
+            picture_comments_commenters.add(user['node']['owner']['username'])
+        picture['comments_count'] = datastore['edge_media_to_comment']['count']
+        picture['comments_has_next_page'] = datastore['edge_media_to_comment']\
+            ['page_info']['has_next_page']
+        picture['commenters'] = list(picture_comments_commenters)
+        picture['commenters_count'] = len(picture_comments_commenters)
+    else:
+        picture['comments_count'] = 0
+        picture['commenters_count'] = 0
+        picture['comments_has_next_page'] = False
+
+    # Extract picture details from JSON - Owner and did he/she answer comments
+    picture['owner'] = datastore['owner']['username']
+    picture['ownerid'] = int(datastore['owner']['id'])
+    try:
+        if picture['owner'] in picture['commenters']:
+            picture['owner_commented'] = True
+    except KeyError:
+        picture['owner_comments'] = False
+
+    # Extract picture details from JSON - edge_media_preview_like
+    picture['likes_count'] = datastore['edge_media_preview_like']['count']
+
+    # Extract picture details from JSON - edge_media_to_sponsor_user
+    try:
+        picture['sponsor'] = datastore['edge_media_to_sponsor_user']['edges']\
+            [0]['node']['sponsor']['username']
+    except IndexError:
+        log.debug('Picture {}: No sponsor found')
+
+    # Extract picture details from JSON - location
+    try:
+        picture['location_id'] = int(datastore['location']['id'])
+    except TypeError:
+        log.debug('Picture %s: No location available', shortcode)
+
+    # Extract picture details from JSON - time between "retrieved" and picture posted
+    picture['time_passed'] = retrieved_at_time - picture['taken_at_timestamp']
+
+    # Extract picture details from JSON - Hashtags and referenced users of the caption
+    # and the comments
+    if tags is None:
+        tags = post_tags(datastore)
+    picture_ht_list, picture_ref_list = tags
+    log.debug(picture_ht_list)
+    log.debug(picture_ref_list)
+
+    if len(picture_ht_list) > 0:
+        picture['hashtags'] = list(picture_ht_list)
+        picture['hashtags_count'] = len(picture_ht_list)
+    else:
+        picture['hashtags_count'] = 0
+
+    if len(picture_ref_list) > 0:
+        picture['referenced_users'] = list(picture_ref_list)
+        picture['referenced_users_count'] = len(picture_ref_list)
+    else:
+        picture['referenced_users_count'] = 0
+
+    return picture
+
+
+def parse_user(username, datastore, loads=json.loads):
+    """
+    User details from the GraphQL data of a profile page
+    :param username: Username, for logging
+    :param datastore: The user GraphQL data
+    :param loads: Function to decode the embedded business address JSON
+    :return: Dictionary of the user attributes
+    """
+    log = logging.getLogger(__name__)
+    user = {}
+
+    # Extract user details from JSON
+    userlist = ['biography', 'business_category_name', 'business_email',
+                'business_phone_number', 'connected_fb_page', 'country_block',
+                'external_url', 'full_name', 'has_channel', 'highlight_reel_count',
+                'is_business_account', 'is_joined_recently', 'is_private',
+                'is_verified', 'profile_pic_url_hd']
+
+    for element in userlist:
+        try:
+            if datastore[element] not in ['', None]:
+                user[element] = datastore[element]
+        except KeyError:
+            log.debug('User %s: %s not available within post', user, element)
+    user['id'] = int(datastore['id'])
+
+    # Extract user details from JSON - business details
+    if datastore['business_address_json'] not in ['', None]:
+        busaddrjson = loads(datastore['business_address_json'])
+        baddrlist = ['street_address', 'zip_code', 'city_name', 'region_name', 'country_code']
+        for element in baddrlist:
+            if busaddrjson[element] not in ['', None]:
+                user['json_' + element] = busaddrjson[element]
+
+    # Extract user details from JSON - follower, follow & posts detail
+    user['follow_count'] = datastore['edge_follow']['count']
+    user['followed_by_count'] = datastore['edge_followed_by']['count']
+    user['posts_count'] = datastore['edge_owner_to_timeline_media']['count']
+
+    return user
 
 
 class Extract:
@@ -46,7 +256,16 @@ class Extract:
     def __init__(self,
                  awsprofile='default',
                  awsregion='eu-central-1',
-                 storage_directory='./downloads'):
+                 storage_directory='./downloads',
+                 zstd_dictionary=None,
+                 strict_discovery=True,
+                 knownkeys_directory=None,
+                 knownkeys_error_rate=0.001,
+                 knownkeys_exact=True,
+                 json_backend='auto',
+                 subtree_json=False,
+                 regions_file='./config/regions.geojson',
+                 timeseries_directory=None):
 
         self.log = logging.getLogger(__name__)
         self.awssession = boto3.session.Session(profile_name=awsprofile, region_name=awsregion)
@@ -62,453 +281,259 @@ class Extract:
         self.storage_json_user = 'json/user'
         self.storage_json_post = 'json/post'
         self.storage_pictures = 'pictures'
+        self.zstd_dictionary = loaddictionary(zstd_dictionary)
+        self.writestats = WriteStats()
+        self.strict_discovery = strict_discovery
+        self.loads = getloads(json_backend)
+        self.subtree_json = subtree_json
+        self.geofence = GeoFence(regions_file)
+        # With a local time series store the weekly snapshots are synced to DynamoDB later
+        self.timeseries = None
+        if timeseries_directory is not None:
+            self.timeseries = {
+                'location': TimeSeries(timeseries_directory, 'location'),
+                'user': TimeSeries(timeseries_directory, 'user')
+            }
+        self.knownkeys = None
+        if knownkeys_directory is not None:
+            self.knownkeys = KnownKeys(knownkeys_directory,
+                                       error_rate=knownkeys_error_rate,
+                                       exact=knownkeys_exact)
 
-    def location_details(self, locationid):
+    def warm_knownkeys(self, category):
+        """
+        Load all existing keys of a category into the known keys index
+        :param category: 'location', 'user' or 'picture'
+        :return: Number of keys loaded
+        """
+        tables = {
+            'location': (self.locdb, 'id'),
+            'user': (self.userdb, 'username'),
+            'picture': (self.picdb, 'shortcode')
+        }
+        table, keyname = tables[category]
+        return self.knownkeys.warm(table, keyname)
+
+    def sync_snapshots(self, category):
+        """
+        Write the weekly snapshots of the local time series store to DynamoDB
+        :param category: 'location' or 'user'
+        :return: Number of snapshots written
+        """
+        if category == 'location':
+            return self.timeseries['location'].sync(self.locdbupdate, 'id', int)
+        return self.timeseries['user'].sync(self.userdbupdate, 'username')
+
+    def close(self):
+        """
+        Persist the known keys index and close the time series store
+        :return: None
+        """
+        if self.knownkeys is not None:
+            self.knownkeys.save()
+        if self.timeseries is not None:
+            for timeseries in self.timeseries.values():
+                timeseries.close()
+
+    def location_details(self, locationid, rawjson=None, retrieved_at_time=None):
         """
         Extraction of location details
         :param locationid: Location ID
+        :param rawjson: Optional JSON as fetched, otherwise it is read from the file
+        :param retrieved_at_time: Retrieval time of rawjson as unix timestamp
         :return: None
         """
 
-        #Configure dictionary for saving the results
-        location = {}
-
         #Get json from file
-        file_storage_json_location = os.path.join(self.storage_directory,
-                                                  self.storage_json_location)
-        with open('{}/{}.json'.format(file_storage_json_location, locationid), 'r') as file:
-            filetext = file.read().split('\n')
-            rawjson = filetext[1]
-            retrieved_at_time = int(filetext[0])
+        if rawjson is None:
+            file_storage_json_location = os.path.join(self.storage_directory,
+                                                      self.storage_json_location)
+            retrieved_at_time, rawjson = readrecord(file_storage_json_location, locationid,
+                                                    self.zstd_dictionary)
 
         # Transform JSON from file
-        rawdatastore = json.loads(rawjson)
-        datastore = rawdatastore['entry_data']['LocationsPage'][0]['graphql']['location']
+        datastore = graphqldata(rawjson, 'LocationsPage', 'location', self.loads,
+                                self.subtree_json)
 
         # Extract location details from JSON
-        locationdict = ['name', 'has_public_page', 'slug', 'blurb', 'website', 'phone',
-                        'primary_alias_on_fb']
-        for element in locationdict:
-            if datastore[element] not in ['', None]:
-                location[element] = datastore[element]
+        location = parse_location(locationid, datastore, self.loads)
 
-        # Extract location coordinates as Decimal
-        locationcoordinates = ['lat', 'lng']
-        for element in locationcoordinates:
-            if datastore[element] not in ['', None]:
-                location[element] = Decimal(str(datastore[element]))
-
-        # Unpack and extract JSON location address details
-        if datastore['address_json'] not in ['', None]:
-            addressjson = json.loads(datastore['address_json'])
-            addressdict = ['street_address', 'zip_code', 'city_name', 'region_name', 'country_code',
-                           'exact_city_match', 'exact_region_match', 'exact_country_match']
-            for element in addressdict:
-                if addressjson[element] not in ['', None]:
-                    location['json_' + element] = addressjson[element]
-
-        # Extract location directory details from JSON
-        try:
-            countryjson = datastore['directory']['country']
-            directorydict = ['id', 'name', 'slug']
-            cityjson = datastore['directory']['city']
-
-            for element in directorydict:
-                if countryjson[element] not in ['', None]:
-                    location['country_' + element] = countryjson[element]
-
-            for element in directorydict:
-                if cityjson[element] not in ['', None]:
-                    location['city_' + element] = cityjson[element]
-
-        except KeyError:
-            self.log.info('Location %s: No directory details available', locationid)
+        # Region of the location
+        region = None
+        if 'lat' in location and 'lng' in location:
+            region = self.geofence.locate(location['lat'], location['lng'])
+            if region is not None:
+                location['region'] = region
 
-        # Extract further location details & timestamp
-        location['media_count'] = datastore['edge_location_to_media']['count']
         location['processed_at_time'] = int(datetime.now().strftime('%s'))
         self.log.info('Location details for %s extracted', locationid)
 
         # Update into DB
         self.log.debug('Location keys for location %s: %s', locationid, location.keys())
-        for key in location:
-            self.log.debug('For location %s update %s to %s', locationid, key, location[key])
-            self.locdb.update_item(
-                Key={
-                    'id': int(locationid)
-                },
-                UpdateExpression='SET #key = :value',
-                ExpressionAttributeNames={
-                    '#key': key
-                },
-                ExpressionAttributeValues={
-                    ':value': location[key]
-                },
-            )
+        update_attributes(self.locdb, {'id': int(locationid)}, location, self.writestats,
+                          [STATUS_ATTRIBUTE])
         self.log.info('Location %s saved to DB', locationid)
 
         # Weekly snapshot
-        self.locdbupdate.put_item(
-            Item={
-                'id': int(locationid),
-                'at_time': int(datetime.now().strftime('%s')),
-                'media_count': location['media_count']
-            }
-        )
-
-        # Only extract picture from Switzerland
-        # North 47.808463, 8.568019
-        # South 45.817933, 9.017074
-        # West 46.132250, 5.955882
-        # East 46.615055, 10.492088
-        try:
-            if 5.955882 < location['lng'] < 10.492088 and 45.817933 < location['lat'] < 47.808463:
-                pictures = []
-                for pic in range(len(datastore['edge_location_to_media']['edges'])):
-                    pictures.append((datastore['edge_location_to_media']['edges'][pic]
-                                     ['node']['shortcode'],
-                                     datastore['edge_location_to_media']['edges'][pic]
-                                     ['node']['owner']['id']))
-                self.log.debug(pictures)
-
-                # Upload extracted pictures
-                failedpictures = []
-                uploadedpictures = []
-
-                for pic in pictures:
-                    try:
-                        self.picdb.put_item(
-                            Item={
-                                'shortcode': pic[0],
-                                'userid': pic[1],
-                                'discovered_at_time': retrieved_at_time
-                            },
-                            ConditionExpression='attribute_not_exists(#sc)',
-                            ExpressionAttributeNames={
-                                '#sc': 'shortcode'
-                            },
-                        )
-                        uploadedpictures.append(pic[0])
-                    except errorfactory.ClientError as error:
-                        if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
-                            failedpictures.append(pic[0])
-                            self.log.debug('Entry %s already exists in the database', pic)
-                        else:
-                            raise
-
-                if len(uploadedpictures) > 0:
-                    self.log.info('For %s the following %s pictures were added: %s',
-                                  locationid,
-                                  len(uploadedpictures),
-                                  uploadedpictures)
-                else:
-                    self.log.info('No new pictures from location %s extracted', locationid)
-
-                self.log.debug('The following pictures already exist in the DB: %s', failedpictures)
+        snapshot = {
+            'id': int(locationid),
+            'at_time': int(datetime.now().strftime('%s')),
+            'media_count': location['media_count']
+        }
+        if self.timeseries is not None:
+            self.timeseries['location'].append(locationid, snapshot['at_time'], snapshot)
+        else:
+            self.locdbupdate.put_item(Item=snapshot)
 
-            else:
-                self.log.info('No pictures for location %s have been extracted as '
-                              'they are likely outside Switzerland',
-                              locationid)
-        except KeyError:
+        # Only extract pictures from locations within one of the regions
+        if 'lat' not in location or 'lng' not in location:
             self.log.info('%s: Location has no geo coordinates', locationid)
+        elif region is not None:
+            pictures = []
+            for pic in range(len(datastore['edge_location_to_media']['edges'])):
+                pictures.append((datastore['edge_location_to_media']['edges'][pic]
+                                 ['node']['shortcode'],
+                                 datastore['edge_location_to_media']['edges'][pic]
+                                 ['node']['owner']['id']))
+            self.log.debug(pictures)
+
+            # Upload extracted pictures
+            discovered = []
+            for pic in pictures:
+                discovered.append({
+                    'shortcode': pic[0],
+                    'userid': pic[1],
+                    'discovered_at_time': retrieved_at_time
+                })
+            inserted = discover_items(self.dynamo,
+                                      [(self.picdb, 'shortcode', discovered)],
+                                      self.strict_discovery, self.knownkeys)
+            uploadedpictures = inserted[self.picdb.name]
+            failedpictures = [pic[0] for pic in pictures if pic[0] not in uploadedpictures]
+
+            if len(uploadedpictures) > 0:
+                self.log.info('For %s the following %s pictures were added: %s',
+                              locationid,
+                              len(uploadedpictures),
+                              uploadedpictures)
+            else:
+                self.log.info('No new pictures from location %s extracted', locationid)
+
+            self.log.debug('The following pictures already exist in the DB: %s', failedpictures)
+
+        else:
+            self.log.info('No pictures for location %s have been extracted as '
+                          'it is outside of the regions',
+                          locationid)
 
-    def picture_details(self, shortcode):
+    def picture_details(self, shortcode, rawjson=None, retrieved_at_time=None):
         """
         Extract picture details
         :param shortcode: Picture shortcode
+        :param rawjson: Optional JSON as fetched, otherwise it is read from the file
+        :param retrieved_at_time: Retrieval time of rawjson as unix timestamp
         :return: None
         """
 
-        # Configure dictionary for saving the results
-        picture = {}
-
         # Get json from file
-        try:
-            file_storage_json_picture = os.path.join(self.storage_directory, self.storage_json_post)
-            with open('{}/{}.json'.format(file_storage_json_picture, shortcode), 'r') as file:
-                filetext = file.read().split('\n')
-                rawjson = filetext[1]
-                retrieved_at_time = int(filetext[0])
-
-        except FileNotFoundError:
-            self.log.debug('%s: File not found', shortcode)
-            raise
-
-        # Transform JSON from file
-        rawdatastore = json.loads(rawjson)
-        datastore = rawdatastore['entry_data']['PostPage'][0]['graphql']['shortcode_media']
-
-        # Extract picture details from JSON - 1st level
-        postlist = ['gating_info', 'display_url', 'accessibility_caption', 'is_video',
-                    'should_log_client_event', 'caption_is_edited', 'has_ranked_comments',
-                    'comments_disabled', 'taken_at_timestamp', 'is_ad']
-
-        for element in postlist:
+        if rawjson is None:
             try:
-                if datastore[element] not in ['', None]:
-                    picture[element] = datastore[element]
-            except KeyError:
-                self.log.debug('Picture %s: %s not available within post', shortcode, element)
-        picture['id'] = int(datastore['id'])
-
-        # Extract picture details from JSON - Size details
-        sizelist = ['height', 'width']
-        for element in sizelist:
-            if datastore['dimensions'][element] not in ['', None]:
-                picture['size_' + element] = datastore['dimensions'][element]
-
-        # Extract picture details from JSON - edge_media_to_tagged_user
-        if len(datastore['edge_media_to_tagged_user']['edges']) > 0:
-            tagged_users = set()
-            for user in datastore['edge_media_to_tagged_user']['edges']:
-                tagged_users.add(user['node']['user']['username'])
-            picture['tagged_users'] = list(tagged_users)
-            picture['tagged_users_count'] = len(tagged_users)
-
-        else:
-            picture['tagged_users_count'] = 0
+                file_storage_json_picture = os.path.join(self.storage_directory,
+                                                         self.storage_json_post)
+                retrieved_at_time, rawjson = readrecord(file_storage_json_picture, shortcode,
+                                                        self.zstd_dictionary)
 
-        # Extract picture details from JSON - edge_media_to_caption
-        try:
-            picture['caption'] = datastore['edge_media_to_caption']['edges'][0]['node']['text']
-        except IndexError:
-            self.log.debug('Picture %s: No caption available', shortcode)
-
-        # Extract picture details from JSON - edge_media_to_comment
-        if len(datastore['edge_media_to_comment']['edges']) > 0:
-            picture_comments_commenters = set()
-            for user in datastore['edge_media_to_comment']['edges']:
-                picture_comments_commenters.add(user['node']['owner']['username'])
-            picture['comments_count'] = datastore['edge_media_to_comment']['count']
-            picture['comments_has_next_page'] = datastore['edge_media_to_comment']\
-                ['page_info']['has_next_page']
-            picture['commenters'] = list(picture_comments_commenters)
-            picture['commenters_count'] = len(picture_comments_commenters)
-        else:
-            picture['comments_count'] = 0
-            picture['commenters_count'] = 0
-            picture['comments_has_next_page'] = False
-
-        # Extract picture details from JSON - Owner and did he/she answer comments
-        picture['owner'] = datastore['owner']['username']
-        picture['ownerid'] = int(datastore['owner']['id'])
-        try:
-            if picture['owner'] in picture['commenters']:
-                picture['owner_commented'] = True
-        except KeyError:
-            picture['owner_comments'] = False
-
-        # Extract picture details from JSON - edge_media_preview_like
-        picture['likes_count'] = datastore['edge_media_preview_like']['count']
+            except FileNotFoundError:
+                self.log.debug('%s: File not found', shortcode)
+                raise
 
-        # Extract picture details from JSON - edge_media_to_sponsor_user
-        try:
-            picture['sponsor'] = datastore['edge_media_to_sponsor_user']['edges']\
-                [0]['node']['sponsor']['username']
-        except IndexError:
-            self.log.debug('Picture {}: No sponsor found')
+        # Transform JSON from file
+        datastore = graphqldata(rawjson, 'PostPage', 'shortcode_media', self.loads,
+                                self.subtree_json)
 
-        # Extract picture details from JSON - location
-        try:
-            picture['location_id'] = int(datastore['location']['id'])
-        except TypeError:
-            self.log.debug('Picture %s: No location available', shortcode)
-
-        # Extract picture details from JSON - time between "retrieved" and picture posted
-        picture['time_passed'] = retrieved_at_time - picture['taken_at_timestamp']
-
-        # Extract picture details from JSON - Extracted Hashtags
-        picture_ht_list = set()
-
-        # -- Find hashtags or user references in the picture caption
-        if len(datastore['edge_media_to_caption']['edges']) > 0:
-            caption_tag_list = tag_extractor(datastore, 'edge_media_to_caption', '#')
-            for tag in caption_tag_list:
-                picture_ht_list.add(tag)
-
-        # -- Find hashtags or user references in the comments
-        if len(datastore['edge_media_to_comment']['edges']) > 0:
-            media_tag_list = tag_extractor(datastore, 'edge_media_to_comment', '#')
-            for tag in media_tag_list:
-                picture_ht_list.add(tag)
-        self.log.debug(picture_ht_list)
-
-        if len(picture_ht_list) > 0:
-            picture['hashtags'] = list(picture_ht_list)
-            picture['hashtags_count'] = len(picture_ht_list)
-        else:
-            picture['hashtags_count'] = 0
-
-        # Extract picture details from JSON - Referenced users
-        picture_ref_list = set()
-
-        # -- Find hashtags or user references in the picture caption
-        if len(datastore['edge_media_to_caption']['edges']) > 0:
-            caption_tag_list = tag_extractor(datastore, 'edge_media_to_caption', '@')
-            for tag in caption_tag_list:
-                picture_ref_list.add(tag)
-
-        # -- Find hashtags or user references in the comments
-        if len(datastore['edge_media_to_comment']['edges']) > 0:
-            media_tag_list = tag_extractor(datastore, 'edge_media_to_comment', '@')
-            for tag in media_tag_list:
-                picture_ref_list.add(tag)
-        self.log.debug(picture_ref_list)
-        if len(picture_ref_list) > 0:
-            picture['referenced_users'] = list(picture_ref_list)
-            picture['referenced_users_count'] = len(picture_ref_list)
-        else:
-            picture['referenced_users_count'] = 0
+        # Extract picture details from JSON
+        picture = parse_picture(shortcode, datastore, retrieved_at_time)
 
         # Extract picture details from JSON - When was it processed
         picture['processed_at_time'] = int(datetime.now().strftime('%s'))
 
         # Update into DB
-        for key in picture:
-            self.log.debug('For picture %s update %s to %s', shortcode, key, picture[key])
-            self.picdb.update_item(
-                Key={
-                    'shortcode': shortcode
-                },
-                UpdateExpression='SET #key = :value',
-                ExpressionAttributeNames={
-                    '#key': key
-                },
-                ExpressionAttributeValues={
-                    ':value': picture[key]
-                },
-            )
-
-        # Extract location details & timestamp
+        self.log.debug('Picture keys for picture %s: %s', shortcode, picture.keys())
+        update_attributes(self.picdb, {'shortcode': shortcode}, picture, self.writestats,
+                          [STATUS_ATTRIBUTE])
+
+        # Extract location and user details & timestamp
+        discoveries = []
         try:
             location = int(datastore['location']['id'])
-            self.locdb.put_item(
-                Item={
-                    'id': location,
-                    'discovered_at_time': retrieved_at_time
-                },
-                ConditionExpression='attribute_not_exists(id)'
-            )
+            discoveries.append((self.locdb, 'id', [{
+                'id': location,
+                'discovered_at_time': retrieved_at_time
+            }]))
         except TypeError:
             self.log.info('%s: No location availabe', shortcode)
-        except errorfactory.ClientError as error:
-            if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
-                self.log.debug('Entry %s already exists in the database', shortcode)
-            else:
-                raise
 
-        # Extract user details & timestamp
-        try:
-            username = datastore['owner']['username']
-            userid = int(datastore['owner']['id'])
+        discoveries.append((self.userdb, 'username', [{
+            'username': datastore['owner']['username'],
+            'userid': int(datastore['owner']['id']),
+            'discovered_at_time': retrieved_at_time
+        }]))
 
-            self.userdb.put_item(
-                Item={
-                    'username': username,
-                    'userid': userid,
-                    'discovered_at_time': retrieved_at_time
-                },
-                ConditionExpression='attribute_not_exists(username)'
-            )
-        except errorfactory.ClientError as error:
-            if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
-                self.log.debug('%s: Entry already exists in the database', shortcode)
-            else:
-                raise
+        inserted = discover_items(self.dynamo, discoveries, self.strict_discovery,
+                                  self.knownkeys)
+        if len(inserted[self.userdb.name]) == 0:
+            self.log.debug('%s: Entry already exists in the database', shortcode)
 
-    def user_details(self, username):
+    def user_details(self, username, rawjson=None, retrieved_at_time=None):
         """
         Extract user detils
         :param username: username for user
+        :param rawjson: Optional JSON as fetched, otherwise it is read from the file
+        :param retrieved_at_time: Retrieval time of rawjson as unix timestamp
         :return: None
         """
 
-        # Configure dictionary for saving the results
-        user = {}
-
         # Get json from file
-        file_storage_json_user = os.path.join(self.storage_directory, self.storage_json_user)
-        with open('{}/{}.json'.format(file_storage_json_user, username), 'r') as file:
-            filetext = file.read().split('\n')
-            rawjson = filetext[1]
-            retrieved_at_time = int(filetext[0])
+        if rawjson is None:
+            file_storage_json_user = os.path.join(self.storage_directory, self.storage_json_user)
+            retrieved_at_time, rawjson = readrecord(file_storage_json_user, username,
+                                                    self.zstd_dictionary)
 
         # Transform JSON from file
-        rawdatastore = json.loads(rawjson)
-        datastore = rawdatastore['entry_data']['ProfilePage'][0]['graphql']['user']
+        datastore = graphqldata(rawjson, 'ProfilePage', 'user', self.loads, self.subtree_json)
 
         # Extract user details from JSON
-        userlist = ['biography', 'business_category_name', 'business_email',
-                    'business_phone_number', 'connected_fb_page', 'country_block',
-                    'external_url', 'full_name', 'has_channel', 'highlight_reel_count',
-                    'is_business_account', 'is_joined_recently', 'is_private',
-                    'is_verified', 'profile_pic_url_hd']
-
-        for element in userlist:
-            try:
-                if datastore[element] not in ['', None]:
-                    user[element] = datastore[element]
-            except KeyError:
-                self.log.debug('User %s: %s not available within post', user, element)
-        user['id'] = int(datastore['id'])
-
-        # Extract user details from JSON - business details
-        if datastore['business_address_json'] not in ['', None]:
-            busaddrjson = json.loads(datastore['business_address_json'])
-            baddrlist = ['street_address', 'zip_code', 'city_name', 'region_name', 'country_code']
-            for element in baddrlist:
-                if busaddrjson[element] not in ['', None]:
-                    user['json_' + element] = busaddrjson[element]
-
-        # Extract user details from JSON - follower, follow & posts detail
-        user['follow_count'] = datastore['edge_follow']['count']
-        user['followed_by_count'] = datastore['edge_followed_by']['count']
-        user['posts_count'] = datastore['edge_owner_to_timeline_media']['count']
+        user = parse_user(username, datastore, self.loads)
         user['processed_at_time'] = int(datetime.now().strftime('%s'))
 
         # Update into DB
-        for key in user:
-            self.log.debug('For user %s update %s to %s', user, key, user[key])
-            self.userdb.update_item(
-                Key={
-                    'username': username
-                },
-                UpdateExpression='SET #key = :value',
-                ExpressionAttributeNames={
-                    '#key': key
-                },
-                ExpressionAttributeValues={
-                    ':value': user[key]
-                },
-            )
+        self.log.debug('User keys for user %s: %s', username, user.keys())
+        update_attributes(self.userdb, {'username': username}, user, self.writestats,
+                          [STATUS_ATTRIBUTE])
 
         # Extract picture details & timestamp
+        discovered = []
         for picture in datastore['edge_owner_to_timeline_media']['edges']:
-            try:
-                self.picdb.put_item(
-                    Item={
-                        'shortcode': picture['node']['shortcode'],
-                        'userid': int(picture['node']['owner']['id']),
-                        'discovered_at_time': retrieved_at_time
-                    },
-                    ConditionExpression='attribute_not_exists(username)'
-                )
-            except errorfactory.ClientError as error:
-                if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
-                    self.log.debug('Entry %s already exists in the database', picture)
-                else:
-                    raise
+            discovered.append({
+                'shortcode': picture['node']['shortcode'],
+                'userid': int(picture['node']['owner']['id']),
+                'discovered_at_time': retrieved_at_time
+            })
+        inserted = discover_items(self.dynamo, [(self.picdb, 'shortcode', discovered)],
+                                  self.strict_discovery, self.knownkeys)
+        self.log.debug('User %s: %s new pictures discovered', username,
+                       len(inserted[self.picdb.name]))
 
         # Weekly snapshot
-
-        self.userdbupdate.put_item(
-            Item={
-                'username': username,
-                'at_time': int(datetime.now().strftime('%s')),
-                'id': int(datastore['id']),
-                'follow_count': user['follow_count'],
-                'followed_by_count': user['followed_by_count'],
-                'posts_count': user['posts_count']
-            }
-        )
+        snapshot = {
+            'username': username,
+            'at_time': int(datetime.now().strftime('%s')),
+            'id': int(datastore['id']),
+            'follow_count': user['follow_count'],
+            'followed_by_count': user['followed_by_count'],
+            'posts_count': user['posts_count']
+        }
+        if self.timeseries is not None:
+            self.timeseries['user'].append(username, snapshot['at_time'], snapshot)
+        else:
+            self.userdbupdate.put_item(Item=snapshot)
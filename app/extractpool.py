@@ -0,0 +1,202 @@
+"""
+The extractpool module runs the extraction of many keys in parallel. Parsing the JSONs needs
+CPU, writing to DynamoDB waits on the network, so the work is spread over processes with a
+thread pool each. Every thread has its own Extract instance, because boto3 resources must not
+be shared between threads.
+"""
+import itertools
+import logging
+import multiprocessing as mp
+import multiprocessing.util
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .dbwrite import WriteStats
+from .extract import Extract
+
+
+# State of the current worker process, set up by worker_init
+WORKER = {}
+
+
+def chunked(keys, size):
+    """
+    Split an iterable into chunks without reading it ahead
+    :param keys: Iterable
+    :param size: Maximum chunk size
+    :return: Generator of lists
+    """
+    keys = iter(keys)
+    while True:
+        chunk = list(itertools.islice(keys, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+def bounded(entries, window):
+    """
+    Hand out entries only while the window has room. Pool.imap reads its input as fast as it
+    can, so a lazy input would be read into memory completely. The consumer releases the
+    window once per finished entry.
+    :param entries: Iterable
+    :param window: threading.BoundedSemaphore
+    :return: Generator of the entries
+    """
+    for entry in entries:
+        window.acquire()
+        yield entry
+
+
+def worker_init(options, threads, pooled=False):
+    """
+    Set up a worker process
+    :param options: Keyword arguments for Extract
+    :param threads: Number of extraction threads in this process
+    :param pooled: The process is a pool worker, its Extract instances are closed when it exits
+    :return: None
+    """
+    WORKER['options'] = options
+    WORKER['local'] = threading.local()
+    WORKER['executor'] = ThreadPoolExecutor(max_workers=threads)
+    WORKER['writestats'] = WriteStats()
+    WORKER['extracts'] = []
+    WORKER['lock'] = threading.Lock()
+    if pooled:
+        # Runs when the worker leaves its loop after Pool.close, not on Pool.terminate
+        multiprocessing.util.Finalize(None, worker_close, exitpriority=10)
+
+
+def worker_close():
+    """
+    Close the Extract instances of the worker, which saves their known keys index
+    :return: None
+    """
+    with WORKER['lock']:
+        extracts = WORKER['extracts']
+        WORKER['extracts'] = []
+    for extract in extracts:
+        extract.close()
+
+
+def worker_extract():
+    """
+    The Extract instance of the current thread
+    :return: Extract
+    """
+    local = WORKER['local']
+    if not hasattr(local, 'extract'):
+        local.extract = Extract(**WORKER['options'])
+        with WORKER['lock']:
+            WORKER['extracts'].append(local.extract)
+    local.extract.writestats = WORKER['writestats']
+    return local.extract
+
+
+def extract_one(category, key, rawjson=None, retrieved_at_time=None):
+    """
+    Extract one key. Errors are logged and returned, so one broken item does not stop the
+    others.
+    :param category: 'location', 'user' or 'picture'
+    :param key: Location ID, username or shortcode
+    :param rawjson: Optional JSON as fetched, otherwise it is read from the file
+    :param retrieved_at_time: Retrieval time of rawjson as unix timestamp
+    :return: Tuple of key, status ('completed', 'missing' or 'failed') and error text
+    """
+    log = logging.getLogger(__name__)
+    details = getattr(worker_extract(), '{}_details'.format(category))
+    try:
+        details(key, rawjson, retrieved_at_time)
+        return key, 'completed', None
+    except FileNotFoundError:
+        log.info('%s: No JSON file to extract', key)
+        return key, 'missing', None
+    except Exception as error:  # pylint: disable=broad-except
+        log.exception('%s: Extraction failed', key)
+        return key, 'failed', repr(error)
+
+
+def extract_chunk(task):
+    """
+    Extract a chunk of keys on the thread pool of the worker. A process works on one chunk at
+    a time, so the write statistics are counted per chunk.
+    :param task: Tuple of category and list of keys
+    :return: Tuple of the results of extract_one in the order of the keys and the summary of
+    the write statistics
+    """
+    category, keys = task
+    WORKER['writestats'] = WriteStats()
+    results = list(WORKER['executor'].map(lambda key: extract_one(category, key), keys))
+    return results, WORKER['writestats'].summary()
+
+
+class ExtractPool():
+    """
+    ExtractPool extracts keys with a number of processes and threads. Progress is reported in
+    the order of the keys, failed keys are collected instead of aborting the run.
+    """
+    def __init__(self, options, processes=1, threads=1, chunk_size=50, writestats=None):
+        """
+        :param options: Keyword arguments for the Extract instances, e.g. awsprofile
+        :param processes: Number of processes, 1 extracts in this process
+        :param threads: Number of threads per process
+        :param chunk_size: Number of keys handed to a process at once
+        :param writestats: Optional WriteStats the writes of all workers are added to
+        """
+        self.log = logging.getLogger(__name__)
+        self.options = options
+        self.processes = processes
+        self.threads = threads
+        self.chunk_size = chunk_size
+        self.writestats = writestats
+
+    def run(self, category, keys, done=None):
+        """
+        Extract all keys of a category
+        :param category: 'location', 'user' or 'picture'
+        :param keys: List or lazy iterable of location IDs, usernames or shortcodes, at most
+        two chunks per process are read ahead
+        :param done: Optional function called per key with None or the error message
+        :return: Dictionary with the number of completed, missing and failed keys and a list
+        of (key, error) for the failed ones
+        """
+        total = len(keys) if hasattr(keys, '__len__') else '?'
+        window = threading.BoundedSemaphore(2 * max(self.processes, 1))
+        tasks = bounded(((category, chunk) for chunk in chunked(keys, self.chunk_size)), window)
+        stats = {'completed': 0, 'missing': 0, 'failed': 0, 'errors': []}
+        extracted = 0
+
+        if self.processes > 1:
+            pool = mp.Pool(self.processes, initializer=worker_init,
+                           initargs=(self.options, self.threads, True))
+            results = pool.imap(extract_chunk, tasks)
+        else:
+            pool = None
+            worker_init(self.options, self.threads)
+            results = map(extract_chunk, tasks)
+
+        try:
+            for chunk, writesummary in results:
+                window.release()
+                if self.writestats is not None:
+                    self.writestats.merge(writesummary)
+                for key, status, error in chunk:
+                    stats[status] += 1
+                    if error is not None:
+                        stats['errors'].append((key, error))
+                    if done is not None:
+                        done(key, None if status == 'completed' else error or status)
+                extracted += len(chunk)
+                self.log.info('[%s]/[%s]: %s extracted, %s missing, %s failed',
+                              extracted, total, stats['completed'], stats['missing'],
+                              stats['failed'])
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            else:
+                WORKER['executor'].shutdown()
+                worker_close()
+
+        return stats
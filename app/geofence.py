@@ -0,0 +1,212 @@
+"""
+The geofence module decides in which region a location lies. Regions are polygons from a
+GeoJSON file, so new countries need no code change. A grid over the bounding boxes of the
+polygons keeps the number of point-in-polygon tests per location small. Batches of locations
+are tested with NumPy, if it is installed.
+"""
+import json
+import logging
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def ring_contains(ring, lng, lat):
+    """
+    Even-odd ray casting test for one ring
+    :param ring: List of (lng, lat) tuples, closed or not
+    :param lng: Longitude of the point
+    :param lat: Latitude of the point
+    :return: True if the point lies within the ring
+    """
+    inside = False
+    previouslng, previouslat = ring[-1]
+    for pointlng, pointlat in ring:
+        if (pointlat > lat) != (previouslat > lat):
+            crossing = (previouslng - pointlng) * (lat - pointlat) / \
+                (previouslat - pointlat) + pointlng
+            if lng < crossing:
+                inside = not inside
+        previouslng, previouslat = pointlng, pointlat
+    return inside
+
+
+def ring_contains_many(ring, lngs, lats):
+    """
+    Even-odd ray casting test for one ring and many points
+    :param ring: List of (lng, lat) tuples, closed or not
+    :param lngs: numpy array of longitudes
+    :param lats: numpy array of latitudes
+    :return: numpy array of bools
+    """
+    inside = numpy.zeros(len(lngs), dtype=bool)
+    previouslng, previouslat = ring[-1]
+    for pointlng, pointlat in ring:
+        if pointlat != previouslat:
+            crosses = (pointlat > lats) != (previouslat > lats)
+            crossing = (previouslng - pointlng) * (lats - pointlat) / \
+                (previouslat - pointlat) + pointlng
+            inside ^= crosses & (lngs < crossing)
+        previouslng, previouslat = pointlng, pointlat
+    return inside
+
+
+class Region():
+    """
+    Region is a named area of one or more polygons, each with an outer ring and holes
+    """
+    def __init__(self, name, polygons):
+        """
+        :param name: Name of the region, e.g. 'switzerland'
+        :param polygons: List of polygons, each a list of rings of (lng, lat) tuples
+        """
+        self.name = name
+        self.polygons = polygons
+        points = [point for polygon in polygons for point in polygon[0]]
+        self.bbox = (min(point[0] for point in points), min(point[1] for point in points),
+                     max(point[0] for point in points), max(point[1] for point in points))
+
+    def contains(self, lng, lat):
+        """
+        Checks if a point lies within the region
+        :param lng: Longitude
+        :param lat: Latitude
+        :return: True if the point lies within one of the polygons and none of its holes
+        """
+        west, south, east, north = self.bbox
+        if not (west <= lng <= east and south <= lat <= north):
+            return False
+        for polygon in self.polygons:
+            if ring_contains(polygon[0], lng, lat) and \
+                    not any(ring_contains(hole, lng, lat) for hole in polygon[1:]):
+                return True
+        return False
+
+    def contains_many(self, lngs, lats):
+        """
+        Vectorized counterpart of contains
+        :param lngs: numpy array of longitudes
+        :param lats: numpy array of latitudes
+        :return: numpy array of bools
+        """
+        west, south, east, north = self.bbox
+        result = numpy.zeros(len(lngs), dtype=bool)
+        candidates = numpy.nonzero((lngs >= west) & (lngs <= east) &
+                                   (lats >= south) & (lats <= north))[0]
+        if len(candidates) == 0:
+            return result
+        for polygon in self.polygons:
+            inside = ring_contains_many(polygon[0], lngs[candidates], lats[candidates])
+            for hole in polygon[1:]:
+                inside &= ~ring_contains_many(hole, lngs[candidates], lats[candidates])
+            result[candidates] |= inside
+        return result
+
+
+def polygons_of(geometry):
+    """
+    The polygons of a GeoJSON geometry
+    :param geometry: GeoJSON geometry of type Polygon or MultiPolygon
+    :return: List of polygons, each a list of rings of (lng, lat) tuples
+    """
+    if geometry['type'] == 'Polygon':
+        polygons = [geometry['coordinates']]
+    elif geometry['type'] == 'MultiPolygon':
+        polygons = geometry['coordinates']
+    else:
+        raise ValueError('Unsupported geometry {}'.format(geometry['type']))
+    return [[[(float(point[0]), float(point[1])) for point in ring] for ring in polygon]
+            for polygon in polygons]
+
+
+class GeoFence():
+    """
+    GeoFence finds the region of a location. The first region of the file that contains a
+    point wins, so overlapping regions can be ordered by priority.
+    """
+    def __init__(self, regionsfile='./config/regions.geojson', cellsize=1.0):
+        """
+        :param regionsfile: GeoJSON FeatureCollection, every feature needs a 'name' property
+        :param cellsize: Size of the grid cells in degrees
+        """
+        self.log = logging.getLogger(__name__)
+        self.cellsize = cellsize
+        self.regions = []
+        self.grid = {}
+        with open(regionsfile, 'r') as file:
+            collection = json.load(file)
+        for feature in collection['features']:
+            self.add(Region(feature['properties']['name'], polygons_of(feature['geometry'])))
+        self.log.debug('%s regions loaded from %s', len(self.regions), regionsfile)
+
+    def cell(self, lng, lat):
+        """
+        Grid cell of a point
+        :param lng: Longitude
+        :param lat: Latitude
+        :return: Tuple of column and row
+        """
+        return math.floor(lng / self.cellsize), math.floor(lat / self.cellsize)
+
+    def add(self, region):
+        """
+        Add a region to the grid
+        :param region: Region
+        :return: None
+        """
+        number = len(self.regions)
+        self.regions.append(region)
+        west, south, east, north = region.bbox
+        firstcolumn, firstrow = self.cell(west, south)
+        lastcolumn, lastrow = self.cell(east, north)
+        for column in range(firstcolumn, lastcolumn + 1):
+            for row in range(firstrow, lastrow + 1):
+                self.grid.setdefault((column, row), []).append(number)
+
+    def locate(self, lat, lng):
+        """
+        Region of a location
+        :param lat: Latitude
+        :param lng: Longitude
+        :return: Name of the region, None if the location lies in none
+        """
+        lat = float(lat)
+        lng = float(lng)
+        for number in self.grid.get(self.cell(lng, lat), []):
+            if self.regions[number].contains(lng, lat):
+                return self.regions[number].name
+        return None
+
+    def locate_many(self, coordinates):
+        """
+        Regions of many locations
+        :param coordinates: List of (lat, lng) tuples
+        :return: List of region names or None, in the order of the coordinates
+        """
+        if numpy is None or len(coordinates) == 0:
+            return [self.locate(lat, lng) for lat, lng in coordinates]
+
+        lats = numpy.array([float(lat) for lat, _ in coordinates])
+        lngs = numpy.array([float(lng) for _, lng in coordinates])
+        columns = numpy.floor(lngs / self.cellsize).astype(int)
+        rows = numpy.floor(lats / self.cellsize).astype(int)
+
+        found = numpy.full(len(coordinates), -1)
+        # Test each region only against the points in its grid cells
+        candidates = {}
+        for index, cell in enumerate(zip(columns.tolist(), rows.tolist())):
+            for number in self.grid.get(cell, []):
+                candidates.setdefault(number, []).append(index)
+        for number in sorted(candidates):
+            indexes = numpy.array(candidates[number])
+            indexes = indexes[found[indexes] < 0]
+            if len(indexes) == 0:
+                continue
+            inside = self.regions[number].contains_many(lngs[indexes], lats[indexes])
+            found[indexes[inside]] = number
+
+        return [self.regions[number].name if number >= 0 else None
+                for number in found.tolist()]
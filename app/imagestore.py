@@ -0,0 +1,122 @@
+"""
+The imagestore module keeps a content-addressed index of the downloaded images. It maps the
+URL path of an image to the SHA-256 of its bytes and the hash to the S3 key, so images that
+were already stored are neither downloaded nor uploaded again.
+"""
+import logging
+import os
+import sqlite3
+import threading
+
+from urllib.parse import urlsplit
+
+
+def urlpath(imagelink):
+    """
+    The part of an image link that identifies the image. The query string holds signatures
+    that change between crawls and is ignored.
+    :param imagelink: Image link, e.g. the display_url of a post
+    :return: Path of the link
+    """
+    return urlsplit(imagelink).path
+
+
+class ImageStore():
+    """
+    ImageStore is a SQLite index of URL path -> content hash -> S3 key
+    """
+    def __init__(self, indexfile='./tmp/imagestore.sqlite'):
+        """
+        :param indexfile: SQLite file of the index
+        """
+        self.log = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.indexfile = indexfile
+        self.connection = None
+        self.pid = None
+        self.skipped_downloads = 0
+        self.skipped_uploads = 0
+
+    def connect(self):
+        """
+        Returns the connection of this process. A connection inherited from the parent process
+        is not reused, so the index works with a process pool.
+        :return: sqlite3.Connection
+        """
+        if self.connection is None or self.pid != os.getpid():
+            directory = os.path.dirname(self.indexfile)
+            if directory != '' and not os.path.exists(directory):
+                os.makedirs(directory)
+            self.connection = sqlite3.connect(self.indexfile, timeout=60,
+                                              check_same_thread=False)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS urls ('
+                                    'path TEXT PRIMARY KEY, hash TEXT NOT NULL, pictureid TEXT)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS blobs ('
+                                    'hash TEXT PRIMARY KEY, s3key TEXT NOT NULL, '
+                                    'size INTEGER NOT NULL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS urls_pictureid '
+                                    'ON urls (pictureid)')
+            self.connection.commit()
+            self.pid = os.getpid()
+        return self.connection
+
+    def lookup_url(self, path):
+        """
+        S3 key of an image by its URL path
+        :param path: URL path as returned by urlpath
+        :return: S3 key, None if the image is unknown
+        """
+        with self.lock:
+            row = self.connect().execute('SELECT blobs.s3key FROM urls '
+                                         'JOIN blobs ON urls.hash = blobs.hash '
+                                         'WHERE urls.path = ?', (path,)).fetchone()
+            if row is None:
+                return None
+            self.skipped_downloads += 1
+            return row[0]
+
+    def lookup_hash(self, digest):
+        """
+        S3 key of an image by its content hash
+        :param digest: Hex SHA-256 of the image bytes
+        :return: S3 key, None if no image with these bytes was stored
+        """
+        with self.lock:
+            row = self.connect().execute('SELECT s3key FROM blobs WHERE hash = ?',
+                                         (digest,)).fetchone()
+            if row is None:
+                return None
+            self.skipped_uploads += 1
+            return row[0]
+
+    def lookup_picture(self, pictureid):
+        """
+        S3 key of the image of a picture
+        :param pictureid: The picture ID (shortcode)
+        :return: S3 key, None if no image was stored for the picture
+        """
+        with self.lock:
+            row = self.connect().execute('SELECT blobs.s3key FROM urls '
+                                         'JOIN blobs ON urls.hash = blobs.hash '
+                                         'WHERE urls.pictureid = ?', (pictureid,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def add(self, path, digest, s3key, size, pictureid):
+        """
+        Record a stored image. Must be called after the upload succeeded.
+        :param path: URL path as returned by urlpath
+        :param digest: Hex SHA-256 of the image bytes
+        :param s3key: S3 key the bytes are stored under
+        :param size: Size of the image in bytes
+        :param pictureid: The picture ID the image was downloaded for
+        :return: None
+        """
+        with self.lock:
+            connection = self.connect()
+            connection.execute('INSERT OR IGNORE INTO blobs (hash, s3key, size) VALUES (?, ?, ?)',
+                               (digest, s3key, size))
+            connection.execute('INSERT OR REPLACE INTO urls (path, hash, pictureid) '
+                               'VALUES (?, ?, ?)', (path, digest, pictureid))
+            connection.commit()
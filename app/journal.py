@@ -0,0 +1,292 @@
+"""
+The journal module keeps the state of the runs of run.py in an embedded SQLite database, so an
+interrupted run can be resumed where it stopped. A run has one phase per step, 'discovered'
+for the retrieval and 'retrieved' for the extraction. For each phase the journal records the
+scan position of every segment and the state of every scanned item: pending, dispatched,
+completed or failed.
+
+The items of a page are recorded in the same transaction as the scan position after the page.
+A resumed run first dispatches the items that never completed and then continues the scan.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from .search import keydefault
+
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS runs ('
+    'id INTEGER PRIMARY KEY AUTOINCREMENT, category TEXT NOT NULL, '
+    'started_at INTEGER NOT NULL, finished_at INTEGER)',
+    'CREATE TABLE IF NOT EXISTS phases ('
+    'run INTEGER NOT NULL, phase TEXT NOT NULL, finished_at INTEGER, '
+    'PRIMARY KEY (run, phase)) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS cursors ('
+    'run INTEGER NOT NULL, phase TEXT NOT NULL, segment INTEGER NOT NULL, '
+    'segments INTEGER NOT NULL, lastkey TEXT NOT NULL, '
+    'PRIMARY KEY (run, phase, segment, segments)) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS items ('
+    'run INTEGER NOT NULL, phase TEXT NOT NULL, key TEXT NOT NULL, state TEXT NOT NULL, '
+    'error TEXT, updated_at INTEGER NOT NULL, '
+    'PRIMARY KEY (run, phase, key)) WITHOUT ROWID'
+]
+
+
+class JournalCheckpoint():
+    """
+    JournalCheckpoint is the scan checkpoint of one phase of a run, see Search.scan_pages
+    """
+    def __init__(self, journal, phase, keyname):
+        """
+        :param journal: JobJournal
+        :param phase: 'discovered' or 'retrieved'
+        :param keyname: Key attribute of the scanned items, e.g. 'id'
+        """
+        self.journal = journal
+        self.phase = phase
+        self.keyname = keyname
+
+    def read(self, segment, segments):
+        """
+        :param segment: Number of the segment
+        :param segments: Total number of segments
+        :return: LastEvaluatedKey, {} for a completed segment, None for a new one
+        """
+        return self.journal.readcursor(self.phase, segment, segments)
+
+    def save(self, segment, segments, lastkey, items):
+        """
+        Save the position after a page together with the items of the page
+        :param segment: Number of the segment
+        :param segments: Total number of segments
+        :param lastkey: LastEvaluatedKey of the page, {} at the end of the segment
+        :param items: Items of the page
+        :return: None
+        """
+        self.journal.savecursor(self.phase, segment, segments, lastkey,
+                                [str(item[self.keyname]) for item in items])
+
+    def clear(self, segments):
+        """
+        The positions stay in the journal, the phase is finished by the runner
+        :param segments: Total number of segments
+        :return: None
+        """
+
+
+class JobJournal():
+    """
+    JobJournal is the state of the runs of one category. Dispatching and completing items can
+    happen from different threads, the connection is shared under a lock.
+    """
+    def __init__(self, path='./tmp/jobs.sqlite'):
+        """
+        :param path: Path of the SQLite database
+        """
+        self.log = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.path = path
+        self.connection = None
+        self.pid = None
+        self.run = None
+        directory = os.path.dirname(path)
+        if directory != '' and not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def connect(self):
+        """
+        Returns the SQLite connection of this process
+        :return: sqlite3.Connection
+        """
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+            self.connection.commit()
+            self.pid = os.getpid()
+        return self.connection
+
+    def start(self, category, resume=False):
+        """
+        Start a new run or resume the last unfinished run of a category
+        :param category: 'location', 'user' or 'picture'
+        :param resume: Resume the last unfinished run if there is one
+        :return: Run number
+        """
+        with self.lock:
+            connection = self.connect()
+            if resume:
+                row = connection.execute(
+                    'SELECT id FROM runs WHERE category = ? AND finished_at IS NULL '
+                    'ORDER BY id DESC LIMIT 1', (category,)).fetchone()
+                if row is not None:
+                    self.run = row[0]
+                    self.log.info('Resuming run #%s of %s', self.run, category)
+                    return self.run
+                self.log.info('No unfinished run of %s to resume', category)
+            cursor = connection.execute('INSERT INTO runs (category, started_at) VALUES (?, ?)',
+                                        (category, int(time.time())))
+            connection.commit()
+            self.run = cursor.lastrowid
+            self.log.info('Starting run #%s of %s', self.run, category)
+            return self.run
+
+    def finish(self):
+        """
+        Mark the run as finished, a finished run is not resumed
+        :return: None
+        """
+        with self.lock:
+            connection = self.connect()
+            connection.execute('UPDATE runs SET finished_at = ? WHERE id = ?',
+                               (int(time.time()), self.run))
+            connection.commit()
+
+    def checkpoint(self, phase, keyname):
+        """
+        Scan checkpoint of a phase
+        :param phase: 'discovered' or 'retrieved'
+        :param keyname: Key attribute of the scanned items, e.g. 'id'
+        :return: JournalCheckpoint
+        """
+        return JournalCheckpoint(self, phase, keyname)
+
+    def readcursor(self, phase, segment, segments):
+        """
+        Scan position of a segment
+        :param phase: 'discovered' or 'retrieved'
+        :param segment: Number of the segment
+        :param segments: Total number of segments
+        :return: LastEvaluatedKey, {} for a completed segment, None for a new one
+        """
+        with self.lock:
+            row = self.connect().execute(
+                'SELECT lastkey FROM cursors WHERE run = ? AND phase = ? AND segment = ? '
+                'AND segments = ?', (self.run, phase, segment, segments)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def savecursor(self, phase, segment, segments, lastkey, keys):
+        """
+        Save the scan position after a page and record its items as pending
+        :param phase: 'discovered' or 'retrieved'
+        :param segment: Number of the segment
+        :param segments: Total number of segments
+        :param lastkey: LastEvaluatedKey of the page, {} at the end of the segment
+        :param keys: Keys of the items of the page as strings
+        :return: None
+        """
+        now = int(time.time())
+        with self.lock:
+            connection = self.connect()
+            connection.execute(
+                'INSERT OR REPLACE INTO cursors (run, phase, segment, segments, lastkey) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (self.run, phase, segment, segments, json.dumps(lastkey, default=keydefault)))
+            connection.executemany(
+                'INSERT OR IGNORE INTO items (run, phase, key, state, updated_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(self.run, phase, key, 'pending', now) for key in keys])
+            connection.commit()
+
+    def unfinished(self, phase):
+        """
+        Keys of a phase that were scanned or dispatched but never completed, e.g. because
+        the run was interrupted
+        :param phase: 'discovered' or 'retrieved'
+        :return: List of keys as strings
+        """
+        with self.lock:
+            rows = self.connect().execute(
+                'SELECT key FROM items WHERE run = ? AND phase = ? '
+                'AND state IN (\'pending\', \'dispatched\')', (self.run, phase)).fetchall()
+        return [key for (key,) in rows]
+
+    def count(self, phase):
+        """
+        Number of items of a phase in the journal
+        :param phase: 'discovered' or 'retrieved'
+        :return: Number of items
+        """
+        with self.lock:
+            row = self.connect().execute(
+                'SELECT COUNT(*) FROM items WHERE run = ? AND phase = ?',
+                (self.run, phase)).fetchone()
+        return row[0]
+
+    def dispatch(self, phase, key, resumed=False):
+        """
+        Mark a pending item as dispatched to a worker
+        :param phase: 'discovered' or 'retrieved'
+        :param key: Key of the item
+        :param resumed: Also dispatch an item that was dispatched before, in a resumed run
+        :return: False if the item was already dispatched, completed or failed
+        """
+        states = '(\'pending\', \'dispatched\')' if resumed else '(\'pending\')'
+        with self.lock:
+            connection = self.connect()
+            cursor = connection.execute(
+                'UPDATE items SET state = \'dispatched\', updated_at = ? '
+                'WHERE run = ? AND phase = ? AND key = ? AND state IN ' + states,
+                (int(time.time()), self.run, phase, str(key)))
+            connection.commit()
+        return cursor.rowcount == 1
+
+    def done(self, phase, key, error=None):
+        """
+        Mark an item as completed or failed
+        :param phase: 'discovered' or 'retrieved'
+        :param key: Key of the item
+        :param error: Error message of a failed item, None for a completed one
+        :return: None
+        """
+        with self.lock:
+            connection = self.connect()
+            connection.execute(
+                'UPDATE items SET state = ?, error = ?, updated_at = ? '
+                'WHERE run = ? AND phase = ? AND key = ?',
+                ('completed' if error is None else 'failed', error, int(time.time()),
+                 self.run, phase, str(key)))
+            connection.commit()
+
+    def phase_finished(self, phase):
+        """
+        :param phase: 'discovered' or 'retrieved'
+        :return: True if the phase of the run was finished
+        """
+        with self.lock:
+            row = self.connect().execute(
+                'SELECT finished_at FROM phases WHERE run = ? AND phase = ?',
+                (self.run, phase)).fetchone()
+        return row is not None and row[0] is not None
+
+    def finish_phase(self, phase):
+        """
+        Mark a phase as finished, a resumed run skips it
+        :param phase: 'discovered' or 'retrieved'
+        :return: None
+        """
+        with self.lock:
+            connection = self.connect()
+            connection.execute('INSERT OR REPLACE INTO phases (run, phase, finished_at) '
+                               'VALUES (?, ?, ?)', (self.run, phase, int(time.time())))
+            connection.commit()
+
+    def summary(self, phase):
+        """
+        Summary for logging
+        :param phase: 'discovered' or 'retrieved'
+        :return: Dictionary of state -> number of items
+        """
+        with self.lock:
+            rows = self.connect().execute(
+                'SELECT state, COUNT(*) FROM items WHERE run = ? AND phase = ? GROUP BY state',
+                (self.run, phase)).fetchall()
+        summary = {'pending': 0, 'dispatched': 0, 'completed': 0, 'failed': 0}
+        summary.update(rows)
+        return summary
@@ -0,0 +1,123 @@
+"""
+The jsondecode module decodes the stored JSONs with the fastest available backend. orjson and
+simdjson are optional, the standard library json module is the fallback. Extraction only
+needs the GraphQL data of a page, so it can also be decoded on its own.
+"""
+import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+
+BACKENDS = {
+    'json': json.loads
+}
+if orjson is not None:
+    BACKENDS['orjson'] = orjson.loads
+if simdjson is not None:
+    BACKENDS['simdjson'] = simdjson.loads
+
+# Backends in the order they are preferred by 'auto'
+PREFERENCE = ['orjson', 'simdjson', 'json']
+
+ENTRY_DATA = b'"entry_data"'
+GRAPHQL = b'"graphql"'
+WHITESPACE = b' \t\n\r'
+
+# Strings as a whole, so brackets inside them are skipped, and the brackets outside of them
+TOKENS = re.compile(rb'"(?:[^"\\]|\\.)*"|[{}\[\]]', re.DOTALL)
+
+
+def getloads(backend='auto'):
+    """
+    The loads function of a backend
+    :param backend: 'auto', 'orjson', 'simdjson' or 'json'
+    :return: Function that decodes bytes or a string
+    """
+    if backend == 'auto':
+        for name in PREFERENCE:
+            if name in BACKENDS:
+                return BACKENDS[name]
+    if backend not in BACKENDS:
+        raise ImportError('The JSON backend {} is not installed: pip install {}'.format(
+            backend, 'pysimdjson' if backend == 'simdjson' else backend))
+    return BACKENDS[backend]
+
+
+def valueend(rawjson, start):
+    """
+    End of the JSON object or array that starts at a position. Only strings and brackets are
+    looked at, the content is checked when the slice is decoded.
+    :param rawjson: JSON as bytes
+    :param start: Position of the opening bracket
+    :return: Position after the closing bracket, -1 if the value is not closed
+    """
+    depth = 0
+    for token in TOKENS.finditer(rawjson, start):
+        char = token.group()[:1]
+        if char in b'{[':
+            depth += 1
+        elif char in b'}]':
+            depth -= 1
+            if depth == 0:
+                return token.end()
+    return -1
+
+
+def graphqlslice(rawjson, loads=json.loads):
+    """
+    Decode only the 'graphql' object of the first page in entry_data. The position and the end
+    of the object are found on the bytes, only this slice is decoded by the backend. A key
+    inside a JSON string has escaped quotes, so the search can only match a real key.
+    :param rawjson: The shared data as bytes
+    :param loads: Function to decode the slice, see getloads
+    :return: The graphql object, None if it could not be found
+    """
+    if isinstance(rawjson, str):
+        rawjson = rawjson.encode('utf-8')
+    start = rawjson.find(ENTRY_DATA)
+    if start < 0:
+        return None
+    start = rawjson.find(GRAPHQL, start)
+    if start < 0:
+        return None
+    start = rawjson.find(b':', start + len(GRAPHQL))
+    if start < 0:
+        return None
+    start += 1
+    while start < len(rawjson) and rawjson[start] in WHITESPACE:
+        start += 1
+    if rawjson[start:start + 1] not in (b'{', b'['):
+        return None
+    end = valueend(rawjson, start)
+    if end < 0:
+        return None
+    try:
+        return loads(rawjson[start:end])
+    except ValueError:
+        return None
+
+
+def graphqldata(rawjson, page, entity, loads=json.loads, subtree=False):
+    """
+    The GraphQL data of a stored page, e.g. entry_data.PostPage[0].graphql.shortcode_media
+    :param rawjson: The shared data as bytes or string
+    :param page: Page type, e.g. 'PostPage'
+    :param entity: Entity in the GraphQL data, e.g. 'shortcode_media'
+    :param loads: Function to decode the JSON or its GraphQL object, see getloads
+    :param subtree: Decode only the GraphQL object, default is False
+    :return: Dictionary of the entity
+    """
+    if subtree is True:
+        graphql = graphqlslice(rawjson, loads)
+        if isinstance(graphql, dict) and entity in graphql:
+            return graphql[entity]
+    return loads(rawjson)['entry_data'][page][0]['graphql'][entity]
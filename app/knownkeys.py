@@ -0,0 +1,351 @@
+"""
+The knownkeys module keeps a local index of the keys that already exist in DynamoDB, so
+Extract can skip known shortcodes, usernames and location ids without a network round trip.
+A scalable Bloom filter answers most lookups from memory, an exact key set in SQLite confirms
+the positive answers.
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import math
+import os
+import sqlite3
+import struct
+import threading
+import time
+
+
+class BloomFilter():
+    """
+    Bloom filter with double hashing over a BLAKE2 digest
+    """
+    def __init__(self, capacity, error_rate):
+        """
+        :param capacity: Number of keys the filter is sized for
+        :param error_rate: False positive rate at capacity
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, key):
+        """
+        Bit positions of a key
+        :param key: Key as string
+        :return: Generator of bit positions
+        """
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first, second = struct.unpack('<QQ', digest)
+        for number in range(self.hashes):
+            yield (first + number * second) % self.size
+
+    def add(self, key):
+        """
+        Add a key
+        :param key: Key as string
+        :return: None
+        """
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        for position in self.positions(key):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def merge(self, other):
+        """
+        Add the keys of a saved copy of this filter, which other indexes may have extended
+        :param other: BloomFilter with the same parameters
+        :return: None
+        """
+        if (other.capacity, other.error_rate) != (self.capacity, self.error_rate):
+            raise ValueError('Bloom filters with different parameters can not be merged')
+        bits = int.from_bytes(self.bits, 'little') | int.from_bytes(other.bits, 'little')
+        self.bits = bytearray(bits.to_bytes(len(self.bits), 'little'))
+        # Both may hold the same keys, the number of keys is estimated from the set bits
+        setbits = bin(bits).count('1')
+        if setbits < self.size:
+            self.count = max(self.count, other.count, int(round(
+                -self.size / self.hashes * math.log(1 - setbits / self.size))))
+        else:
+            self.count = self.capacity
+
+
+class ScalableBloomFilter():
+    """
+    Bloom filter that adds a larger filter with a tighter error rate whenever the current one
+    is full, so the overall false positive rate stays below the configured one
+    """
+    def __init__(self, capacity=1000000, error_rate=0.001, growth=2, tightening=0.5):
+        """
+        :param capacity: Capacity of the first filter
+        :param error_rate: Overall false positive rate
+        :param growth: Factor by which every further filter is larger
+        :param tightening: Factor by which every further filter has a lower error rate
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.growth = growth
+        self.tightening = tightening
+        self.filters = []
+
+    def add(self, key):
+        """
+        Add a key
+        :param key: Key as string
+        :return: None
+        """
+        if len(self.filters) == 0 or self.filters[-1].count >= self.filters[-1].capacity:
+            number = len(self.filters)
+            # The error rates form a geometric series that sums up to error_rate
+            self.filters.append(BloomFilter(
+                self.capacity * self.growth ** number,
+                self.error_rate * (1 - self.tightening) * self.tightening ** number))
+        self.filters[-1].add(key)
+
+    def __contains__(self, key):
+        for bloomfilter in self.filters:
+            if key in bloomfilter:
+                return True
+        return False
+
+    def merge(self, other):
+        """
+        Add the keys of a saved copy of this filter, which other indexes may have extended
+        :param other: ScalableBloomFilter with the same parameters
+        :return: None
+        """
+        if (other.capacity, other.error_rate, other.growth, other.tightening) != \
+                (self.capacity, self.error_rate, self.growth, self.tightening):
+            raise ValueError('Bloom filters with different parameters can not be merged')
+        for number, bloomfilter in enumerate(other.filters):
+            if number < len(self.filters):
+                self.filters[number].merge(bloomfilter)
+            else:
+                self.filters.append(bloomfilter)
+
+    def save(self, path):
+        """
+        Write the filter to a file: one JSON line with the parameters, then the bits
+        :param path: File path
+        :return: None
+        """
+        header = {
+            'capacity': self.capacity,
+            'error_rate': self.error_rate,
+            'growth': self.growth,
+            'tightening': self.tightening,
+            'filters': [{'capacity': bloomfilter.capacity,
+                         'error_rate': bloomfilter.error_rate,
+                         'count': bloomfilter.count} for bloomfilter in self.filters]
+        }
+        # Several indexes of the same directory can save at once, also from one process
+        tmppath = '{}.{}.{}'.format(path, os.getpid(), threading.get_ident())
+        with open(tmppath, 'wb') as file:
+            file.write(json.dumps(header).encode('utf-8') + b'\n')
+            for bloomfilter in self.filters:
+                file.write(bloomfilter.bits)
+        os.replace(tmppath, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a filter written by save
+        :param path: File path
+        :return: ScalableBloomFilter
+        """
+        with open(path, 'rb') as file:
+            header = json.loads(file.readline().decode('utf-8'))
+            scalable = cls(header['capacity'], header['error_rate'], header['growth'],
+                           header['tightening'])
+            for parameters in header['filters']:
+                bloomfilter = BloomFilter(parameters['capacity'], parameters['error_rate'])
+                bloomfilter.bits = bytearray(file.read(len(bloomfilter.bits)))
+                bloomfilter.count = parameters['count']
+                scalable.filters.append(bloomfilter)
+        return scalable
+
+
+class KnownKeys():
+    """
+    KnownKeys is the membership index per table. With exact, every positive answer of the
+    Bloom filter is confirmed in the SQLite key set, so a new key is never skipped. Without
+    exact, new keys are skipped with the false positive rate of the filter, but no disk access
+    is needed.
+    """
+    def __init__(self,
+                 directory='./tmp/knownkeys',
+                 capacity=1000000,
+                 error_rate=0.001,
+                 exact=True,
+                 save_interval=300):
+        """
+        :param directory: Directory of the key set and the Bloom filters
+        :param capacity: Capacity of the first Bloom filter per table
+        :param error_rate: False positive rate of the Bloom filters
+        :param exact: Confirm positive answers in the exact key set, default is True
+        :param save_interval: Seconds after which added keys are written to the Bloom filter
+        files, so workers that are never closed do not lose them
+        """
+        self.log = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.directory = directory
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.exact = exact
+        self.filters = {}
+        self.connection = None
+        self.pid = None
+        self.skipped = 0
+        self.save_interval = save_interval
+        self.savedat = time.time()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def connect(self):
+        """
+        Returns the SQLite connection of this process
+        :return: sqlite3.Connection
+        """
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(os.path.join(self.directory, 'keys.sqlite'),
+                                              timeout=60, check_same_thread=False)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS keys ('
+                                    'tablename TEXT NOT NULL, key TEXT NOT NULL, '
+                                    'PRIMARY KEY (tablename, key)) WITHOUT ROWID')
+            self.connection.commit()
+            self.pid = os.getpid()
+        return self.connection
+
+    def filterpath(self, tablename):
+        """
+        Path of the Bloom filter of a table
+        :param tablename: DynamoDB table name
+        :return: File path
+        """
+        return os.path.join(self.directory, '{}.bloom'.format(tablename))
+
+    def bloomfilter(self, tablename):
+        """
+        The Bloom filter of a table. It is loaded from disk or rebuilt from the exact key set.
+        Must be called with the lock held.
+        :param tablename: DynamoDB table name
+        :return: ScalableBloomFilter
+        """
+        if tablename not in self.filters:
+            try:
+                self.filters[tablename] = ScalableBloomFilter.load(self.filterpath(tablename))
+            except (FileNotFoundError, ValueError):
+                bloomfilter = ScalableBloomFilter(self.capacity, self.error_rate)
+                rows = self.connect().execute('SELECT key FROM keys WHERE tablename = ?',
+                                              (tablename,))
+                for (key,) in rows:
+                    bloomfilter.add(key)
+                self.filters[tablename] = bloomfilter
+        return self.filters[tablename]
+
+    def unknown(self, tablename, keys):
+        """
+        Filter out the keys that are known to exist
+        :param tablename: DynamoDB table name
+        :param keys: List of key values
+        :return: List of the key values that may not exist yet
+        """
+        with self.lock:
+            bloomfilter = self.bloomfilter(tablename)
+            candidates = [key for key in keys if str(key) in bloomfilter]
+            known = set(str(key) for key in candidates)
+            if self.exact is True and len(candidates) > 0:
+                known = set()
+                connection = self.connect()
+                for start in range(0, len(candidates), 500):
+                    chunk = [str(key) for key in candidates[start:start + 500]]
+                    rows = connection.execute(
+                        'SELECT key FROM keys WHERE tablename = ? AND key IN ({})'.format(
+                            ', '.join('?' * len(chunk))), [tablename] + chunk)
+                    known.update(key for (key,) in rows)
+
+            unknown = [key for key in keys if str(key) not in known]
+            self.skipped += len(keys) - len(unknown)
+            return unknown
+
+    def add(self, tablename, keys):
+        """
+        Record keys that exist in DynamoDB
+        :param tablename: DynamoDB table name
+        :param keys: Iterable of key values
+        :return: None
+        """
+        keys = [str(key) for key in keys]
+        if len(keys) == 0:
+            return
+        with self.lock:
+            bloomfilter = self.bloomfilter(tablename)
+            for key in keys:
+                if key not in bloomfilter:
+                    bloomfilter.add(key)
+            connection = self.connect()
+            connection.executemany('INSERT OR IGNORE INTO keys (tablename, key) VALUES (?, ?)',
+                                   [(tablename, key) for key in keys])
+            connection.commit()
+            if time.time() - self.savedat >= self.save_interval:
+                self.savefilters()
+
+    def warm(self, table, keyname):
+        """
+        Load all keys of a table with a projection scan
+        :param table: DynamoDB table resource
+        :param keyname: Name of the key attribute
+        :return: Number of keys loaded
+        """
+        total = 0
+        scanargs = {
+            'ProjectionExpression': '#k',
+            'ExpressionAttributeNames': {'#k': keyname}
+        }
+        while True:
+            response = table.scan(**scanargs)
+            self.add(table.name, [item[keyname] for item in response['Items']])
+            total += response['Count']
+            self.log.info('%s: %s keys loaded', table.name, total)
+            if 'LastEvaluatedKey' not in response:
+                break
+            scanargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        self.save()
+        return total
+
+    def save(self):
+        """
+        Write the Bloom filters to disk
+        :return: None
+        """
+        with self.lock:
+            self.savefilters()
+
+    def savefilters(self):
+        """
+        Write the Bloom filters to disk. Other indexes of the directory, e.g. of other workers,
+        save the same files, so the saved filter is merged in under a file lock before it is
+        replaced. Must be called with the lock held.
+        :return: None
+        """
+        for tablename, bloomfilter in self.filters.items():
+            path = self.filterpath(tablename)
+            with open(path + '.lock', 'a') as lockfile:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+                try:
+                    bloomfilter.merge(ScalableBloomFilter.load(path))
+                except FileNotFoundError:
+                    pass
+                except ValueError:
+                    self.log.warning('%s: Saved Bloom filter does not match, it is replaced',
+                                     tablename)
+                bloomfilter.save(path)
+        self.savedat = time.time()
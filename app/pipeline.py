@@ -0,0 +1,91 @@
+"""
+The pipeline module hands every newly fetched JSON straight from Retrieve to the extraction,
+without writing it to disk and reading it back, and without scanning DynamoDB for retrieved
+items. Archiving the JSON continues on the archive thread pool of Retrieve.
+"""
+import logging
+import queue
+import threading
+
+from .dbwrite import WriteStats
+from .extractpool import WORKER, extract_one, worker_close, worker_init
+
+
+class Pipeline():
+    """
+    Pipeline extracts fetched JSONs on a number of threads. The queue between retrieval and
+    extraction is bounded: when extraction falls behind, put blocks the storage threads of the
+    retrieval, which in turn stops new requests.
+    """
+    def __init__(self, options, threads=4, queue_size=100, writestats=None):
+        """
+        :param options: Keyword arguments for the Extract instances, e.g. awsprofile
+        :param threads: Number of extraction threads
+        :param queue_size: Maximum number of JSONs waiting for extraction
+        :param writestats: Optional WriteStats the writes of the extraction are added to
+        """
+        self.log = logging.getLogger(__name__)
+        self.options = options
+        self.threads = threads
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.writestats = writestats
+        self.lock = threading.Lock()
+        self.workers = []
+        self.stats = {'completed': 0, 'missing': 0, 'failed': 0, 'errors': []}
+
+    def start(self):
+        """
+        Start the extraction threads
+        :return: None
+        """
+        worker_init(self.options, 1)
+        WORKER['executor'].shutdown()
+        for _ in range(self.threads):
+            worker = threading.Thread(target=self.consume, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def put(self, category, key, rawjson, retrieved_at_time):
+        """
+        Queue a fetched JSON for extraction, blocks while the queue is full
+        :param category: 'location', 'user' or 'picture'
+        :param key: Location ID, username or shortcode
+        :param rawjson: The fetched JSON as bytes
+        :param retrieved_at_time: Retrieval time as unix timestamp
+        :return: None
+        """
+        self.queue.put((category, key, rawjson, retrieved_at_time))
+
+    def consume(self):
+        """
+        Extract queued JSONs until a None is received
+        :return: None
+        """
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                self.queue.task_done()
+                break
+            key, status, error = extract_one(*entry)
+            with self.lock:
+                self.stats[status] += 1
+                if error is not None:
+                    self.stats['errors'].append((key, error))
+            self.queue.task_done()
+
+    def close(self):
+        """
+        Extract the remaining JSONs and stop the threads
+        :return: Dictionary with the number of completed, missing and failed keys and a list
+        of (key, error) for the failed ones
+        """
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        worker_close()
+        if self.writestats is not None:
+            self.writestats.merge(WORKER['writestats'].summary())
+            WORKER['writestats'] = WriteStats()
+        return self.stats
@@ -0,0 +1,324 @@
+"""
+The proxypool module keeps health scores for the proxies and routes requests to the fastest
+healthy ones. Failing proxies are put into a cooldown and probed again afterwards.
+"""
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from collections import deque
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class ProxyStats():
+    """
+    Health statistics and circuit breaker state of a single proxy
+    """
+    def __init__(self, latency_window=100):
+        self.successes = 0
+        self.failures = 0
+        self.toomanyrequests = 0
+        self.proxyerrors = 0
+        self.timeouts = 0
+        self.consecutive_failures = 0
+        self.latencies = deque(maxlen=latency_window)
+        self.state = CLOSED
+        self.open_until = 0
+        self.cooldown = 0
+        self.probing = False
+        self.probe_started = 0
+
+    def success_rate(self):
+        """
+        Success rate with one virtual success and failure, so new proxies start at 0.5
+        :return: Success rate between 0 and 1
+        """
+        return (self.successes + 1) / (self.successes + self.failures + 2)
+
+    def latency_percentile(self, percentile):
+        """
+        Latency percentile over the latency window
+        :param percentile: Percentile between 0 and 100, e.g. 50 for the median
+        :return: Latency in seconds, None if no latency was recorded yet
+        """
+        if len(self.latencies) == 0:
+            return None
+        latencies = sorted(self.latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+        return latencies[index]
+
+    def score(self):
+        """
+        Expected time per successful request, lower is better. Proxies without latency samples
+        get an optimistic latency so they are tried early.
+        :return: Score in seconds
+        """
+        latency = self.latency_percentile(50)
+        if latency is None:
+            latency = 0.5
+        return latency / self.success_rate()
+
+    def to_dict(self):
+        """
+        Serialise the statistics for persisting
+        :return: Dictionary
+        """
+        return {
+            'successes': self.successes,
+            'failures': self.failures,
+            'toomanyrequests': self.toomanyrequests,
+            'proxyerrors': self.proxyerrors,
+            'timeouts': self.timeouts,
+            'consecutive_failures': self.consecutive_failures,
+            'latencies': list(self.latencies),
+            'state': self.state,
+            'open_until': self.open_until,
+            'cooldown': self.cooldown
+        }
+
+    def from_dict(self, stats):
+        """
+        Restore the statistics from a persisted dictionary
+        :param stats: Dictionary as returned by to_dict
+        :return: None
+        """
+        self.successes = stats['successes']
+        self.failures = stats['failures']
+        self.toomanyrequests = stats['toomanyrequests']
+        self.proxyerrors = stats['proxyerrors']
+        self.timeouts = stats['timeouts']
+        self.consecutive_failures = stats['consecutive_failures']
+        self.latencies.extend(stats['latencies'])
+        self.state = stats['state']
+        self.open_until = stats['open_until']
+        self.cooldown = stats['cooldown']
+
+
+class ProxyPool():
+    """
+    ProxyPool chooses a (proxy, user agent) tuple for each request and records the outcome.
+    Proxies are closed (healthy), open (in cooldown) or half open (one probe request allowed).
+    """
+    def __init__(self,
+                 proxies,
+                 statefile='./tmp/proxypool.json',
+                 failure_threshold=3,
+                 cooldown=60,
+                 max_cooldown=3600,
+                 latency_window=100,
+                 save_interval=60,
+                 probe_timeout=120):
+        """
+        :param proxies: List of (proxy, user agent) tuples as returned by proxies_file
+        :param statefile: JSON file where the scores are persisted, None to disable
+        :param failure_threshold: Consecutive failures after which a proxy goes into cooldown
+        :param cooldown: First cooldown in seconds, doubled on every failed probe
+        :param max_cooldown: Upper limit for the cooldown in seconds
+        :param latency_window: Number of latencies kept per proxy for the percentiles
+        :param save_interval: Seconds between automatic saves of the scores
+        :param probe_timeout: Seconds after which an unanswered probe is given up
+        """
+        self.log = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.proxies = proxies
+        self.useragents = dict(proxies)
+        self.statefile = statefile
+        self.failure_threshold = failure_threshold
+        self.initial_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.save_interval = save_interval
+        self.probe_timeout = probe_timeout
+        self.last_save = time.time()
+        self.stats = {}
+        for proxy, _ in proxies:
+            self.stats[proxy] = ProxyStats(latency_window)
+        self.load()
+
+    def available(self, now):
+        """
+        Proxies that may receive a request now. Open proxies whose cooldown is over become half
+        open and are available for a single probe. A probe whose outcome was never reported is
+        given up after the probe timeout.
+        :param now: Current time
+        :return: List of proxies
+        """
+        available = []
+        for proxy, stats in self.stats.items():
+            if stats.state == OPEN and now >= stats.open_until:
+                stats.state = HALF_OPEN
+                stats.probing = False
+            if stats.probing and now - stats.probe_started > self.probe_timeout:
+                stats.probing = False
+            if stats.state == CLOSED or (stats.state == HALF_OPEN and not stats.probing):
+                available.append(proxy)
+        return available
+
+    def choose(self):
+        """
+        Choose a proxy with the power of two choices: two random healthy proxies are compared
+        and the one with the better score wins. This favours fast proxies without sending all
+        requests to a single one.
+        :return: Tuple of proxy and user agent
+        """
+        with self.lock:
+            now = time.time()
+            available = self.available(now)
+
+            if len(available) == 0:
+                # All proxies are in cooldown, probe the one that becomes available first
+                proxy = min(self.stats, key=lambda key: self.stats[key].open_until)
+                self.log.warning('All proxies are in cooldown, probing %s', proxy)
+            elif len(available) == 1:
+                proxy = available[0]
+            else:
+                first, second = random.sample(available, 2)
+                if self.stats[first].score() <= self.stats[second].score():
+                    proxy = first
+                else:
+                    proxy = second
+
+            if self.stats[proxy].state != CLOSED:
+                self.stats[proxy].probing = True
+                self.stats[proxy].probe_started = now
+
+        return proxy, self.useragents[proxy]
+
+    def report_success(self, chosenproxy, latency):
+        """
+        Record a successful request
+        :param chosenproxy: Tuple of proxy and user agent as returned by choose
+        :param latency: Duration of the request in seconds
+        :return: None
+        """
+        proxy, _ = chosenproxy
+        with self.lock:
+            stats = self.stats[proxy]
+            stats.successes += 1
+            stats.consecutive_failures = 0
+            stats.latencies.append(latency)
+            if stats.state != CLOSED:
+                self.log.info('Proxy %s recovered', proxy)
+                stats.state = CLOSED
+                stats.cooldown = 0
+                stats.probing = False
+        self.autosave()
+
+    def report_failure(self, chosenproxy, error):
+        """
+        Record a failed request and open the circuit if needed
+        :param chosenproxy: Tuple of proxy and user agent as returned by choose
+        :param error: Kind of failure, '429', 'proxy', 'timeout' or 'other'
+        :return: None
+        """
+        proxy, _ = chosenproxy
+        with self.lock:
+            stats = self.stats[proxy]
+            stats.failures += 1
+            stats.consecutive_failures += 1
+            if error == '429':
+                stats.toomanyrequests += 1
+            elif error == 'proxy':
+                stats.proxyerrors += 1
+            elif error == 'timeout':
+                stats.timeouts += 1
+
+            if stats.state != CLOSED or stats.consecutive_failures >= self.failure_threshold:
+                if stats.cooldown == 0:
+                    stats.cooldown = self.initial_cooldown
+                else:
+                    stats.cooldown = min(stats.cooldown * 2, self.max_cooldown)
+                stats.state = OPEN
+                stats.open_until = time.time() + stats.cooldown
+                stats.probing = False
+                self.log.info('Proxy %s in cooldown for %s seconds after %s (%s failures)',
+                              proxy, stats.cooldown, error, stats.consecutive_failures)
+        self.autosave()
+
+    def summary(self):
+        """
+        Health overview of all proxies, ordered by score
+        :return: List of dictionaries with proxy, state, success rate and latency percentiles
+        """
+        with self.lock:
+            overview = []
+            for proxy, stats in self.stats.items():
+                overview.append({
+                    'proxy': proxy,
+                    'state': stats.state,
+                    'success_rate': stats.success_rate(),
+                    'p50': stats.latency_percentile(50),
+                    'p90': stats.latency_percentile(90),
+                    'p99': stats.latency_percentile(99),
+                    'toomanyrequests': stats.toomanyrequests,
+                    'proxyerrors': stats.proxyerrors,
+                    'timeouts': stats.timeouts
+                })
+            overview.sort(key=lambda entry: self.stats[entry['proxy']].score())
+        return overview
+
+    def autosave(self):
+        """
+        Save the scores if the save interval has passed. Only one thread saves per interval,
+        and a failed save is logged: the scores must never fail the request that reports them.
+        :return: None
+        """
+        if self.statefile is None:
+            return
+        with self.lock:
+            if time.time() - self.last_save <= self.save_interval:
+                return
+            self.last_save = time.time()
+        try:
+            self.save()
+        except OSError:
+            self.log.exception('Saving the proxy scores to %s failed', self.statefile)
+
+    def save(self):
+        """
+        Persist the scores of all proxies to the state file
+        :return: None
+        """
+        if self.statefile is None:
+            return
+        with self.lock:
+            state = {proxy: stats.to_dict() for proxy, stats in self.stats.items()}
+            self.last_save = time.time()
+
+        directory = os.path.dirname(self.statefile)
+        if directory != '' and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        # Threads of the same process may save at once, every save writes its own file
+        tmpfile = '{}.{}.{}'.format(self.statefile, os.getpid(), threading.get_ident())
+        with open(tmpfile, 'w') as file:
+            json.dump(state, file)
+        os.replace(tmpfile, self.statefile)
+        self.log.debug('Proxy scores saved to %s', self.statefile)
+
+    def load(self):
+        """
+        Load the persisted scores. Proxies that are no longer configured are ignored.
+        :return: None
+        """
+        if self.statefile is None:
+            return
+        try:
+            with open(self.statefile, 'r') as file:
+                state = json.load(file)
+        except FileNotFoundError:
+            self.log.debug('No proxy scores found in %s', self.statefile)
+            return
+        except ValueError:
+            self.log.warning('Proxy scores in %s are not readable, starting fresh', self.statefile)
+            return
+
+        for proxy, stats in state.items():
+            if proxy in self.stats:
+                self.stats[proxy].from_dict(stats)
+        self.log.info('Proxy scores for %s proxies loaded', len(state))
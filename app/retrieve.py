@@ -1,13 +1,19 @@
 """
 The retrieve program retrieves JSONs and pictures from instagram
 """
+import hashlib
+import io
+import json
 import logging
+import multiprocessing as mp
 import random
 import re
 import shutil
+import threading
 import time
 import os
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import requests
@@ -15,6 +21,22 @@ import boto3
 
 from botocore import errorfactory
 
+from .imagestore import ImageStore, urlpath
+from .proxypool import ProxyPool
+from .dbwrite import STATUS_ATTRIBUTE
+from .segments import SegmentWriter
+from .session import SessionPool
+from .storage import loaddictionary, recordpath, writerecord
+
+
+# Returned by grabjson if the page did not change since the validators were recorded
+NOT_MODIFIED = object()
+
+LINKS = {
+    'location': 'https://www.instagram.com/explore/locations/{}',
+    'user': 'https://www.instagram.com/{}/',
+    'picture': 'https://www.instagram.com/p/{}/'
+}
 
 def proxies_file():
     """Returns a list of proxies from a local file"""
@@ -29,26 +51,92 @@ def proxies_file():
 
     return proxies
 
-def grabjson(link, chosenproxy, useproxy=False):
+class SharedDataExtractor():
+    """
+    Finds the window._sharedData JSON in a page that is fed in chunks. Only the bytes after the
+    start marker are kept, so the page is never held or decoded as a whole.
+    """
+    start_marker = b'window._sharedData = '
+    end_marker = b';</script>'
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.started = False
+        self.searched = 0
+        self.result = None
+
+    def feed(self, chunk):
+        """
+        Feed the next chunk of the page
+        :param chunk: Bytes of the page
+        :return: True as soon as the JSON is complete and no further chunks are needed
+        """
+        if self.result is not None:
+            return True
+        self.buffer += chunk
+
+        if not self.started:
+            position = self.buffer.find(self.start_marker)
+            if position == -1:
+                # Keep only what could be the beginning of a marker split over two chunks
+                del self.buffer[:-len(self.start_marker)]
+                return False
+            del self.buffer[:position + len(self.start_marker)]
+            self.started = True
+            self.searched = 0
+
+        position = self.buffer.find(self.end_marker, self.searched)
+        if position == -1:
+            self.searched = max(0, len(self.buffer) - len(self.end_marker) + 1)
+            return False
+        self.result = bytes(self.buffer[:position])
+        self.buffer = bytearray()
+        return True
+
+    def shareddata(self):
+        """
+        The extracted JSON
+        :return: List with the JSON as bytes, empty if the page has no complete shared data
+        """
+        if self.result is None:
+            return []
+        return [self.result]
+
+def grabjson(link, chosenproxy, useproxy=False, session=None, chunk_size=16384,
+             validators=None):
     """
-    grabjson grabs the JSON from Instagram
+    grabjson grabs the JSON from Instagram. The page is streamed and the download stops as soon
+    as the shared data JSON is complete.
     :param link: Link that should be grabbed, e.g. 'https://www.instagram.com/president' for users
     :param chosenproxy: Proxy as string for requests module, e.g. '1.1.1.1:8080'
     :param useproxy: Indication if you want to use the proxy, default is False
-    :return: The fetches JSON file as dict
+    :param session: Optional requests.Session with keep-alive connections, default is None
+    :param chunk_size: Number of bytes read at once from the response
+    :param validators: Optional dictionary with 'etag' and 'last_modified' of the last retrieval
+    for a conditional request. It is updated with the validators of the response.
+    :return: List with the fetched JSON as bytes, empty if the page has no shared data,
+    NOT_MODIFIED if the server answered 304
 
     Todo: Better error handling in case the JSON can not be retrieved
     """
     log = logging.getLogger(__name__)
+    http = session if session is not None else requests
+
+    headers = {}
+    if validators is not None:
+        if validators.get('etag') is not None:
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified') is not None:
+            headers['If-Modified-Since'] = validators['last_modified']
 
     if useproxy is True:
         proxy, useragent = chosenproxy
+        headers['User-Agent'] = useragent
 
         try:
             jsonstarttime = time.time()
-            resp = requests.get(link, headers={"User-Agent": useragent}, proxies={"https": proxy},
-                                timeout=60)
-            jsonendtime = time.time()
+            resp = http.get(link, headers=headers, proxies={"https": proxy},
+                            timeout=60, stream=True)
 
         except requests.exceptions.ProxyError:
             log.exception('Proxy not reachable')
@@ -64,91 +152,269 @@ def grabjson(link, chosenproxy, useproxy=False):
 
     else:
         jsonstarttime = time.time()
-        resp = requests.get(link, timeout=60)
-        jsonendtime = time.time()
+        resp = http.get(link, headers=headers, timeout=60, stream=True)
 
     if resp.status_code == 404:
         log.info('Page not found, 404: %s', link)
+        resp.close()
         resp.raise_for_status()
 
     if resp.status_code == 429:
         log.info('Too many requests for %s', link)
+        resp.close()
         resp.raise_for_status()
 
-    resp_json = re.findall(r'(?<=window\._sharedData = )(?P<json>.*)(?=;</script>)', resp.text)
+    if resp.status_code == 304:
+        log.debug('Not modified: %s', link)
+        resp.close()
+        return NOT_MODIFIED
+
+    if validators is not None:
+        validators['etag'] = resp.headers.get('ETag')
+        validators['last_modified'] = resp.headers.get('Last-Modified')
+
+    extractor = SharedDataExtractor()
+    try:
+        for chunk in resp.iter_content(chunk_size=chunk_size):
+            if extractor.feed(chunk):
+                break
+    finally:
+        # Closing before the end of the page drops the connection instead of reading the rest
+        resp.close()
+    jsonendtime = time.time()
+
+    resp_json = extractor.shareddata()
     jsontime = jsonendtime - jsonstarttime
     log.debug('%s: Time to retrieve (%s)', jsontime, link)
 
     return resp_json
 
 
+def checkimage(imagefile, imagelink):
+    """
+    Make sure a response is an image before it is stored. An error page must not be stored,
+    the content index would skip the real image under its link afterwards.
+    :param imagefile: The streamed response of the image
+    :param imagelink: The link the image was requested from
+    :return: None
+    """
+    contenttype = imagefile.headers.get('Content-Type', 'image/')
+    try:
+        imagefile.raise_for_status()
+        if not contenttype.startswith('image/'):
+            raise ValueError('No image but {} from {}'.format(contenttype, imagelink))
+    except Exception:
+        imagefile.close()
+        raise
+
+
 def grabimage(file_directory,
               s3_link,
               s3_file_directory,
               pictureid,
               json,
               chosenproxy,
-              useproxy=False):
+              useproxy=False,
+              session=None,
+              keep_local=True,
+              imagestore=None):
     """
     grabimage grabs the image from th category and saves it where needed
     :param file_directory: The directory where the pictures should be safed
     :param s3_link: The connection to S3 from the main module
     :param s3_file_directory: The directory where the pictures should be safed
     :param pictureid: The picture ID
-    :param json: The json retreived
+    :param json: The json retreived, as bytes or string
     :param chosenproxy: The proxy that will be used
     :param useproxy: Should a proxe be used or not
+    :param session: Optional requests.Session with keep-alive connections, default is None
+    :param keep_local: Save the image locally before uploading it, otherwise the response is
+    streamed straight into S3, default is True
+    :param imagestore: Optional ImageStore, images are then stored by content hash and known
+    images are skipped, default is None
     :return: None
     """
+    log = logging.getLogger(__name__)
+    http = session if session is not None else requests
 
-    imagelink = re.findall(r'"display_url":"([^"]+)"', json)
+    if isinstance(json, bytes):
+        imagelink = [link.decode('utf-8')
+                     for link in re.findall(rb'"display_url":"([^"]+)"', json)]
+    else:
+        imagelink = re.findall(r'"display_url":"([^"]+)"', json)
     filename = imagelink[0].split('/')[-1].split('?')[0]
 
+    if imagestore is not None and imagestore.lookup_url(urlpath(imagelink[0])) is not None:
+        log.debug('%s: Image %s already stored', pictureid, filename)
+        return
+
     if useproxy is True:
         proxy, useragent = chosenproxy
-        imagefile = requests.get(imagelink[0], headers={"User-Agent": useragent},
-                                 proxies={"https": proxy}, timeout=60, stream=True)
+        imagefile = http.get(imagelink[0], headers={"User-Agent": useragent},
+                             proxies={"https": proxy}, timeout=60, stream=True)
     else:
-        imagefile = requests.get(imagelink[0], timeout=60, stream=True)
+        imagefile = http.get(imagelink[0], timeout=60, stream=True)
+    checkimage(imagefile, imagelink[0])
 
-    if not os.path.exists(file_directory):
-        os.makedirs(file_directory)
-    with open('{}/{}_{}'.format(file_directory, pictureid, filename), 'wb') as file:
-        shutil.copyfileobj(imagefile.raw, file)
+    if imagestore is not None:
+        storeimage(imagestore, imagefile, imagelink[0], file_directory, s3_link,
+                   s3_file_directory, pictureid, keep_local)
+
+    elif keep_local is True:
+        if not os.path.exists(file_directory):
+            os.makedirs(file_directory)
+        with open('{}/{}_{}'.format(file_directory, pictureid, filename), 'wb') as file:
+            shutil.copyfileobj(imagefile.raw, file)
+        # Hand the connection back to the keep-alive pool
+        imagefile.close()
 
-    s3_link.upload_file('{}/{}_{}'.format(file_directory, pictureid, filename), 'gvbinsta-test',
-                        '{}/{}_{}'.format(s3_file_directory, pictureid, filename))
+        s3_link.upload_file('{}/{}_{}'.format(file_directory, pictureid, filename),
+                            'gvbinsta-test',
+                            '{}/{}_{}'.format(s3_file_directory, pictureid, filename))
+
+    else:
+        # upload_fileobj reads the body in parts and switches to a multipart upload for
+        # large images, nothing is written to disk
+        imagefile.raw.decode_content = True
+        try:
+            s3_link.upload_fileobj(imagefile.raw, 'gvbinsta-test',
+                                   '{}/{}_{}'.format(s3_file_directory, pictureid, filename))
+        finally:
+            imagefile.close()
+
+
+def storeimage(imagestore,
+               imagefile,
+               imagelink,
+               file_directory,
+               s3_link,
+               s3_file_directory,
+               pictureid,
+               keep_local=True):
+    """
+    Store an image under the hash of its bytes, identical images of different posts are
+    uploaded only once
+    :param imagestore: ImageStore with the content index
+    :param imagefile: The streamed response of the image
+    :param imagelink: The link the image was downloaded from
+    :param file_directory: The directory where the pictures should be safed
+    :param s3_link: The connection to S3 from the main module
+    :param s3_file_directory: The directory where the pictures should be safed
+    :param pictureid: The picture ID
+    :param keep_local: Save a local copy as well, default is True
+    :return: The S3 key of the image
+    """
+    log = logging.getLogger(__name__)
+    try:
+        content = imagefile.content
+    finally:
+        imagefile.close()
+
+    digest = hashlib.sha256(content).hexdigest()
+    extension = os.path.splitext(urlpath(imagelink))[1]
+    s3key = imagestore.lookup_hash(digest)
+
+    if s3key is None:
+        s3key = '{}/sha256/{}/{}{}'.format(s3_file_directory, digest[:2], digest, extension)
+        s3_link.upload_fileobj(io.BytesIO(content), 'gvbinsta-test', s3key)
+        if keep_local is True:
+            if not os.path.exists(file_directory):
+                os.makedirs(file_directory)
+            with open('{}/{}{}'.format(file_directory, digest, extension), 'wb') as file:
+                file.write(content)
+    else:
+        log.debug('%s: Identical image already stored as %s', pictureid, s3key)
+
+    imagestore.add(urlpath(imagelink), digest, s3key, len(content), pictureid)
+    return s3key
 
 
 def writejson(file_directory,
               keyid,
               fetchedjson,
               s3_link,
-              s3_directory):
+              s3_directory,
+              codec='plain',
+              dictionary=None,
+              segmentwriter=None,
+              retrieved_at_time=None):
     """
     Writing the JSON string where needed
     :param file_directory: Directory where the JSON string is saved
     :param keyid: Key ID for the file name
-    :param fetchedjson: The fetched JSON
+    :param fetchedjson: The fetched JSON, as bytes or string
     :param s3_link: S3 connection
     :param s3_directory: S3 Directory where the files should be safed
+    :param codec: 'plain', 'gzip' or 'zstd', default is 'plain'
+    :param dictionary: Optional zstd dictionary for the zstd codec
+    :param segmentwriter: Optional SegmentWriter, the JSON is then archived in a segment
+    instead of its own S3 object
+    :param retrieved_at_time: Retrieval time as unix timestamp, default is now
     :return: None
     """
     log = logging.getLogger(__name__)
-    if not os.path.exists(file_directory):
-        os.makedirs(file_directory)
+    if retrieved_at_time is None:
+        retrieved_at_time = int(datetime.now().strftime('%s'))
+    path = recordpath(file_directory, keyid, codec)
     try:
-        with open('{}/{}.json'.format(file_directory, keyid), 'w') as file:
-            file.write(datetime.now().strftime('%s') + '\n')
-            file.write(fetchedjson[0])
+        path = writerecord(file_directory, keyid, retrieved_at_time, fetchedjson[0], codec,
+                           dictionary)
     except:
         log.exception('%s could not be written, check for error. JSON is: %s', keyid, fetchedjson)
-    s3_link.upload_file('{}/{}.json'.format(file_directory, keyid), 'gvbinsta-test',
-                        '{}/{}.json'.format(s3_directory, keyid))
+
+    if segmentwriter is not None:
+        segmentwriter.append(keyid, retrieved_at_time, fetchedjson[0])
+    else:
+        s3_link.upload_file(path, 'gvbinsta-test',
+                            '{}/{}'.format(s3_directory, os.path.basename(path)))
+
+def contenthash(fetchedjson):
+    """
+    Hash of the GraphQL data of a fetched JSON. Tokens and other fields of the shared data
+    that change with every request are left out, so unchanged pages get the same hash.
+    :param fetchedjson: The fetched JSON as returned by grabjson
+    :return: Hex SHA-256
+    """
+    payload = fetchedjson[0]
+    try:
+        entry_data = json.loads(payload)['entry_data']
+        graphql = [[page.get('graphql') for page in pages] for pages in entry_data.values()]
+        payload = json.dumps(graphql, sort_keys=True).encode('utf-8')
+    except (ValueError, KeyError, AttributeError, TypeError):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+    return hashlib.sha256(payload).hexdigest()
+
+def readvalidators(file_directory, keyid):
+    """
+    Read the validators that were recorded next to the JSON file
+    :param file_directory: Directory where the JSON string is saved
+    :param keyid: Key ID for the file name
+    :return: Dictionary with 'etag', 'last_modified' and 'sha256', empty if none were recorded
+    """
+    try:
+        with open('{}/{}.validators'.format(file_directory, keyid), 'r') as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def writevalidators(file_directory, keyid, validators):
+    """
+    Record the validators next to the JSON file
+    :param file_directory: Directory where the JSON string is saved
+    :param keyid: Key ID for the file name
+    :param validators: Dictionary with 'etag', 'last_modified' and 'sha256'
+    :return: None
+    """
+    if not os.path.exists(file_directory):
+        os.makedirs(file_directory)
+    with open('{}/{}.validators'.format(file_directory, keyid), 'w') as file:
+        json.dump(validators, file)
 
 def set_retrieved_time(db_link, key, value):
     """
-    Set the retrieved time within the DB for further processing
+    Set the retrieved time within the DB for further processing, which puts the item into
+    the 'retrieved' pipeline status
     :param db_link: DB connection
     :param key: Key that is used with the respective DB
     :param value: set retrieved value with the corresponding time
@@ -160,9 +426,13 @@ def set_retrieved_time(db_link, key, value):
             Key={
                 key: value
             },
-            UpdateExpression='SET retrieved_at_time = :rtime',
+            UpdateExpression='SET retrieved_at_time = :rtime, #status = :status',
+            ExpressionAttributeNames={
+                '#status': STATUS_ATTRIBUTE
+            },
             ExpressionAttributeValues={
-                ':rtime': int(time.time())
+                ':rtime': int(time.time()),
+                ':status': 'retrieved'
             }
         )
 
@@ -173,9 +443,39 @@ def set_retrieved_time(db_link, key, value):
 
     log.debug(resp)
 
+def set_checked_time(db_link, key, value):
+    """
+    Set the retrieved time of an item whose page is unchanged since the last retrieval. The
+    stored JSON was already extracted, so the item leaves the pipeline instead of being queued
+    for extraction again.
+    :param db_link: DB connection
+    :param key: Key that is used with the respective DB
+    :param value: Key value of the item
+    :return: None
+    """
+    log = logging.getLogger(__name__)
+    try:
+        resp = db_link.update_item(
+            Key={
+                key: value
+            },
+            UpdateExpression='SET retrieved_at_time = :rtime REMOVE #status',
+            ExpressionAttributeNames={
+                '#status': STATUS_ATTRIBUTE
+            },
+            ExpressionAttributeValues={
+                ':rtime': int(time.time())
+            }
+        )
+    except errorfactory.ClientError:
+        log.exception('Exception when updating "retrieved_at_time" in DB')
+        raise SystemExit
+
+    log.debug(resp)
+
 def set_deleted(db_link, key, value):
     """
-    Set the item deleted within the DB
+    Set the item deleted within the DB, a deleted item leaves the pipeline
     :param db_link: DB connection
     :param key: Respective key for the category
     :param value: set deleted value as default
@@ -186,7 +486,10 @@ def set_deleted(db_link, key, value):
         Key={
             key: value
         },
-        UpdateExpression='SET deleted = :del, retrieved_at_time = :time',
+        UpdateExpression='SET deleted = :del, retrieved_at_time = :time REMOVE #status',
+        ExpressionAttributeNames={
+            '#status': STATUS_ATTRIBUTE
+        },
         ExpressionAttributeValues={
             ':del': True,
             ':time': int(time.time())
@@ -195,6 +498,186 @@ def set_deleted(db_link, key, value):
 
     log.debug(resp)
 
+class TokenBucket():
+    """
+    Token bucket whose refill rate adapts with AIMD: every success raises the rate additively,
+    every 429 cuts it multiplicatively and blocks the bucket for a jittered backoff. The state
+    lives in shared memory under a process lock, so processes forked after the bucket was
+    created take their tokens from the same bucket.
+    """
+    # Positions of the state in the shared array
+    fields = ['rate', 'tokens', 'updated', 'blocked_until', 'toomanyrequests']
+
+    def __init__(self,
+                 rate,
+                 burst=1,
+                 min_rate=0.01,
+                 max_rate=100,
+                 increase=0.05,
+                 decrease=0.5,
+                 backoff=5,
+                 max_backoff=300):
+        """
+        :param rate: Start rate in requests per second
+        :param burst: Maximum number of tokens that can be saved up
+        :param min_rate: Lower limit for the rate
+        :param max_rate: Upper limit for the rate
+        :param increase: Additive increase of the rate per second of successful requests
+        :param decrease: Factor the rate is multiplied with on a 429
+        :param backoff: Base backoff in seconds after a 429, doubled for every further 429
+        :param max_backoff: Upper limit for the backoff in seconds
+        """
+        self.lock = mp.Lock()
+        self.state = mp.RawArray('d', len(self.fields))
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.tokens = burst
+        self.updated = time.time()
+        self.blocked_until = 0
+        self.toomanyrequests = 0
+
+    def __getattr__(self, name):
+        if name in TokenBucket.fields:
+            return self.state[TokenBucket.fields.index(name)]
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name in TokenBucket.fields:
+            self.state[TokenBucket.fields.index(name)] = value
+        else:
+            super().__setattr__(name, value)
+
+    def reserve(self):
+        """
+        Take a token. If none is left the token is borrowed from the future.
+        :return: Seconds to wait before the request may be sent
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = 0
+            if self.tokens < 0:
+                wait = -self.tokens / self.rate
+            return max(wait, self.blocked_until - now)
+
+    def on_success(self):
+        """
+        Additive increase, spread over the requests of one second
+        :return: None
+        """
+        with self.lock:
+            self.toomanyrequests = 0
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def on_toomanyrequests(self):
+        """
+        Multiplicative decrease and a backoff with full jitter
+        :return: Backoff in seconds
+        """
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            backoff = random.uniform(0, min(self.max_backoff,
+                                            self.backoff * 2 ** int(self.toomanyrequests)))
+            self.toomanyrequests += 1
+            self.blocked_until = max(self.blocked_until, time.time() + backoff)
+            return backoff
+
+
+class RateLimiter():
+    """
+    RateLimiter combines a global token bucket with one token bucket per proxy. A request waits
+    until both buckets have a token. The buckets of the given proxies are created up front, so
+    the limits and backoffs are shared with the processes forked afterwards, e.g. the process
+    pool of run.py. The bucket of a proxy that is not given applies only to its process.
+    """
+    def __init__(self,
+                 requests_per_second=20,
+                 proxy_requests_per_second=1,
+                 max_requests_per_second=200,
+                 max_proxy_requests_per_second=10,
+                 proxies=()):
+        """
+        :param requests_per_second: Start rate over all proxies
+        :param proxy_requests_per_second: Start rate per proxy
+        :param max_requests_per_second: Upper limit of the rate over all proxies
+        :param max_proxy_requests_per_second: Upper limit of the rate per proxy
+        :param proxies: Proxies as strings whose buckets are shared, None for direct requests
+        """
+        self.log = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.proxy_requests_per_second = proxy_requests_per_second
+        self.max_proxy_requests_per_second = max_proxy_requests_per_second
+        # A single 429 mostly concerns one proxy, so the global rate is cut more gently and
+        # only the proxy is blocked for the backoff
+        self.globalbucket = TokenBucket(requests_per_second,
+                                        burst=requests_per_second,
+                                        max_rate=max_requests_per_second,
+                                        increase=1,
+                                        decrease=0.9,
+                                        backoff=0)
+        self.proxybuckets = {}
+        for proxy in proxies:
+            self.bucket(proxy)
+
+    def bucket(self, proxy):
+        """
+        Returns the token bucket of a proxy
+        :param proxy: Proxy as string, None if no proxy is used
+        :return: TokenBucket
+        """
+        with self.lock:
+            if proxy not in self.proxybuckets:
+                self.proxybuckets[proxy] = TokenBucket(self.proxy_requests_per_second,
+                                                       max_rate=self.max_proxy_requests_per_second)
+            return self.proxybuckets[proxy]
+
+    def reserve(self, proxy):
+        """
+        Take a token from the global and the proxy bucket
+        :param proxy: Proxy as string, None if no proxy is used
+        :return: Seconds to wait before the request may be sent
+        """
+        return max(self.globalbucket.reserve(), self.bucket(proxy).reserve())
+
+    def acquire(self, proxy):
+        """
+        Block until a request through the proxy may be sent
+        :param proxy: Proxy as string, None if no proxy is used
+        :return: None
+        """
+        wait = self.reserve(proxy)
+        if wait > 0:
+            time.sleep(wait)
+
+    def on_success(self, proxy):
+        """
+        Report a successful request
+        :param proxy: Proxy as string, None if no proxy is used
+        :return: None
+        """
+        self.globalbucket.on_success()
+        self.bucket(proxy).on_success()
+
+    def on_toomanyrequests(self, proxy):
+        """
+        Report a 429 response
+        :param proxy: Proxy as string, None if no proxy is used
+        :return: None
+        """
+        self.globalbucket.on_toomanyrequests()
+        backoff = self.bucket(proxy).on_toomanyrequests()
+        self.log.info('429 through %s: backing off %.1f seconds, rate now %.2f/s (global %.2f/s)',
+                      proxy, backoff, self.bucket(proxy).rate, self.globalbucket.rate)
+
+
 class Retrieve():
     """
     Retrieve class extracts the JSON from Instagram, downloads the picture for posts,
@@ -204,10 +687,34 @@ class Retrieve():
                  useproxy=False,
                  awsprofile='default',
                  awsregion='eu-central-1',
-                 storage_directory='./downloads'):
+                 storage_directory='./downloads',
+                 proxystatefile='./tmp/proxypool.json',
+                 connections_per_session=10,
+                 session_idle_timeout=300,
+                 requests_per_second=20,
+                 proxy_requests_per_second=1,
+                 keep_local_pictures=True,
+                 upload_threads=0,
+                 max_pending_uploads=100,
+                 dedupe_images=False,
+                 imagestorefile='./tmp/imagestore.sqlite',
+                 conditional=True,
+                 codec='plain',
+                 zstd_dictionary=None,
+                 archive='objects',
+                 segment_bytes=64 * 1024 * 1024,
+                 segment_age=300,
+                 archive_threads=0,
+                 max_pending_archives=100):
 
         self.log = logging.getLogger(__name__)
         self.proxies = proxies_file()
+        self.proxypool = ProxyPool(self.proxies, statefile=proxystatefile)
+        self.sessionpool = SessionPool(pool_maxsize=connections_per_session,
+                                       idle_timeout=session_idle_timeout)
+        self.ratelimiter = RateLimiter(requests_per_second=requests_per_second,
+                                       proxy_requests_per_second=proxy_requests_per_second,
+                                       proxies=[proxy for proxy, _ in self.proxies] + [None])
         self.useproxy = useproxy
         self.awssession = boto3.session.Session(profile_name=awsprofile, region_name=awsregion)
         self.s3_link = self.awssession.client('s3')
@@ -220,6 +727,232 @@ class Retrieve():
         self.storage_json_user = 'json/user'
         self.storage_json_post = 'json/post'
         self.storage_pictures = 'pictures'
+        self.storage_json = {
+            'location': self.storage_json_location,
+            'user': self.storage_json_user,
+            'picture': self.storage_json_post
+        }
+        self.conditional = conditional
+        self.codec = codec
+        self.zstd_dictionary = loaddictionary(zstd_dictionary)
+        self.segmentwriters = {}
+        if archive == 'segments':
+            for category, storage_json in self.storage_json.items():
+                self.segmentwriters[category] = SegmentWriter(
+                    os.path.join(self.storage_directory, 'segments', storage_json),
+                    category,
+                    self.s3_link,
+                    'segments/{}'.format(storage_json),
+                    max_bytes=segment_bytes,
+                    max_age=segment_age,
+                    codec=codec,
+                    dictionary=self.zstd_dictionary)
+        self.keep_local_pictures = keep_local_pictures
+        self.imagestore = None
+        if dedupe_images is True:
+            self.imagestore = ImageStore(imagestorefile)
+        self.uploadpool = None
+        if upload_threads > 0:
+            self.uploadpool = ThreadPoolExecutor(max_workers=upload_threads)
+            self.pendinguploads = threading.BoundedSemaphore(max_pending_uploads)
+        self.archivepool = None
+        if archive_threads > 0:
+            self.archivepool = ThreadPoolExecutor(max_workers=archive_threads)
+            self.pendingarchives = threading.BoundedSemaphore(max_pending_archives)
+        # Optional pipeline.Pipeline that receives every new JSON for extraction
+        self.pipeline = None
+
+    def close(self):
+        """
+        Wait for all background image uploads and archive writes to finish and upload the open
+        segments, also those the process pool workers left behind once the pool was joined
+        :return: None
+        """
+        if self.uploadpool is not None:
+            self.uploadpool.shutdown(wait=True)
+            self.uploadpool = None
+        if self.archivepool is not None:
+            self.archivepool.shutdown(wait=True)
+            self.archivepool = None
+        for segmentwriter in self.segmentwriters.values():
+            segmentwriter.close()
+            segmentwriter.recover()
+
+    def session(self, chosenproxy):
+        """
+        Returns the keep-alive session for the chosen proxy
+        :param chosenproxy: Tuple of proxy and user agent
+        :return: requests.Session
+        """
+        if self.useproxy is not True:
+            return self.sessionpool.get(None)
+        return self.sessionpool.get(chosenproxy)
+
+    def proxykey(self, chosenproxy):
+        """
+        Returns the proxy that limits apply to
+        :param chosenproxy: Tuple of proxy and user agent
+        :return: Proxy as string, None if no proxy is used
+        """
+        if self.useproxy is not True:
+            return None
+        return chosenproxy[0]
+
+    def report_success(self, chosenproxy, latency):
+        """
+        Report a successful request to the rate limiter and the proxy pool
+        :param chosenproxy: Tuple of proxy and user agent
+        :param latency: Duration of the request in seconds
+        :return: None
+        """
+        self.ratelimiter.on_success(self.proxykey(chosenproxy))
+        if self.useproxy is True:
+            self.proxypool.report_success(chosenproxy, latency)
+
+    def report_failure(self, chosenproxy, error):
+        """
+        Report a failed request to the rate limiter and the proxy pool
+        :param chosenproxy: Tuple of proxy and user agent
+        :param error: Kind of failure, '429', 'proxy', 'timeout' or 'other'
+        :return: None
+        """
+        if error == '429':
+            self.ratelimiter.on_toomanyrequests(self.proxykey(chosenproxy))
+        if self.useproxy is True:
+            self.proxypool.report_failure(chosenproxy, error)
+
+    def validators(self, category, keyid):
+        """
+        Validators of the last retrieval for a conditional request
+        :param category: 'location', 'user' or 'picture'
+        :param keyid: Key of the item
+        :return: Dictionary of validators, None if conditional requests are disabled
+        """
+        if self.conditional is not True:
+            return None
+        return readvalidators(os.path.join(self.storage_directory, self.storage_json[category]),
+                              keyid)
+
+    def unchanged(self, category, keyid, fetchedjson, validators):
+        """
+        Checks if the page did not change since the last retrieval, either because the server
+        answered 304 or because the GraphQL data has the same hash. The new hash is put into
+        the validators.
+        :param category: 'location', 'user' or 'picture'
+        :param keyid: Key of the item
+        :param fetchedjson: The fetched JSON as returned by grabjson
+        :param validators: Dictionary of validators, None if conditional requests are disabled
+        :return: True if the page is unchanged
+        """
+        if validators is None:
+            return False
+        if fetchedjson is NOT_MODIFIED:
+            return True
+        if fetchedjson in ['', None] or len(fetchedjson) == 0:
+            return False
+
+        previous = validators.get('sha256')
+        validators['sha256'] = contenthash(fetchedjson)
+        if previous != validators['sha256']:
+            return False
+
+        # Keep the validators of the latest response for the next conditional request
+        self.savevalidators(category, keyid, validators)
+        return True
+
+    def savevalidators(self, category, keyid, validators):
+        """
+        Record the validators after the JSON was saved
+        :param category: 'location', 'user' or 'picture'
+        :param keyid: Key of the item
+        :param validators: Dictionary of validators, None if conditional requests are disabled
+        :return: None
+        """
+        if validators is not None:
+            writevalidators(os.path.join(self.storage_directory, self.storage_json[category]),
+                            keyid, validators)
+
+    def archive_json(self, category, keyid, fetchedjson, validators, retrieved_at_time):
+        """
+        Write the JSON to disk and S3 and record its validators
+        :param category: 'location', 'user' or 'picture'
+        :param keyid: Key of the item
+        :param fetchedjson: The fetched JSON as returned by grabjson
+        :param validators: Validators of the request, None if conditional requests are disabled
+        :param retrieved_at_time: Retrieval time as unix timestamp
+        :return: None
+        """
+        writejson(os.path.join(self.storage_directory, self.storage_json[category]), keyid,
+                  fetchedjson, self.s3_link, self.storage_json[category], self.codec,
+                  self.zstd_dictionary, self.segmentwriters.get(category), retrieved_at_time)
+        self.savevalidators(category, keyid, validators)
+
+    def archive_done(self, keyid, future):
+        """
+        Callback of a background archive write, logs its error
+        :param keyid: Key of the item
+        :param future: Future of archive_json
+        :return: None
+        """
+        self.pendingarchives.release()
+        if future.exception() is not None:
+            self.log.error('%s: JSON could not be archived: %s', keyid, future.exception())
+
+    def store_json(self, category, keyid, fetchedjson, validators):
+        """
+        Archive the fetched JSON, on the archive thread pool if there is one
+        :param category: 'location', 'user' or 'picture'
+        :param keyid: Key of the item
+        :param fetchedjson: The fetched JSON as returned by grabjson
+        :param validators: Validators of the request, None if conditional requests are disabled
+        :return: Retrieval time as unix timestamp
+        """
+        retrieved_at_time = int(time.time())
+        if self.archivepool is None:
+            self.archive_json(category, keyid, fetchedjson, validators, retrieved_at_time)
+        else:
+            # Blocks when too many writes are waiting, so memory stays bounded
+            self.pendingarchives.acquire()
+            archive = self.archivepool.submit(self.archive_json, category, keyid, fetchedjson,
+                                              validators, retrieved_at_time)
+            archive.add_done_callback(lambda future: self.archive_done(keyid, future))
+        return retrieved_at_time
+
+    def fetchjson(self, link, validators=None):
+        """
+        Grab the JSON through a proxy from the proxy pool within the rate limits and report the
+        outcome to the pool and the rate limiter
+        :param link: Link that should be grabbed
+        :param validators: Optional validators for a conditional request, see grabjson
+        :return: The fetched JSON as returned by grabjson
+        """
+        chosenproxy = self.proxypool.choose()
+        session = self.session(chosenproxy)
+        self.ratelimiter.acquire(self.proxykey(chosenproxy))
+
+        starttime = time.time()
+        try:
+            fetchedjson = grabjson(link, chosenproxy, self.useproxy, session,
+                                   validators=validators)
+        except requests.exceptions.HTTPError as error:
+            if error.response is not None and error.response.status_code == 429:
+                self.report_failure(chosenproxy, '429')
+            else:
+                # e.g. a 404 says nothing about the health of the proxy
+                self.report_success(chosenproxy, time.time() - starttime)
+            raise
+        except requests.exceptions.ProxyError:
+            self.report_failure(chosenproxy, 'proxy')
+            raise
+        except requests.exceptions.Timeout:
+            self.report_failure(chosenproxy, 'timeout')
+            raise
+        except requests.exceptions.RequestException:
+            self.report_failure(chosenproxy, 'other')
+            raise
+
+        self.report_success(chosenproxy, time.time() - starttime)
+        return fetchedjson
 
     def retrieve_location(self, locationid):
         """
@@ -228,21 +961,36 @@ class Retrieve():
         :return: None
         """
         fetchedjson = ''
-        link = 'https://www.instagram.com/explore/locations/{}'.format(locationid)
+        link = LINKS['location'].format(locationid)
+        validators = self.validators('location', locationid)
         try:
-            fetchedjson = grabjson(link,
-                                   random.choice(self.proxies),
-                                   self.useproxy)
-        except requests.exceptions.HTTPError:
+            fetchedjson = self.fetchjson(link, validators)
+        except requests.exceptions.HTTPError as error:
+            # A 429 is reported to the rate limiter by fetchjson, the location still exists
+            if error.response is not None and error.response.status_code == 429:
+                raise
             self.log.exception('Http Error when retrieving the JSON')
 
-        if fetchedjson not in ['', None]:
+        self.save_location(locationid, fetchedjson, validators)
+
+    def save_location(self, locationid, fetchedjson, validators=None):
+        """
+        Save the fetched location JSON and mark the location in the DB
+        :param locationid: Location ID
+        :param fetchedjson: The fetched JSON as returned by grabjson
+        :param validators: Validators of the request, None if conditional requests are disabled
+        :return: None
+        """
+        if self.unchanged('location', locationid, fetchedjson, validators):
+            self.log.info('Location %s: Unchanged since the last retrieval', locationid)
+            set_checked_time(self.locdb, 'id', locationid)
+
+        elif fetchedjson not in ['', None]:
             self.log.debug('%s: Fetched JSON %s.', locationid, fetchedjson)
-            file_storage_json_location = os.path.join(self.storage_directory,
-                                                      self.storage_json_location)
-            writejson(file_storage_json_location, locationid, fetchedjson, self.s3_link,
-                      self.storage_json_location)
+            retrieved_at_time = self.store_json('location', locationid, fetchedjson, validators)
             set_retrieved_time(self.locdb, 'id', locationid)
+            if self.pipeline is not None:
+                self.pipeline.put('location', locationid, fetchedjson[0], retrieved_at_time)
 
         else:
             self.log.debug('Location %s: No JSON retrieved', locationid)
@@ -255,16 +1003,29 @@ class Retrieve():
         :param userid: User ID
         :return: None
         """
-        link = 'https://www.instagram.com/{}/'.format(userid)
-        fetchedjson = grabjson(link, random.choice(self.proxies), self.useproxy)
+        link = LINKS['user'].format(userid)
+        validators = self.validators('user', userid)
+        fetchedjson = self.fetchjson(link, validators)
+        self.save_user(userid, fetchedjson, validators)
 
-        if fetchedjson not in ['', None]:
+    def save_user(self, userid, fetchedjson, validators=None):
+        """
+        Save the fetched user JSON and mark the user in the DB
+        :param userid: User ID
+        :param fetchedjson: The fetched JSON as returned by grabjson
+        :param validators: Validators of the request, None if conditional requests are disabled
+        :return: None
+        """
+        if self.unchanged('user', userid, fetchedjson, validators):
+            self.log.info('User %s: Unchanged since the last retrieval', userid)
+            set_checked_time(self.userdb, 'username', userid)
+
+        elif fetchedjson not in ['', None]:
             self.log.debug('%s: Fetched JSON %s.', userid, fetchedjson)
-            file_storage_json_user = os.path.join(self.storage_directory,
-                                                  self.storage_json_user)
-            writejson(file_storage_json_user, userid, fetchedjson, self.s3_link,
-                      self.storage_json_user)
+            retrieved_at_time = self.store_json('user', userid, fetchedjson, validators)
             set_retrieved_time(self.userdb, 'username', userid)
+            if self.pipeline is not None:
+                self.pipeline.put('user', userid, fetchedjson[0], retrieved_at_time)
 
         else:
             self.log.debug('Location %s: No JSON retrieved', userid)
@@ -276,27 +1037,60 @@ class Retrieve():
         :param pictureid: Picture ID
         :return: None
         """
-        link = 'https://www.instagram.com/p/{}/'.format(pictureid)
-        fetchedjson = grabjson(link, random.choice(self.proxies), self.useproxy)
+        link = LINKS['picture'].format(pictureid)
+        validators = self.validators('picture', pictureid)
+        fetchedjson = self.fetchjson(link, validators)
+        self.save_picture(pictureid, fetchedjson, validators)
+
+    def save_image(self, pictureid, fetchedjson):
+        """
+        Grab the image of a picture and upload it to S3. Errors are logged, not raised.
+        :param pictureid: Picture ID
+        :param fetchedjson: The fetched JSON as returned by grabjson
+        :return: None
+        """
+        file_storage_pictures = os.path.join(self.storage_directory, self.storage_pictures)
+        chosenproxy = self.proxypool.choose()
+        try:
+            grabimage(file_storage_pictures,
+                      self.s3_link,
+                      self.storage_pictures,
+                      pictureid,
+                      fetchedjson[0],
+                      chosenproxy,
+                      self.useproxy,
+                      self.session(chosenproxy),
+                      self.keep_local_pictures,
+                      self.imagestore)
+        except:
+            self.log.exception('Check the exception with the following: %s, %s',
+                               pictureid, fetchedjson)
+
+    def save_picture(self, pictureid, fetchedjson, validators=None):
+        """
+        Save the fetched picture JSON, grab the image and mark the picture in the DB
+        :param pictureid: Picture ID
+        :param fetchedjson: The fetched JSON as returned by grabjson
+        :param validators: Validators of the request, None if conditional requests are disabled
+        :return: None
+        """
+        if self.unchanged('picture', pictureid, fetchedjson, validators):
+            self.log.info('Picture %s: Unchanged since the last retrieval', pictureid)
+            set_checked_time(self.picdb, 'shortcode', pictureid)
 
-        if fetchedjson not in ['', None]:
+        elif fetchedjson not in ['', None]:
             self.log.debug('%s: Fetched JSON %s', pictureid, fetchedjson)
-            file_storage_json_post = os.path.join(self.storage_directory, self.storage_json_post)
-            writejson(file_storage_json_post, pictureid, fetchedjson, self.s3_link,
-                      self.storage_json_post)
-            file_storage_pictures = os.path.join(self.storage_directory, self.storage_pictures)
-            try:
-                grabimage(file_storage_pictures,
-                          self.s3_link,
-                          self.storage_pictures,
-                          pictureid,
-                          fetchedjson[0],
-                          random.choice(self.proxies),
-                          self.useproxy)
-            except:
-                self.log.exception('Check the exception with the following: %s, %s',
-                                   pictureid, fetchedjson)
+            retrieved_at_time = self.store_json('picture', pictureid, fetchedjson, validators)
+            if self.uploadpool is None:
+                self.save_image(pictureid, fetchedjson)
+            else:
+                # Blocks when too many uploads are waiting, so memory stays bounded
+                self.pendinguploads.acquire()
+                upload = self.uploadpool.submit(self.save_image, pictureid, fetchedjson)
+                upload.add_done_callback(lambda future: self.pendinguploads.release())
             set_retrieved_time(self.picdb, 'shortcode', pictureid)
+            if self.pipeline is not None:
+                self.pipeline.put('picture', pictureid, fetchedjson[0], retrieved_at_time)
 
         else:
             self.log.debug('%s: No JSON for picture retrieved', pictureid)
@@ -2,15 +2,41 @@ import logging
 import boto3
 import os
 import json
+import queue
+import threading
+import time
 
-from boto3.dynamodb.conditions import Attr
+from decimal import Decimal
+
+from boto3.dynamodb.conditions import Attr, Key
 from botocore import errorfactory
 
+from .dbwrite import STATUS_ATTRIBUTE, STATUS_INDEX
+
+# Client errors a scan is retried for, all others are permanent, e.g. a missing table
+RETRIED_ERRORS = ('ProvisionedThroughputExceededException', 'ThrottlingException',
+                  'RequestLimitExceeded')
+
+FILTER_EXPRESSIONS = {
+    'discovered': Attr('retrieved_at_time').not_exists() &
+                  Attr('deleted').not_exists(),
+    'retrieved': Attr('processed_at_time').not_exists() &
+                 Attr('deleted').not_exists() &
+                 Attr('retrieved_at_time').exists(),
+    'all': None
+}
+
+
+def lastkeypath(category, step, segment=None, segments=1):
+    if segments > 1:
+        return './tmp/{}-{}-{}of{}-lastkey.tmp'.format(category, step, segment, segments)
+    return './tmp/{}-{}-lastkey.tmp'.format(category, step)
+
 
-def readlastkey(category, step):
+def readlastkey(category, step, segment=None, segments=1):
 
     try:
-        with open('./tmp/{}-{}-lastkey.tmp'.format(category, step), 'r') as f:
+        with open(lastkeypath(category, step, segment, segments), 'r') as f:
             lastkey = json.loads(f.read())
         return lastkey
 
@@ -19,68 +45,351 @@ def readlastkey(category, step):
         return lastkey
 
 
-def savelastkey(category, step, lastkey):
-    lastkeyjson = json.dumps(lastkey)
-    with open('./tmp/{}-{}-lastkey.tmp'.format(category, step), 'w') as f:
+def keydefault(value):
+    """
+    JSON encoding of the numbers boto3 returns in keys, e.g. the location ID
+    :param value: Decimal
+    :return: int or float
+    """
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError('{} is not JSON serializable'.format(type(value).__name__))
+
+
+def savelastkey(category, step, lastkey, segment=None, segments=1):
+    lastkeyjson = json.dumps(lastkey, default=keydefault)
+    with open(lastkeypath(category, step, segment, segments), 'w') as f:
         f.write(lastkeyjson)
 
+
+class FileCheckpoint():
+    """
+    FileCheckpoint keeps the LastEvaluatedKey of every segment of a scan in a file under ./tmp.
+    An empty key marks a segment that reached its end. Only the position is kept, a page that
+    was scanned but not processed before a crash is not scanned again.
+    """
+    def __init__(self, category, step):
+        """
+        :param category: 'location', 'user' or 'picture'
+        :param step: 'discovered', 'retrieved' or 'all'
+        """
+        self.category = category
+        self.step = step
+
+    def read(self, segment, segments):
+        """
+        :param segment: Number of the segment
+        :param segments: Total number of segments
+        :return: LastEvaluatedKey, {} for a completed segment, None for a new one
+        """
+        return readlastkey(self.category, self.step, segment, segments)
+
+    def save(self, segment, segments, lastkey, items):
+        """
+        Save the position after a page
+        :param segment: Number of the segment
+        :param segments: Total number of segments
+        :param lastkey: LastEvaluatedKey of the page, {} at the end of the segment
+        :param items: Items of the page
+        :return: None
+        """
+        savelastkey(self.category, self.step, lastkey, segment, segments)
+
+    def clear(self, segments):
+        """
+        Remove the positions once every segment reached its end, so the next scan starts over
+        :param segments: Total number of segments
+        :return: None
+        """
+        for segment in range(segments):
+            os.remove(lastkeypath(self.category, self.step, segment, segments))
+
+
+class ScanProgress():
+    """
+    ScanProgress counts the items of all segments of a scan, so the segments stop together
+    once the items limit is reached
+    """
+    def __init__(self, items):
+        """
+        :param items: Number of matching items after which no further pages are requested
+        """
+        self.log = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.items = items
+        self.retritem = 0
+        self.scanneditem = 0
+        self.consumedcapacity = 0
+        self.finished = set()
+        self.stopped = threading.Event()
+
+    def full(self):
+        """
+        :return: True if the items limit is reached or the consumer stopped the scan
+        """
+        with self.lock:
+            return self.retritem >= self.items or self.stopped.is_set()
+
+    def add(self, response):
+        """
+        Count a scan page
+        :param response: Response of db.scan
+        :return: None
+        """
+        with self.lock:
+            self.retritem += response['Count']
+            self.scanneditem += response['ScannedCount']
+            self.consumedcapacity += response['ConsumedCapacity']['CapacityUnits']
+            self.log.info('%s out of %s DB items received', self.retritem, self.scanneditem)
+
+
 class Search:
 
-    def __init__(self):
+    def __init__(self, segments=1):
+        """
+        :param segments: Number of segments that are scanned in parallel threads, 1 scans
+        the tables sequentially
+        """
         self.log = logging.getLogger(__name__)
+        self.segments = segments
         self.dynamo = boto3.resource('dynamodb')
         self.picdb = self.dynamo.Table('test2')
         self.locdb = self.dynamo.Table('test3')
         self.userdb = self.dynamo.Table('test4')
+        self.tables = {'picture': (self.picdb, 'shortcode'),
+                       'location': (self.locdb, 'id'),
+                       'user': (self.userdb, 'username')}
+
+    def segment_pages(self,
+                      db,
+                      key,
+                      used_filter,
+                      progress,
+                      segment=0,
+                      segments=1,
+                      checkpoint=None,
+                      retries=8):
+        """
+        Scan one segment of a table page by page until it ends or the items limit is reached.
+        The checkpoint of a page is saved before the page is handed out. A segment that
+        reached its end is added to progress.finished.
+        :param db: DynamoDB table
+        :param key: Attribute to return, None for the whole items
+        :param used_filter: 'discovered', 'retrieved' or 'all'
+        :param progress: ScanProgress shared by all segments
+        :param segment: Number of the segment
+        :param segments: Total number of segments
+        :param checkpoint: FileCheckpoint or another object with read and save, None for no
+        checkpoint
+        :param retries: Retries of a throttled page before the error is raised
+        :return: Generator of lists of items
+        """
+        if segments > 1:
+            # boto3 resources are not thread safe, every segment gets its own
+            db = boto3.session.Session().resource('dynamodb').Table(db.name)
+
+        lastkey = None
+        if checkpoint is not None:
+            lastkey = checkpoint.read(segment, segments)
+            # An empty key marks a segment that was completed in an earlier run
+            if lastkey == {}:
+                progress.finished.add(segment)
+                return
+
+        parameters = {'ReturnConsumedCapacity': 'TOTAL'}
+        if segments > 1:
+            parameters.update(Segment=segment, TotalSegments=segments)
+        if key is not None:
+            parameters['ProjectionExpression'] = key
+        if FILTER_EXPRESSIONS[used_filter] is not None:
+            parameters['FilterExpression'] = FILTER_EXPRESSIONS[used_filter]
+
+        failures = 0
+        while not progress.full():
+            if lastkey is not None:
+                parameters['ExclusiveStartKey'] = lastkey
+            try:
+                response = db.scan(**parameters)
+            except errorfactory.ClientError as error:
+                if error.response['Error']['Code'] not in RETRIED_ERRORS or failures >= retries:
+                    raise
+                failures += 1
+                self.log.warning('Segment %s of %s: %s, retry %s of %s', segment, segments,
+                                 error.response['Error']['Code'], failures, retries)
+                # The retry waits twice as long each time up to half a minute
+                time.sleep(min(0.1 * 2 ** failures, 30))
+                continue
+            failures = 0
+
+            progress.add(response)
+            lastkey = response.get('LastEvaluatedKey', {})
+            if checkpoint is not None:
+                checkpoint.save(segment, segments, lastkey, response['Items'])
+            yield response['Items']
+
+            if lastkey == {}:
+                self.log.info('Segment %s of %s: After %s scanned items. No more last keys',
+                              segment, segments, progress.scanneditem)
+                progress.finished.add(segment)
+                return
+
+    def feed_segment(self, pages, progress, segment, db, key, used_filter, checkpoint):
+        """
+        Put the pages of one segment into a queue. Runs in a thread of scan_pages.
+        :param pages: queue.Queue of lists of items, the segment number when the segment is
+        done or an exception
+        :param progress: ScanProgress shared by all segments
+        :param segment: Number of the segment
+        :param db: DynamoDB table
+        :param key: Attribute to return, None for the whole items
+        :param used_filter: 'discovered', 'retrieved' or 'all'
+        :param checkpoint: Checkpoint of the scan, None for no checkpoint
+        :return: None
+        """
+        try:
+            for page in self.segment_pages(db, key, used_filter, progress, segment,
+                                           self.segments, checkpoint):
+                while not progress.stopped.is_set():
+                    try:
+                        pages.put(page, timeout=1)
+                        break
+                    except queue.Full:
+                        continue
+            pages.put(segment)
+        except Exception as error:
+            pages.put(error)
+
+    def scan_pages(self,
+                   db,
+                   key,
+                   used_filter,
+                   items=float('inf'),
+                   category=None,
+                   checkpoint=None):
+        """
+        Scan a table with self.segments parallel segments and yield the pages as they arrive.
+        Only a few pages per segment are buffered, so the memory does not grow with the table.
+        Every segment stops after the page that reaches the items limit, so the pages can hold
+        up to one page per segment more than items.
+        :param db: DynamoDB table
+        :param key: Attribute to return, None for the whole items
+        :param used_filter: 'discovered', 'retrieved' or 'all'
+        :param items: Number of items after which the scan stops, default is all
+        :param category: Category to checkpoint every segment under ./tmp, so the next scan
+        continues where this one stopped. None scans from the start.
+        :param checkpoint: Checkpoint object instead of the files of the category, e.g. of the
+        job journal
+        :return: Generator of lists of items
+        """
+        if checkpoint is None and category is not None:
+            checkpoint = FileCheckpoint(category, used_filter)
+        progress = ScanProgress(items)
+        try:
+            if self.segments == 1:
+                yield from self.segment_pages(db, key, used_filter, progress,
+                                              checkpoint=checkpoint)
+            else:
+                pages = queue.Queue(maxsize=2 * self.segments)
+                threads = [threading.Thread(target=self.feed_segment,
+                                            args=(pages, progress, segment, db, key,
+                                                  used_filter, checkpoint),
+                                            daemon=True)
+                           for segment in range(self.segments)]
+                for thread in threads:
+                    thread.start()
+                running = self.segments
+                while running > 0:
+                    page = pages.get()
+                    if isinstance(page, Exception):
+                        raise page
+                    if isinstance(page, int):
+                        running -= 1
+                        continue
+                    yield page
+        finally:
+            progress.stopped.set()
+
+        # Start over with the next scan once every segment reached its end
+        if checkpoint is not None and len(progress.finished) == self.segments:
+            checkpoint.clear(self.segments)
+
+        self.log.info('%s items received from %s scanned in %s segments, %s capacity units',
+                      progress.retritem, progress.scanneditem, self.segments,
+                      progress.consumedcapacity)
+
+    def scan_keys(self,
+                  db,
+                  key,
+                  used_filter,
+                  items=float('inf'),
+                  category=None):
+        """
+        Generator variant of scan_key_with_filter, the items are yielded as their pages arrive
+        :param db: DynamoDB table
+        :param key: Key attribute, e.g. 'id'
+        :param used_filter: 'discovered' or 'retrieved'
+        :param items: Number of items after which the scan stops, default is all
+        :param category: Category to checkpoint the scan under, None scans from the start
+        :return: Generator of item dictionaries with the key attribute
+        """
+        for page in self.scan_pages(db, key, used_filter, items, category):
+            yield from page
+
+    def scan_segments(self,
+                      db,
+                      key,
+                      used_filter,
+                      items,
+                      category=None):
+        """
+        Scan a table with self.segments parallel segments, see scan_pages
+        :param db: DynamoDB table
+        :param key: Attribute to return, None for the whole items
+        :param used_filter: 'discovered', 'retrieved' or 'all'
+        :param items: Number of items after which the scan stops
+        :param category: Category to checkpoint every segment under, None scans from the start
+        :return: List of items
+        """
+        resultlist = []
+        for page in self.scan_pages(db, key, used_filter, items, category):
+            resultlist.extend(page)
+        return resultlist
 
     def scan_key_with_filter(self,
                              db,
                              key,
                              used_filter,
-                             items=1000):
-
-        filter_expressions = {
-            'discovered': Attr('retrieved_at_time').not_exists() &
-                          Attr('deleted').not_exists(),
-            'retrieved': Attr('processed_at_time').not_exists() &
-                         Attr('deleted').not_exists() &
-                         Attr('retrieved_at_time').exists()
-        }
-
-        resultlist = []
-        retritem = 0
-        scanneditem = 0
-        consumedcapacity = 0
-        lastkey = None
-
-        while retritem < items:
-            if lastkey != None:
-                response = db.scan(
-                    ProjectionExpression=key,
-                    FilterExpression=filter_expressions[used_filter],
-                    ReturnConsumedCapacity='TOTAL',
-                    ExclusiveStartKey=lastkey
-                )
-            if lastkey == None:
-                response = db.scan(
-                    ProjectionExpression=key,
-                    FilterExpression=filter_expressions[used_filter],
-                    ReturnConsumedCapacity='TOTAL'
-                )
-
-            resultlist.extend(response['Items'])
-            retritem += response['Count']
-            scanneditem += response['ScannedCount']
-            consumedcapacity += response['ConsumedCapacity']['CapacityUnits']
-            self.log.info('%s out of %s DB items received', retritem, scanneditem)
-
-            try:
-                lastkey = response['LastEvaluatedKey']
-            except:
-                self.log.info('After %s scanned itmens. No more last keys', scanneditem)
-                break
-
-        return resultlist
+                             items=1000,
+                             category=None):
+        """
+        Scan a table for the keys of the items of a step
+        :param db: DynamoDB table
+        :param key: Key attribute, e.g. 'id'
+        :param used_filter: 'discovered' or 'retrieved'
+        :param items: Number of items after which the scan stops
+        :param category: Category to checkpoint the scan under, None scans from the start
+        :return: List of item dictionaries with the key attribute
+        """
+        return self.scan_segments(db, key, used_filter, items, category)
+
+    def incomplete_keys(self,
+                        category,
+                        step='discovered',
+                        getitems=float('inf')):
+        """
+        Generator variant of incomplete. The scan is checkpointed under the category and step
+        and continues where the last one stopped.
+        :param category: 'location', 'user' or 'picture'
+        :param step: 'discovered', 'retrieved' or 'all'
+        :param getitems: Number of keys after which the scan stops, default is all
+        :return: Generator of keys
+        """
+        if category not in self.tables:
+            raise ValueError('Wrong category chosen')
+        db, key = self.tables[category]
+        for page in self.scan_pages(db, None, step, getitems, category):
+            for item in page:
+                yield item[key]
 
     def incomplete(self,
                    category=None,
@@ -108,6 +417,10 @@ class Search:
                  'location': 'id',
                  'user': 'username'}
 
+        if self.segments > 1:
+            itemslist = self.scan_segments(db, None, step, getitems, category)
+            return [item[dbkey[category]] for item in itemslist][:getitems]
+
         while retrieveditems < getitems:
 
             if lastkey != None:
@@ -191,4 +504,131 @@ class Search:
         for item in itemslist:
             returnlist.append(item[dbkey[category]])
 
-        return returnlist[:getitems]
\ No newline at end of file
+        return returnlist[:getitems]
+
+    def query_pending(self,
+                      category,
+                      step='discovered',
+                      items=1000):
+        """
+        Query the keys of the items of a step from the sparse status index. Only pending items
+        are in the index, so the read cost grows with the backlog and not with the table.
+        :param category: 'location', 'user' or 'picture'
+        :param step: 'discovered' or 'retrieved'
+        :param items: Number of items after which the query stops
+        :return: List of item dictionaries with the key attribute
+        """
+        resultlist = []
+        for page in self.pending_pages(category, step, items):
+            resultlist.extend(page)
+        return resultlist
+
+    def pending_pages(self,
+                      category,
+                      step='discovered',
+                      items=float('inf'),
+                      checkpoint=None):
+        """
+        Generator variant of query_pending that yields the pages as they arrive
+        :param category: 'location', 'user' or 'picture'
+        :param step: 'discovered' or 'retrieved'
+        :param items: Number of items after which the query stops, default is all
+        :param checkpoint: Optional checkpoint of the query position, see segment_pages
+        :return: Generator of lists of item dictionaries with the key attribute
+        """
+        db, key = self.tables[category]
+        received = 0
+        consumedcapacity = 0
+        parameters = {
+            'IndexName': STATUS_INDEX,
+            'KeyConditionExpression': Key(STATUS_ATTRIBUTE).eq(step),
+            'ProjectionExpression': '#k',
+            'ExpressionAttributeNames': {'#k': key},
+            'ReturnConsumedCapacity': 'TOTAL'
+        }
+
+        lastkey = None
+        if checkpoint is not None:
+            lastkey = checkpoint.read(0, 1)
+            if lastkey == {}:
+                return
+
+        while received < items:
+            if lastkey is not None:
+                parameters['ExclusiveStartKey'] = lastkey
+            if items != float('inf'):
+                parameters['Limit'] = int(items - received)
+            response = db.query(**parameters)
+            received += len(response['Items'])
+            consumedcapacity += response['ConsumedCapacity']['CapacityUnits']
+            self.log.info('%s %s %s items received', received, step, category)
+            lastkey = response.get('LastEvaluatedKey', {})
+            if checkpoint is not None:
+                checkpoint.save(0, 1, lastkey, response['Items'])
+            yield response['Items']
+            if lastkey == {}:
+                # Start over with the next query, new items may have entered the index
+                if checkpoint is not None:
+                    checkpoint.clear(1)
+                break
+
+        self.log.info('%s items received from the status index, %s capacity units',
+                      received, consumedcapacity)
+
+    def create_status_index(self, category):
+        """
+        Create the sparse status index of a table, keys only, if it does not exist
+        :param category: 'location', 'user' or 'picture'
+        :return: True if the index was created
+        """
+        db, _ = self.tables[category]
+        for index in db.global_secondary_indexes or []:
+            if index['IndexName'] == STATUS_INDEX:
+                self.log.info('%s: %s exists with status %s', db.name, STATUS_INDEX,
+                              index['IndexStatus'])
+                return False
+
+        index = {
+            'IndexName': STATUS_INDEX,
+            'KeySchema': [{'AttributeName': STATUS_ATTRIBUTE, 'KeyType': 'HASH'}],
+            'Projection': {'ProjectionType': 'KEYS_ONLY'}
+        }
+        billingmode = (db.billing_mode_summary or {}).get('BillingMode', 'PROVISIONED')
+        if billingmode == 'PROVISIONED':
+            index['ProvisionedThroughput'] = {
+                'ReadCapacityUnits': db.provisioned_throughput['ReadCapacityUnits'],
+                'WriteCapacityUnits': db.provisioned_throughput['WriteCapacityUnits']
+            }
+        db.update(
+            AttributeDefinitions=[{'AttributeName': STATUS_ATTRIBUTE, 'AttributeType': 'S'}],
+            GlobalSecondaryIndexUpdates=[{'Create': index}]
+        )
+        self.log.info('%s: %s is being created', db.name, STATUS_INDEX)
+        return True
+
+    def backfill_status(self, category):
+        """
+        Set the pipeline status of the pending items that were written before the status
+        existed. Each update is conditional on the item still being pending.
+        :param category: 'location', 'user' or 'picture'
+        :return: Dictionary of step -> number of items set
+        """
+        db, key = self.tables[category]
+        counts = {}
+        for step in ('discovered', 'retrieved'):
+            counts[step] = 0
+            for item in self.scan_segments(db, key, step, float('inf')):
+                try:
+                    db.update_item(
+                        Key={key: item[key]},
+                        UpdateExpression='SET #status = :status',
+                        ConditionExpression=FILTER_EXPRESSIONS[step],
+                        ExpressionAttributeNames={'#status': STATUS_ATTRIBUTE},
+                        ExpressionAttributeValues={':status': step}
+                    )
+                    counts[step] += 1
+                except errorfactory.ClientError as error:
+                    if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                        raise
+            self.log.info('%s: %s %s items set', db.name, counts[step], step)
+        return counts
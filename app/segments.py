@@ -0,0 +1,315 @@
+"""
+The segments module packs many JSON records into rolling segment files, so the archive needs
+one S3 PUT per segment instead of one per item. Each segment has an index with the offset of
+every record, which allows reading a single record with a ranged GET.
+
+A segment is a sequence of frames: a header with the length of the key and of the record,
+the key as UTF-8 and the record as encoded by storage.encoderecord. The index file has one
+JSON line per record with key, offset and length of the frame.
+"""
+import json
+import logging
+import os
+import struct
+import threading
+import time
+
+from .storage import decoderecord, encoderecord
+
+
+FRAME_HEADER = struct.Struct('>HI')
+
+
+def pidalive(pid):
+    """
+    Checks if a process is still running
+    :param pid: Process ID
+    :return: True if the process exists
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SegmentWriter():
+    """
+    SegmentWriter appends records to the current segment of a category and uploads the segment
+    with its index when it reaches the size or age threshold. Segments are written to an 'open'
+    directory and moved next to the uploaded segments afterwards. Segments left open by a
+    process that ended are uploaded by the next writer for the same directory.
+    """
+    def __init__(self,
+                 directory,
+                 category,
+                 s3_link,
+                 s3_directory,
+                 bucket='gvbinsta-test',
+                 max_bytes=64 * 1024 * 1024,
+                 max_age=300,
+                 codec='plain',
+                 dictionary=None):
+        """
+        :param directory: Local directory of the segments
+        :param category: 'location', 'user' or 'picture', used in the segment names
+        :param s3_link: S3 connection
+        :param s3_directory: S3 directory of the segments
+        :param bucket: S3 bucket
+        :param max_bytes: Segment size after which the segment is uploaded
+        :param max_age: Seconds after which a segment is uploaded with the next record
+        :param codec: Codec of the records, see storage.encoderecord
+        :param dictionary: Optional zstd dictionary for the zstd codec
+        """
+        self.log = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.directory = directory
+        self.opendirectory = os.path.join(directory, 'open')
+        self.category = category
+        self.s3_link = s3_link
+        self.s3_directory = s3_directory
+        self.bucket = bucket
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.codec = codec
+        self.dictionary = dictionary
+        self.sequence = 0
+        self.segment = None
+        self.segmentfile = None
+        self.indexfile = None
+        self.size = 0
+        self.opened_at = 0
+
+        if not os.path.exists(self.opendirectory):
+            os.makedirs(self.opendirectory)
+        self.recover()
+
+    def recover(self):
+        """
+        Upload segments that were left open by processes that are no longer running, e.g. the
+        finished workers of a process pool. The current segment of this writer stays open.
+        :return: None
+        """
+        with self.lock:
+            for filename in sorted(os.listdir(self.opendirectory)):
+                if not filename.endswith('.seg'):
+                    continue
+                segment = filename[:-len('.seg')]
+                pid = int(segment.split('-')[2])
+                if segment == self.segment or (pid != os.getpid() and pidalive(pid)):
+                    continue
+                self.log.info('Recovering segment %s', segment)
+                self.upload(segment)
+
+    def append(self, keyid, retrieved_at_time, payload):
+        """
+        Append a record to the current segment
+        :param keyid: Key of the record, e.g. the shortcode
+        :param retrieved_at_time: Retrieval time as unix timestamp
+        :param payload: The JSON as bytes or string
+        :return: Tuple of segment name, offset and length of the frame
+        """
+        record = encoderecord(retrieved_at_time, payload, self.codec, self.dictionary)
+        key = str(keyid).encode('utf-8')
+        frame = FRAME_HEADER.pack(len(key), len(record)) + key + record
+
+        with self.lock:
+            if self.segment is None:
+                self.open()
+            segment = self.segment
+            offset = self.size
+            self.segmentfile.write(frame)
+            self.segmentfile.flush()
+            # The index line is written after the frame, so it never points to a partial frame
+            self.indexfile.write(json.dumps({'key': str(keyid),
+                                             'offset': offset,
+                                             'length': len(frame)}) + '\n')
+            self.indexfile.flush()
+            self.size += len(frame)
+
+            if self.size >= self.max_bytes or time.time() - self.opened_at >= self.max_age:
+                self.seal()
+
+        return segment, offset, len(frame)
+
+    def open(self):
+        """
+        Open a new segment. Must be called with the lock held.
+        :return: None
+        """
+        self.sequence += 1
+        self.segment = '{}-{}-{}-{}'.format(self.category, int(time.time()), os.getpid(),
+                                            self.sequence)
+        self.segmentfile = open(os.path.join(self.opendirectory, self.segment + '.seg'), 'wb')
+        self.indexfile = open(os.path.join(self.opendirectory, self.segment + '.idx'), 'w')
+        self.size = 0
+        self.opened_at = time.time()
+
+    def seal(self):
+        """
+        Close and upload the current segment. Must be called with the lock held.
+        :return: None
+        """
+        self.segmentfile.close()
+        self.indexfile.close()
+        segment = self.segment
+        self.segment = None
+        self.segmentfile = None
+        self.indexfile = None
+        self.upload(segment)
+
+    def upload(self, segment):
+        """
+        Upload a closed segment with its index and move it out of the open directory
+        :param segment: Segment name
+        :return: None
+        """
+        for extension in ['.seg', '.idx']:
+            openpath = os.path.join(self.opendirectory, segment + extension)
+            if not os.path.exists(openpath):
+                continue
+            self.s3_link.upload_file(openpath, self.bucket,
+                                     '{}/{}{}'.format(self.s3_directory, segment, extension))
+            os.replace(openpath, os.path.join(self.directory, segment + extension))
+        self.log.info('Segment %s uploaded', segment)
+
+    def close(self):
+        """
+        Upload the current segment, if there is one
+        :return: None
+        """
+        with self.lock:
+            if self.segment is not None:
+                self.seal()
+
+
+class SegmentReader():
+    """
+    SegmentReader reads single records from segments, either from the local segment files or
+    with ranged GETs from S3
+    """
+    def __init__(self,
+                 directory=None,
+                 s3_link=None,
+                 s3_directory=None,
+                 bucket='gvbinsta-test',
+                 dictionary=None):
+        """
+        :param directory: Local directory of the segments, None to read from S3 only
+        :param s3_link: Optional S3 connection for segments that are not available locally
+        :param s3_directory: S3 directory of the segments
+        :param bucket: S3 bucket
+        :param dictionary: The zstd dictionary the records were compressed with
+        """
+        self.directory = directory
+        self.s3_link = s3_link
+        self.s3_directory = s3_directory
+        self.bucket = bucket
+        self.dictionary = dictionary
+        self.indexes = {}
+        self.catalog = None
+
+    def segments(self):
+        """
+        Names of the local segments, oldest first
+        :return: List of segment names
+        """
+        names = [filename[:-len('.idx')] for filename in os.listdir(self.directory)
+                 if filename.endswith('.idx')]
+        return sorted(names, key=lambda name: (int(name.split('-')[1]), name))
+
+    def index(self, segment):
+        """
+        The index of a segment
+        :param segment: Segment name
+        :return: Dictionary of key -> (offset, length)
+        """
+        if segment not in self.indexes:
+            if self.directory is not None and \
+                    os.path.exists(os.path.join(self.directory, segment + '.idx')):
+                with open(os.path.join(self.directory, segment + '.idx'), 'r') as file:
+                    lines = file.read().splitlines()
+            else:
+                response = self.s3_link.get_object(
+                    Bucket=self.bucket, Key='{}/{}.idx'.format(self.s3_directory, segment))
+                lines = response['Body'].read().decode('utf-8').splitlines()
+            index = {}
+            for line in lines:
+                entry = json.loads(line)
+                index[entry['key']] = (entry['offset'], entry['length'])
+            self.indexes[segment] = index
+        return self.indexes[segment]
+
+    def readframe(self, segment, offset, length):
+        """
+        Read one frame of a segment
+        :param segment: Segment name
+        :param offset: Offset of the frame
+        :param length: Length of the frame
+        :return: Tuple of key and the record as bytes
+        """
+        localpath = None
+        if self.directory is not None:
+            localpath = os.path.join(self.directory, segment + '.seg')
+        if localpath is not None and os.path.exists(localpath):
+            with open(localpath, 'rb') as file:
+                file.seek(offset)
+                frame = file.read(length)
+        else:
+            response = self.s3_link.get_object(
+                Bucket=self.bucket,
+                Key='{}/{}.seg'.format(self.s3_directory, segment),
+                Range='bytes={}-{}'.format(offset, offset + length - 1))
+            frame = response['Body'].read()
+
+        keylength, recordlength = FRAME_HEADER.unpack_from(frame)
+        start = FRAME_HEADER.size
+        key = frame[start:start + keylength].decode('utf-8')
+        return key, frame[start + keylength:start + keylength + recordlength]
+
+    def read(self, segment, keyid):
+        """
+        Read the record of a key from a segment
+        :param segment: Segment name
+        :param keyid: Key of the record
+        :return: Tuple of retrieval time as int and the JSON as bytes
+        """
+        offset, length = self.index(segment)[str(keyid)]
+        _, record = self.readframe(segment, offset, length)
+        return decoderecord(record, self.dictionary)
+
+    def lookup(self, keyid):
+        """
+        Read the latest record of a key from all local segments
+        :param keyid: Key of the record
+        :return: Tuple of retrieval time as int and the JSON as bytes
+        """
+        if self.catalog is None:
+            self.catalog = {}
+            for segment in self.segments():
+                for key in self.index(segment):
+                    self.catalog[key] = segment
+        if str(keyid) not in self.catalog:
+            raise KeyError(keyid)
+        return self.read(self.catalog[str(keyid)], keyid)
+
+    def records(self, segment):
+        """
+        Iterate over all records of a segment in file order
+        :param segment: Segment name
+        :return: Generator of (key, retrieval time, JSON as bytes)
+        """
+        with open(os.path.join(self.directory, segment + '.seg'), 'rb') as file:
+            while True:
+                header = file.read(FRAME_HEADER.size)
+                if len(header) < FRAME_HEADER.size:
+                    break
+                keylength, recordlength = FRAME_HEADER.unpack(header)
+                key = file.read(keylength).decode('utf-8')
+                record = file.read(recordlength)
+                if len(record) < recordlength:
+                    break
+                retrieved_at_time, payload = decoderecord(record, self.dictionary)
+                yield key, retrieved_at_time, payload
@@ -0,0 +1,137 @@
+"""
+The session module keeps persistent keep-alive HTTP sessions per proxy and user agent, so
+connections and TLS handshakes through a proxy are reused between requests.
+"""
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+
+import requests
+
+
+class SessionPool():
+    """
+    SessionPool hands out one requests.Session per (proxy, user agent) pair. Each session keeps
+    a pool of keep-alive connections. Sessions that were idle for too long are closed.
+    """
+    def __init__(self,
+                 pool_maxsize=10,
+                 max_sessions=300,
+                 idle_timeout=300):
+        """
+        :param pool_maxsize: Maximum number of keep-alive connections per host and session
+        :param max_sessions: Maximum number of open sessions, the least recently used is closed
+        :param idle_timeout: Seconds after which an unused session is closed
+        """
+        self.log = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.pool_maxsize = pool_maxsize
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions = OrderedDict()
+        self.last_used = {}
+        self.last_eviction = time.time()
+        self.evicted = 0
+
+    def new_session(self):
+        """
+        Create a session with a connection pool of the configured size
+        :return: requests.Session
+        """
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_maxsize,
+                                                pool_maxsize=self.pool_maxsize)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def get(self, chosenproxy):
+        """
+        Returns the session for a proxy and user agent
+        :param chosenproxy: Tuple of proxy and user agent, None if no proxy is used
+        :return: requests.Session
+        """
+        now = time.time()
+        with self.lock:
+            if now - self.last_eviction > self.idle_timeout / 10:
+                self.evict_idle(now)
+
+            if chosenproxy in self.sessions:
+                self.sessions.move_to_end(chosenproxy)
+            else:
+                self.sessions[chosenproxy] = self.new_session()
+                if len(self.sessions) > self.max_sessions:
+                    oldest, session = self.sessions.popitem(last=False)
+                    self.close_session(oldest, session)
+            self.last_used[chosenproxy] = now
+
+            return self.sessions[chosenproxy]
+
+    def evict_idle(self, now):
+        """
+        Close all sessions that were not used within the idle timeout. Must be called with the
+        lock held.
+        :param now: Current time
+        :return: None
+        """
+        self.last_eviction = now
+        for key in list(self.sessions):
+            if now - self.last_used[key] > self.idle_timeout:
+                self.close_session(key, self.sessions.pop(key))
+
+    def close_session(self, key, session):
+        """
+        Close a session and forget its last usage
+        :param key: Tuple of proxy and user agent
+        :param session: requests.Session
+        :return: None
+        """
+        self.log.debug('Closing idle session for %s', key)
+        del self.last_used[key]
+        session.close()
+        self.evicted += 1
+
+    def close(self):
+        """
+        Close all sessions
+        :return: None
+        """
+        with self.lock:
+            for key in list(self.sessions):
+                self.close_session(key, self.sessions.pop(key))
+
+    def stats(self):
+        """
+        Connection reuse statistics. Every request that did not need a new connection reused a
+        keep-alive connection.
+        :return: Dictionary with the statistics per (proxy, user agent) and the totals
+        """
+        perkey = {}
+        totalrequests = 0
+        totalconnections = 0
+        with self.lock:
+            for key, session in self.sessions.items():
+                requestcount = 0
+                connectioncount = 0
+                for adapter in set(session.adapters.values()):
+                    managers = [adapter.poolmanager] + list(adapter.proxy_manager.values())
+                    for manager in managers:
+                        for poolkey in list(manager.pools.keys()):
+                            pool = manager.pools.get(poolkey)
+                            if pool is None:
+                                continue
+                            requestcount += pool.num_requests
+                            connectioncount += pool.num_connections
+                perkey[key] = {'requests': requestcount,
+                               'connections': connectioncount,
+                               'reused': requestcount - connectioncount}
+                totalrequests += requestcount
+                totalconnections += connectioncount
+
+        return {'sessions': perkey,
+                'requests': totalrequests,
+                'connections': totalconnections,
+                'reused': totalrequests - totalconnections,
+                'evicted': self.evicted}
@@ -0,0 +1,159 @@
+"""
+The storage module reads and writes the raw JSON records. A record is the retrieval timestamp
+and the JSON, separated by a newline, stored plain, gzip or zstd compressed. The format is
+detected from the content, so existing plain files stay readable.
+"""
+import gzip
+import os
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+EXTENSIONS = {
+    'plain': '.json',
+    'gzip': '.json.gz',
+    'zstd': '.json.zst'
+}
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def requirezstd():
+    """
+    Raises an ImportError if the zstandard package is missing
+    :return: None
+    """
+    if zstandard is None:
+        raise ImportError('The zstd codec needs the zstandard package: pip install zstandard')
+
+
+def loaddictionary(path):
+    """
+    Load a trained zstd dictionary
+    :param path: File written by train_dictionary
+    :return: zstandard.ZstdCompressionDict, None if path is None
+    """
+    if path is None:
+        return None
+    requirezstd()
+    with open(path, 'rb') as file:
+        return zstandard.ZstdCompressionDict(file.read())
+
+
+def train_dictionary(paths, output, size=112640):
+    """
+    Train a zstd dictionary on existing JSON records. Records of one category share most of
+    their structure, so a dictionary helps a lot with small records.
+    :param paths: Paths of JSON records in any format
+    :param output: File the dictionary is written to
+    :param size: Maximum size of the dictionary in bytes
+    :return: Number of samples used
+    """
+    requirezstd()
+    samples = []
+    for path in paths:
+        with open(path, 'rb') as file:
+            samples.append(decoderecord(file.read())[1])
+    dictionary = zstandard.train_dictionary(size, samples)
+    with open(output, 'wb') as file:
+        file.write(dictionary.as_bytes())
+    return len(samples)
+
+
+def encoderecord(retrieved_at_time, payload, codec='plain', dictionary=None, level=3):
+    """
+    Encode a record
+    :param retrieved_at_time: Retrieval time as unix timestamp
+    :param payload: The JSON as bytes or string
+    :param codec: 'plain', 'gzip' or 'zstd'
+    :param dictionary: Optional zstandard.ZstdCompressionDict for the zstd codec
+    :param level: Compression level
+    :return: The encoded record as bytes
+    """
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    record = str(retrieved_at_time).encode('utf-8') + b'\n' + payload
+
+    if codec == 'plain':
+        return record
+    if codec == 'gzip':
+        return gzip.compress(record, compresslevel=level)
+    if codec == 'zstd':
+        requirezstd()
+        compressor = zstandard.ZstdCompressor(level=level, dict_data=dictionary)
+        return compressor.compress(record)
+    raise ValueError('Unknown codec {}'.format(codec))
+
+
+def decoderecord(data, dictionary=None):
+    """
+    Decode a record in any of the formats
+    :param data: The stored record as bytes
+    :param dictionary: The zstandard.ZstdCompressionDict the record was compressed with
+    :return: Tuple of retrieval time as int and the JSON as bytes
+    """
+    if data[:2] == GZIP_MAGIC:
+        data = gzip.decompress(data)
+    elif data[:4] == ZSTD_MAGIC:
+        requirezstd()
+        decompressor = zstandard.ZstdDecompressor(dict_data=dictionary)
+        data = decompressor.decompress(data)
+
+    retrieved_at_time, payload = data.split(b'\n', 1)
+    return int(retrieved_at_time), payload
+
+
+def recordpath(file_directory, keyid, codec='plain'):
+    """
+    Path of a record
+    :param file_directory: Directory of the records
+    :param keyid: Key ID for the file name
+    :param codec: 'plain', 'gzip' or 'zstd'
+    :return: Path
+    """
+    return '{}/{}{}'.format(file_directory, keyid, EXTENSIONS[codec])
+
+
+def writerecord(file_directory, keyid, retrieved_at_time, payload, codec='plain',
+                dictionary=None):
+    """
+    Write a record and remove records of the same key in other formats
+    :param file_directory: Directory of the records
+    :param keyid: Key ID for the file name
+    :param retrieved_at_time: Retrieval time as unix timestamp
+    :param payload: The JSON as bytes or string
+    :param codec: 'plain', 'gzip' or 'zstd'
+    :param dictionary: Optional zstandard.ZstdCompressionDict for the zstd codec
+    :return: Path of the written record
+    """
+    if not os.path.exists(file_directory):
+        os.makedirs(file_directory)
+    path = recordpath(file_directory, keyid, codec)
+    with open(path, 'wb') as file:
+        file.write(encoderecord(retrieved_at_time, payload, codec, dictionary))
+
+    for othercodec in EXTENSIONS:
+        if othercodec != codec and os.path.exists(recordpath(file_directory, keyid, othercodec)):
+            os.remove(recordpath(file_directory, keyid, othercodec))
+    return path
+
+
+def readrecord(file_directory, keyid, dictionary=None):
+    """
+    Read the record of a key in whichever format it was written
+    :param file_directory: Directory of the records
+    :param keyid: Key ID for the file name
+    :param dictionary: The zstandard.ZstdCompressionDict the records were compressed with
+    :return: Tuple of retrieval time as int and the JSON as bytes
+    """
+    for codec in ['zstd', 'gzip', 'plain']:
+        try:
+            with open(recordpath(file_directory, keyid, codec), 'rb') as file:
+                return decoderecord(file.read(), dictionary)
+        except FileNotFoundError:
+            continue
+    raise FileNotFoundError('No record for {} in {}'.format(keyid, file_directory))
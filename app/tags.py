@@ -0,0 +1,94 @@
+"""
+The tags module finds hashtags and user mentions in captions and comments. All texts of a post
+are tokenized in one pass with one compiled pattern. Tags are normalized with NFKC and
+casefolded, so '#Zürich', '#ZÜRICH' and '#Ｚürich' count as the same tag, and interned, so the
+many repetitions of popular tags share one string. batch_tags tokenizes many posts with one
+cache of the normalized tags, so a popular tag is casefolded and interned only once.
+"""
+import re
+import sys
+import unicodedata
+
+
+# A hashtag ends at the first character that is not a letter, digit or underscore. A mention
+# may contain dots, but not at its end, and is not part of an e-mail address.
+TAG_PATTERN = re.compile(r'#(\w+)|(?<![\w.])@([\w.]*\w)')
+
+TEXT_EDGES = ['edge_media_to_caption', 'edge_media_to_comment']
+
+
+def normalize(tag, cache=None):
+    """
+    Normalized form of a tag
+    :param tag: Tag without '#' or '@'
+    :param cache: Optional dictionary of tag -> normalized tag shared between calls
+    :return: Interned, casefolded tag
+    """
+    if cache is None:
+        return sys.intern(tag.casefold())
+    normalized = cache.get(tag)
+    if normalized is None:
+        normalized = cache[tag] = sys.intern(tag.casefold())
+    return normalized
+
+
+def tokenize(texts, cache=None):
+    """
+    Find the hashtags and mentions in a number of texts
+    :param texts: Iterable of strings
+    :param cache: Optional dictionary of tag -> normalized tag, see normalize
+    :return: Tuple of the set of hashtags and the set of mentions, without '#' and '@'
+    """
+    hashtags = set()
+    mentions = set()
+    for text in texts:
+        # ASCII is already in NFKC, full width '＃' and '＠' become '#' and '@'
+        if not text.isascii():
+            text = unicodedata.normalize('NFKC', text)
+        for hashtag, mention in TAG_PATTERN.findall(text):
+            if hashtag:
+                hashtags.add(normalize(hashtag, cache))
+            else:
+                mentions.add(normalize(mention, cache))
+    return hashtags, mentions
+
+
+def post_texts(datastore, categories=None):
+    """
+    The caption and comment texts of a post
+    :param datastore: The shortcode_media GraphQL data of a post
+    :param categories: Edges to read, default is caption and comments
+    :return: Generator of strings
+    """
+    for category in categories or TEXT_EDGES:
+        for edge in datastore[category]['edges']:
+            text = edge['node']['text']
+            if text:
+                yield text
+
+
+def post_tags(datastore, cache=None):
+    """
+    The hashtags and mentions of a post
+    :param datastore: The shortcode_media GraphQL data of a post
+    :param cache: Optional dictionary of tag -> normalized tag, see normalize
+    :return: Tuple of the set of hashtags and the set of mentions
+    """
+    return tokenize(post_texts(datastore), cache)
+
+
+def batch_tags(datastores):
+    """
+    The hashtags and mentions of many posts, tokenized with one shared cache
+    :param datastores: Iterable of shortcode_media GraphQL data
+    :return: List of (hashtags, mentions) tuples in the order of the posts, None for a post
+    without caption or comment edges
+    """
+    cache = {}
+    tags = []
+    for datastore in datastores:
+        try:
+            tags.append(post_tags(datastore, cache))
+        except (KeyError, TypeError):
+            tags.append(None)
+    return tags
@@ -0,0 +1,235 @@
+"""
+The timeseries module keeps the weekly snapshots of locations and users in local append-only
+files instead of one DynamoDB item per snapshot. Growth curves are read with mmap, without a
+table scan, and the snapshots can be synced to DynamoDB in batches.
+
+A series has two files. The keys file has one entity key per line, the line number is the
+entity number. The data file has fixed size records: entity number, offset of the previous
+record of the entity, and the snapshot time and metric values as differences to the previous
+record of the entity. The records of an entity form a chain, which is followed backwards from
+the last record.
+"""
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+
+
+SERIES = {
+    'location': ['media_count'],
+    'user': ['id', 'follow_count', 'followed_by_count', 'posts_count']
+}
+
+
+class TimeSeries():
+    """
+    TimeSeries is one series of snapshots, e.g. of all locations. Several processes can append
+    to the same series, writes are serialized with a file lock.
+    """
+    def __init__(self, directory, series, metrics=None):
+        """
+        :param directory: Directory of the series files
+        :param series: Name of the series, e.g. 'location'
+        :param metrics: Names of the integer metrics, default is SERIES[series]
+        """
+        self.log = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.series = series
+        self.metrics = metrics or SERIES[series]
+        self.record = struct.Struct('<Iqq' + 'q' * len(self.metrics))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.datapath = os.path.join(directory, '{}.ts'.format(series))
+        self.keyspath = os.path.join(directory, '{}.keys'.format(series))
+        self.syncpath = os.path.join(directory, '{}.synced'.format(series))
+        self.datafile = open(self.datapath, 'ab')
+        self.keysfile = open(self.keyspath, 'ab')
+        self.keys = []
+        self.numbers = {}
+        self.last = {}
+        self.size = 0
+        self.keysize = 0
+        self.map = None
+        with self.lock:
+            self.refresh()
+
+    def refresh(self):
+        """
+        Read the records and keys that were appended since the last refresh, also by other
+        processes. Must be called with the lock held.
+        :return: None
+        """
+        with open(self.datapath, 'rb') as file:
+            file.seek(self.size)
+            data = file.read()
+        # The keys are read after the records, so every record refers to a known key
+        with open(self.keyspath, 'rb') as file:
+            file.seek(self.keysize)
+            keys = file.read()
+
+        keys = keys[:keys.rfind(b'\n') + 1]
+        for line in keys.splitlines():
+            self.numbers[line.decode('utf-8')] = len(self.keys)
+            self.keys.append(line.decode('utf-8'))
+        self.keysize += len(keys)
+
+        complete = len(data) - len(data) % self.record.size
+        for position in range(0, complete, self.record.size):
+            number, _, timedelta, *deltas = self.record.unpack_from(data, position)
+            _, at_time, values = self.last.get(number, (-1, 0, [0] * len(self.metrics)))
+            self.last[number] = (self.size + position, at_time + timedelta,
+                                 [value + delta for value, delta in zip(values, deltas)])
+        self.size += complete
+
+    def append(self, key, at_time, values):
+        """
+        Append a snapshot
+        :param key: Key of the entity, e.g. the location ID
+        :param at_time: Snapshot time as unix timestamp
+        :param values: Dictionary of metric -> integer value
+        :return: None
+        """
+        key = str(key)
+        values = [int(values[metric]) for metric in self.metrics]
+        with self.lock:
+            fcntl.flock(self.datafile, fcntl.LOCK_EX)
+            try:
+                self.refresh()
+                if key not in self.numbers:
+                    self.keysfile.write(key.encode('utf-8') + b'\n')
+                    self.keysfile.flush()
+                    self.refresh()
+                number = self.numbers[key]
+                offset, previoustime, previousvalues = self.last.get(
+                    number, (-1, 0, [0] * len(self.metrics)))
+                self.datafile.write(self.record.pack(
+                    number, offset, int(at_time) - previoustime,
+                    *[value - previous for value, previous in zip(values, previousvalues)]))
+                self.datafile.flush()
+                self.last[number] = (self.size, int(at_time), values)
+                self.size += self.record.size
+            finally:
+                fcntl.flock(self.datafile, fcntl.LOCK_UN)
+
+    def mapped(self):
+        """
+        Memory map of the data file that covers all known records. Must be called with the
+        lock held.
+        :return: mmap.mmap
+        """
+        if self.map is None or len(self.map) < self.size:
+            if self.map is not None:
+                self.map.close()
+            with open(self.datapath, 'rb') as file:
+                self.map = mmap.mmap(file.fileno(), self.size, access=mmap.ACCESS_READ)
+        return self.map
+
+    def points(self, key, start=None, end=None):
+        """
+        Snapshots of an entity within a time range
+        :param key: Key of the entity
+        :param start: Optional first snapshot time as unix timestamp
+        :param end: Optional last snapshot time as unix timestamp
+        :return: List of (snapshot time, dictionary of metric -> value), oldest first
+        """
+        with self.lock:
+            self.refresh()
+            number = self.numbers.get(str(key))
+            if number is None or number not in self.last:
+                return []
+            offset, at_time, values = self.last[number]
+            view = self.mapped()
+
+            points = []
+            while offset >= 0:
+                _, previousoffset, timedelta, *deltas = self.record.unpack_from(view, offset)
+                if (start is None or at_time >= start) and (end is None or at_time <= end):
+                    points.append((at_time, dict(zip(self.metrics, values))))
+                at_time -= timedelta
+                values = [value - delta for value, delta in zip(values, deltas)]
+                offset = previousoffset
+
+        # Snapshots of concurrent writers may be appended slightly out of order
+        points.sort(key=lambda point: point[0])
+        return points
+
+    def growth(self, key, metric, start=None, end=None):
+        """
+        Growth of a metric of an entity within a time range
+        :param key: Key of the entity
+        :param metric: Metric name, e.g. 'followed_by_count'
+        :param start: Optional start as unix timestamp
+        :param end: Optional end as unix timestamp
+        :return: Dictionary with first and last time and value, change, relative rate and
+        change per day, None with less than two snapshots
+        """
+        points = self.points(key, start, end)
+        if len(points) < 2:
+            return None
+        (firsttime, first), (lasttime, last) = points[0], points[-1]
+        change = last[metric] - first[metric]
+        return {
+            'first_time': firsttime,
+            'last_time': lasttime,
+            'first': first[metric],
+            'last': last[metric],
+            'change': change,
+            'rate': change / first[metric] if first[metric] != 0 else None,
+            'per_day': change / ((lasttime - firsttime) / 86400) if lasttime > firsttime else None
+        }
+
+    def sync(self, table, keyname, keytype=str):
+        """
+        Write the snapshots that were not synced yet to DynamoDB with batch writes
+        :param table: DynamoDB table resource, e.g. test3-1
+        :param keyname: Name of the key attribute, e.g. 'id'
+        :param keytype: Type of the key attribute, e.g. int
+        :return: Number of snapshots written
+        """
+        try:
+            with open(self.syncpath, 'r') as file:
+                synced = int(file.read())
+        except (FileNotFoundError, ValueError):
+            synced = 0
+
+        with self.lock:
+            self.refresh()
+            size = self.size
+        with open(self.datapath, 'rb') as file:
+            view = file.read(size)
+
+        # The absolute values are the sums of the differences from the first record on
+        current = {}
+        written = 0
+        with table.batch_writer() as batch:
+            for offset in range(0, size, self.record.size):
+                number, _, timedelta, *deltas = self.record.unpack_from(view, offset)
+                at_time, values = current.get(number, (0, [0] * len(self.metrics)))
+                at_time += timedelta
+                values = [value + delta for value, delta in zip(values, deltas)]
+                current[number] = (at_time, values)
+                if offset < synced:
+                    continue
+                item = {keyname: keytype(self.keys[number]), 'at_time': at_time}
+                item.update(zip(self.metrics, values))
+                batch.put_item(Item=item)
+                written += 1
+
+        with open(self.syncpath, 'w') as file:
+            file.write(str(size))
+        self.log.info('%s: %s snapshots synced to %s', self.series, written, table.name)
+        return written
+
+    def close(self):
+        """
+        Close the files
+        :return: None
+        """
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+            self.datafile.close()
+            self.keysfile.close()
@@ -0,0 +1,393 @@
+"""
+The workqueue module is a durable work queue in an embedded SQLite database, shared by all
+runners on the same host. The queue is filled from the Search results and hands the keys out
+as leases: a leased key is invisible to the other runners until it is acknowledged or its
+visibility timeout expires, e.g. because the runner crashed. A key is queued only once, so
+several runners can work on the same backlog without overlap. The leases of the keys a runner still
+works on are renewed in the background, so a slow key does not time out while it is in flight.
+
+Only one runner fills a queue at a time. The position of its scan is kept in the queue
+database, so the next fill continues where the last one stopped, also from another runner.
+"""
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from .search import keydefault
+
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS jobs ('
+    'queue TEXT NOT NULL, key TEXT NOT NULL, state TEXT NOT NULL, owner TEXT, '
+    'lease_until INTEGER, attempts INTEGER NOT NULL DEFAULT 0, error TEXT, '
+    'updated_at INTEGER NOT NULL, PRIMARY KEY (queue, key)) WITHOUT ROWID',
+    'CREATE INDEX IF NOT EXISTS jobs_state ON jobs (queue, state, lease_until)',
+    'CREATE TABLE IF NOT EXISTS fills ('
+    'queue TEXT NOT NULL PRIMARY KEY, owner TEXT NOT NULL, until INTEGER NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS cursors ('
+    'queue TEXT NOT NULL, segment INTEGER NOT NULL, segments INTEGER NOT NULL, '
+    'lastkey TEXT NOT NULL, PRIMARY KEY (queue, segment, segments)) WITHOUT ROWID'
+]
+
+
+class QueueCheckpoint():
+    """
+    QueueCheckpoint is the position of the scan that fills a queue, see Search.scan_pages
+    """
+    def __init__(self, workqueue, queue):
+        """
+        :param workqueue: WorkQueue
+        :param queue: Name of the queue, e.g. 'location-discovered'
+        """
+        self.workqueue = workqueue
+        self.queue = queue
+        self.cleared = False
+
+    def read(self, segment, segments):
+        """
+        :param segment: Number of the segment
+        :param segments: Total number of segments
+        :return: LastEvaluatedKey, {} for a completed segment, None for a new one
+        """
+        with self.workqueue.lock:
+            row = self.workqueue.connect().execute(
+                'SELECT lastkey FROM cursors WHERE queue = ? AND segment = ? AND segments = ?',
+                (self.queue, segment, segments)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def save(self, segment, segments, lastkey, items):
+        """
+        Save the position after a page
+        :param segment: Number of the segment
+        :param segments: Total number of segments
+        :param lastkey: LastEvaluatedKey of the page, {} at the end of the segment
+        :param items: Items of the page, they are queued by WorkQueue.fill
+        :return: None
+        """
+        with self.workqueue.lock:
+            connection = self.workqueue.connect()
+            connection.execute(
+                'INSERT OR REPLACE INTO cursors (queue, segment, segments, lastkey) '
+                'VALUES (?, ?, ?, ?)',
+                (self.queue, segment, segments, json.dumps(lastkey, default=keydefault)))
+            connection.commit()
+
+    def clear(self, segments):
+        """
+        Remove the positions once every segment reached its end, so the next fill starts over
+        :param segments: Total number of segments
+        :return: None
+        """
+        with self.workqueue.lock:
+            connection = self.workqueue.connect()
+            connection.execute('DELETE FROM cursors WHERE queue = ?', (self.queue,))
+            connection.commit()
+        self.cleared = True
+
+
+class WorkQueue():
+    """
+    WorkQueue holds one queue per category and step, e.g. 'location-discovered'. Leasing and
+    acknowledging can happen from different threads, the connection is shared under a lock.
+    """
+    def __init__(self,
+                 path='./tmp/workqueue.sqlite',
+                 visibility_timeout=600,
+                 max_attempts=3,
+                 retention=86400):
+        """
+        :param path: Path of the SQLite database
+        :param visibility_timeout: Seconds a leased key stays invisible to the other runners
+        after its lease or last renewal
+        :param max_attempts: Leases of a key before it is given up as failed
+        :param retention: Seconds finished keys are kept, a kept key is not queued again
+        """
+        self.log = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self.owner = '{}-{}'.format(socket.gethostname(), os.getpid())
+        self.connection = None
+        self.pid = None
+        # Keys leased by this runner and not yet acknowledged, queue -> set of keys
+        self.inflight = {}
+        self.renewal = None
+        self.stopped = threading.Event()
+        directory = os.path.dirname(path)
+        if directory != '' and not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def connect(self):
+        """
+        Returns the SQLite connection of this process
+        :return: sqlite3.Connection
+        """
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False,
+                                              isolation_level=None)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+            self.pid = os.getpid()
+        return self.connection
+
+    def put(self, queue, keys):
+        """
+        Queue keys. Keys that are queued, leased or were finished within the retention are
+        skipped.
+        :param queue: Name of the queue
+        :param keys: Keys as strings
+        :return: Number of keys queued
+        """
+        now = int(time.time())
+        with self.lock:
+            connection = self.connect()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                before = connection.total_changes
+                connection.executemany(
+                    'INSERT OR IGNORE INTO jobs (queue, key, state, updated_at) '
+                    'VALUES (?, ?, \'ready\', ?)', [(queue, key, now) for key in keys])
+                added = connection.total_changes - before
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+        return added
+
+    def lease(self, queue, count):
+        """
+        Lease ready keys and keys whose lease expired
+        :param queue: Name of the queue
+        :param count: Maximum number of keys
+        :return: List of keys as strings
+        """
+        now = int(time.time())
+        with self.lock:
+            connection = self.connect()
+            # The write lock is taken before the select, so two runners never lease the same key
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                rows = connection.execute(
+                    'SELECT key FROM jobs WHERE queue = ? AND (state = \'ready\' OR '
+                    '(state = \'leased\' AND lease_until < ?)) LIMIT ?',
+                    (queue, now, count)).fetchall()
+                keys = [key for (key,) in rows]
+                connection.executemany(
+                    'UPDATE jobs SET state = \'leased\', owner = ?, lease_until = ?, '
+                    'attempts = attempts + 1, updated_at = ? WHERE queue = ? AND key = ?',
+                    [(self.owner, now + self.visibility_timeout, now, queue, key)
+                     for key in keys])
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+            self.inflight.setdefault(queue, set()).update(keys)
+        if len(keys) > 0:
+            self.start_renewal()
+        return keys
+
+    def renew(self):
+        """
+        Extend the leases of all keys this runner still works on by the visibility timeout
+        :return: Number of leases renewed
+        """
+        now = int(time.time())
+        with self.lock:
+            entries = [(now + self.visibility_timeout, now, queue, key, self.owner)
+                       for queue, keys in self.inflight.items() for key in keys]
+            if len(entries) == 0:
+                return 0
+            connection = self.connect()
+            before = connection.total_changes
+            connection.executemany(
+                'UPDATE jobs SET lease_until = ?, updated_at = ? WHERE queue = ? AND key = ? '
+                'AND owner = ? AND state = \'leased\'', entries)
+            renewed = connection.total_changes - before
+        self.log.debug('%s of %s leases renewed', renewed, len(entries))
+        return renewed
+
+    def start_renewal(self):
+        """
+        Start the background thread that renews the leases three times per visibility timeout
+        :return: None
+        """
+        if self.renewal is not None and self.renewal.is_alive():
+            return
+        self.stopped.clear()
+        self.renewal = threading.Thread(target=self.renew_leases, daemon=True)
+        self.renewal.start()
+
+    def renew_leases(self):
+        """
+        Renewal loop of the background thread until close
+        :return: None
+        """
+        while not self.stopped.wait(self.visibility_timeout / 3):
+            try:
+                self.renew()
+            except sqlite3.Error:
+                self.log.exception('Renewing the leases failed')
+
+    def close(self):
+        """
+        Stop renewing the leases, the keys still in flight expire after the visibility timeout
+        :return: None
+        """
+        self.stopped.set()
+        if self.renewal is not None:
+            self.renewal.join()
+            self.renewal = None
+
+    def done(self, queue, key, error=None):
+        """
+        Acknowledge a leased key. A failed key is released for another attempt, after
+        max_attempts it is given up. Keys whose lease passed to another runner are not
+        touched.
+        :param queue: Name of the queue
+        :param key: Key of the item
+        :param error: Error message of a failed key, None for a completed one
+        :return: None
+        """
+        now = int(time.time())
+        with self.lock:
+            self.inflight.get(queue, set()).discard(str(key))
+            connection = self.connect()
+            if error is None:
+                connection.execute(
+                    'UPDATE jobs SET state = \'done\', lease_until = NULL, error = NULL, '
+                    'updated_at = ? WHERE queue = ? AND key = ? AND owner = ? '
+                    'AND state = \'leased\'', (now, queue, str(key), self.owner))
+            else:
+                connection.execute(
+                    'UPDATE jobs SET state = CASE WHEN attempts >= ? THEN \'failed\' '
+                    'ELSE \'ready\' END, lease_until = NULL, error = ?, updated_at = ? '
+                    'WHERE queue = ? AND key = ? AND owner = ? AND state = \'leased\'',
+                    (self.max_attempts, error, now, queue, str(key), self.owner))
+
+    def claim_fill(self, queue, ttl=600):
+        """
+        Claim the right to fill a queue, only one runner scans at a time
+        :param queue: Name of the queue
+        :param ttl: Seconds after which the claim of a crashed runner expires
+        :return: True if this runner may fill the queue
+        """
+        now = int(time.time())
+        with self.lock:
+            connection = self.connect()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = connection.execute('SELECT owner, until FROM fills WHERE queue = ?',
+                                         (queue,)).fetchone()
+                claimed = row is None or row[0] == self.owner or row[1] < now
+                if claimed:
+                    connection.execute('INSERT OR REPLACE INTO fills (queue, owner, until) '
+                                       'VALUES (?, ?, ?)', (queue, self.owner, now + ttl))
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+        return claimed
+
+    def release_fill(self, queue):
+        """
+        Release the fill claim of this runner
+        :param queue: Name of the queue
+        :return: None
+        """
+        with self.lock:
+            self.connect().execute('DELETE FROM fills WHERE queue = ? AND owner = ?',
+                                   (queue, self.owner))
+
+    def checkpoint(self, queue):
+        """
+        Position of the scan that fills a queue
+        :param queue: Name of the queue
+        :return: QueueCheckpoint
+        """
+        return QueueCheckpoint(self, queue)
+
+    def fill(self, queue, pages, keyname):
+        """
+        Queue the keys of search results
+        :param queue: Name of the queue
+        :param pages: Iterable of lists of items
+        :param keyname: Key attribute of the items, e.g. 'id'
+        :return: Tuple of the number of keys queued and the number of items read
+        """
+        added = 0
+        read = 0
+        for page in pages:
+            read += len(page)
+            added += self.put(queue, [str(item[keyname]) for item in page])
+        self.log.info('%s: %s of %s keys queued', queue, added, read)
+        return added, read
+
+    def purge(self, queue):
+        """
+        Remove the finished keys that are older than the retention
+        :param queue: Name of the queue
+        :return: None
+        """
+        with self.lock:
+            self.connect().execute(
+                'DELETE FROM jobs WHERE queue = ? AND state IN (\'done\', \'failed\') '
+                'AND updated_at < ?', (queue, int(time.time()) - self.retention))
+
+    def consume(self, queue, search, keyname, keytype=str, items=1000, batch=50):
+        """
+        Lease the keys of a queue until the backlog is empty. When no key is ready, this
+        runner fills the queue from the search, unless another runner is filling it.
+        :param queue: Name of the queue
+        :param search: Function that takes the number of items and a checkpoint and returns
+        the search results as an iterable of lists of items
+        :param keyname: Key attribute, e.g. 'id'
+        :param keytype: Type of the key, e.g. int
+        :param items: Maximum number of keys for this runner
+        :param batch: Keys per lease
+        :return: Generator of item dictionaries with the key attribute
+        """
+        self.purge(queue)
+        leased = 0
+        while leased < items:
+            keys = self.lease(queue, min(batch, items - leased))
+            if len(keys) > 0:
+                leased += len(keys)
+                for key in keys:
+                    yield {keyname: keytype(key)}
+                continue
+
+            if not self.claim_fill(queue):
+                self.log.debug('%s: Waiting for the queue to be filled by another runner', queue)
+                time.sleep(1)
+                continue
+            try:
+                checkpoint = self.checkpoint(queue)
+                added, read = self.fill(queue, search(items - leased, checkpoint), keyname)
+            finally:
+                self.release_fill(queue)
+            # Stop once the search has nothing new left, the other keys belong to other runners
+            if added == 0 and (read == 0 or checkpoint.cleared):
+                self.log.info('%s: No further keys to lease', queue)
+                return
+
+    def stats(self, queue):
+        """
+        Summary for logging
+        :param queue: Name of the queue
+        :return: Dictionary of state -> number of keys
+        """
+        with self.lock:
+            rows = self.connect().execute(
+                'SELECT state, COUNT(*) FROM jobs WHERE queue = ? GROUP BY state',
+                (queue,)).fetchall()
+        stats = {'ready': 0, 'leased': 0, 'done': 0, 'failed': 0}
+        stats.update(rows)
+        return stats
@@ -0,0 +1,73 @@
+"""
+Micro-benchmark of the JSON backends on the stored JSON files, e.g.
+python json-bench.py picture --files 500
+"""
+import argparse
+import glob
+import logging
+import os
+import time
+
+from app.jsondecode import BACKENDS, graphqldata
+from app.storage import loaddictionary, readrecord
+
+PAGES = {
+    'location': ('json/location', 'LocationsPage', 'location'),
+    'user': ('json/user', 'ProfilePage', 'user'),
+    'picture': ('json/post', 'PostPage', 'shortcode_media')
+}
+
+parser = argparse.ArgumentParser()
+parser.add_argument('category', choices=('location', 'user', 'picture'))
+parser.add_argument('--storage-directory', default='.')
+parser.add_argument('--zstd-dictionary', default=None)
+parser.add_argument('--files', type=int, default=1000, help='Maximum number of files')
+parser.add_argument('--repeat', type=int, default=3, help='Runs per backend, the best counts')
+
+
+def bench(payloads, page, entity, loads, subtree, repeat):
+    """
+    Decode all payloads and return the best time
+    :param payloads: List of JSONs as bytes
+    :param page: Page type, e.g. 'PostPage'
+    :param entity: Entity in the GraphQL data, e.g. 'shortcode_media'
+    :param loads: Function to decode the JSON or its GraphQL object
+    :param subtree: Decode only the GraphQL object
+    :param repeat: Number of runs
+    :return: Seconds of the fastest run
+    """
+    best = None
+    for _ in range(repeat):
+        starttime = time.perf_counter()
+        for payload in payloads:
+            graphqldata(payload, page, entity, loads, subtree)
+        duration = time.perf_counter() - starttime
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args()
+
+    directory, page, entity = PAGES[args.category]
+    directory = os.path.join(args.storage_directory, directory)
+    dictionary = loaddictionary(args.zstd_dictionary)
+
+    keys = set()
+    for path in glob.glob(os.path.join(directory, '*.json*')):
+        keys.add(os.path.basename(path).split('.json')[0])
+    payloads = []
+    for key in sorted(keys)[:args.files]:
+        payloads.append(readrecord(directory, key, dictionary)[1])
+    if len(payloads) == 0:
+        raise SystemExit('No JSON files in {}'.format(directory))
+
+    size = sum(len(payload) for payload in payloads)
+    logging.info('%s files, %.1f MB', len(payloads), size / 1024 / 1024)
+    for name, loads in sorted(BACKENDS.items()):
+        for mode, subtree in (('full', False), ('subtree', True)):
+            duration = bench(payloads, page, entity, loads, subtree, args.repeat)
+            logging.info('%-10s %-7s %8.3f ms/file %8.1f MB/s', name, mode,
+                         duration / len(payloads) * 1000, size / duration / 1024 / 1024)
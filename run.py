@@ -5,56 +5,244 @@ This is the runner module which is the main module to run Instalytics
 import multiprocessing as mp
 import logging
 import argparse
+import functools
+import glob
+import os
+import threading
+import time
 import boto3
 
 from app import Retrieve
 from app import Search
 from app import Extract
+from app.asyncretrieve import AsyncRetrieve
+from app.bulkextract import BulkExtract
+from app.extractpool import ExtractPool, bounded
+from app.journal import JobJournal
+from app.workqueue import WorkQueue
+from app.pipeline import Pipeline
+from app.storage import train_dictionary
+
+def pending_pages(search, table, key, category, step, items=1000, status_index=False,
+                  checkpoint=None):
+    """
+    Pages of the items that wait for a step, from the status index or from a table scan
+    :param search: Search instance
+    :param table: DynamoDB table to scan
+    :param key: Key attribute, e.g. 'id'
+    :param category: 'location', 'user' or 'picture'
+    :param step: 'discovered' or 'retrieved'
+    :param items: Number of items after which the search stops
+    :param status_index: Query the status index instead of scanning
+    :param checkpoint: Optional checkpoint of the search, e.g. of the job journal
+    :return: Generator of lists of item dictionaries with the key attribute
+    """
+    if status_index:
+        return search.pending_pages(category, step, items, checkpoint=checkpoint)
+    return search.scan_pages(table, key, step, items, checkpoint=checkpoint)
+
+def pending(search, table, key, category, step, items=1000, status_index=False,
+            checkpoint=None):
+    """
+    Items that wait for a step, from the status index or from a table scan. The items are
+    yielded as their pages arrive, so the work can start before the search is done.
+    :param search: Search instance
+    :param table: DynamoDB table to scan
+    :param key: Key attribute, e.g. 'id'
+    :param category: 'location', 'user' or 'picture'
+    :param step: 'discovered' or 'retrieved'
+    :param items: Number of items after which the search stops
+    :param status_index: Query the status index instead of scanning
+    :param checkpoint: Optional checkpoint of the search, e.g. of the job journal
+    :return: Generator of item dictionaries with the key attribute
+    """
+    for page in pending_pages(search, table, key, category, step, items, status_index,
+                              checkpoint):
+        yield from page
+
+def journaled(search, journal, table, key, keytype, category, step, items=1000,
+              status_index=False):
+    """
+    Items of a phase of a journaled run. A resumed run first gets the items it dispatched but
+    never completed, then the search continues from its saved position. Items the journal
+    already dispatched are skipped.
+    :param search: Search instance
+    :param journal: JobJournal with a started run
+    :param table: DynamoDB table to scan
+    :param key: Key attribute, e.g. 'id'
+    :param keytype: Type of the key, e.g. int
+    :param category: 'location', 'user' or 'picture'
+    :param step: 'discovered' or 'retrieved', the phase of the run
+    :param items: Number of items of the phase over all attempts of the run
+    :param status_index: Query the status index instead of scanning
+    :return: Generator of item dictionaries with the key attribute
+    """
+    if journal.phase_finished(step):
+        return
+    remaining = max(items - journal.count(step), 0)
+    for keyvalue in journal.unfinished(step):
+        if journal.dispatch(step, keyvalue, resumed=True):
+            yield {key: keytype(keyvalue)}
+    for item in pending(search, table, key, category, step, remaining, status_index,
+                        journal.checkpoint(step, key)):
+        if journal.dispatch(step, item[key]):
+            yield item
+
+def work(search, table, key, keytype, category, step, items=1000, status_index=False):
+    """
+    Items of a phase, leased from the shared work queue with --queue, otherwise from the
+    journaled search
+    :param search: Search instance
+    :param table: DynamoDB table to scan
+    :param key: Key attribute, e.g. 'id'
+    :param keytype: Type of the key, e.g. int
+    :param category: 'location', 'user' or 'picture'
+    :param step: 'discovered' or 'retrieved'
+    :param items: Number of items of the phase
+    :param status_index: Query the status index instead of scanning
+    :return: Generator of item dictionaries with the key attribute
+    """
+    if workqueue is None:
+        return journaled(search, journal, table, key, keytype, category, step, items,
+                         status_index)
+    return workqueue.consume('{}-{}'.format(category, step),
+                             functools.partial(pending_pages, search, table, key, category,
+                                               step, status_index=status_index),
+                             key, keytype, items)
+
+def finished(category, step):
+    """
+    Function that records a finished key of a phase
+    :param category: 'location', 'user' or 'picture'
+    :param step: 'discovered' or 'retrieved'
+    :return: Function called with the key and None or the error message
+    """
+    if workqueue is None:
+        return functools.partial(journal.done, step)
+    return functools.partial(workqueue.done, '{}-{}'.format(category, step))
+
+def finish_phase(category, step):
+    """
+    Close a phase in the journal or log the state of its queue
+    :param category: 'location', 'user' or 'picture'
+    :param step: 'discovered' or 'retrieved'
+    :return: None
+    """
+    if workqueue is None:
+        journal.finish_phase(step)
+        return
+    queuestats = workqueue.stats('{}-{}'.format(category, step))
+    logging.info('Queue %s-%s: %s ready, %s leased, %s done, %s failed', category, step,
+                 queuestats['ready'], queuestats['leased'], queuestats['done'],
+                 queuestats['failed'])
+
+def retrieve_lazily(function, items, window=1000, done=None):
+    """
+    Retrieve the items on the process pool while the search is still running
+    :param function: mp_retrieve_location, mp_retrieve_picture or mp_retrieve_user
+    :param items: Iterable of item dictionaries
+    :param window: Maximum number of items read ahead of the finished ones
+    :param done: Optional function called per key with None or the error message
+    :return: None
+    """
+    semaphore = threading.BoundedSemaphore(window)
+    for key, error in pool.imap_unordered(function, bounded(enumerate(items, 1), semaphore)):
+        semaphore.release()
+        if done is not None:
+            done(key, error)
 
 def mp_retrieve_location(location_list):
     """
     Function to support multiprocessing and avoid getting a pickle error for locations
     :param location_list: Tuple that contains a position number and the location dictionary,
     e.g. (1, {"id": 1992983})
-    :return: None
+    :return: Tuple of the location ID and None or the error message
 
     Todo: Adding the process id and picture number for an improved progress tracking
     """
     log = logging.getLogger(__name__)
     number, location_dictionary = location_list
     log.info('#%s: %s - Retrieving data from Instagram', number, location_dictionary['id'])
-    retr.retrieve_location(location_dictionary['id'])
+    try:
+        retr.retrieve_location(location_dictionary['id'])
+    except Exception as error:  # pylint: disable=broad-except
+        log.exception('#%s: %s - Retrieving failed', number, location_dictionary['id'])
+        return location_dictionary['id'], repr(error)
+    return location_dictionary['id'], None
 
 def mp_retrieve_picture(picture_list):
     """
     Function to support multiprocessing and avoid getting a pickle error for pictures
     :param picture_list: Tuple that contains a position number and the picture dictionary,
     e.g. (1, {'shortcode': '0gKBcODBtk'})
-    :return: None
+    :return: Tuple of the shortcode and None or the error message
 
     Todo: Adding the process id and picture number for an improved progress tracking
     """
     log = logging.getLogger(__name__)
     number, picture_dictionary = picture_list
     log.info('#%s: %s - Retrieving data from Instagram', number, picture_dictionary['shortcode'])
-    retr.retrieve_picture(picture_dictionary['shortcode'])
+    try:
+        retr.retrieve_picture(picture_dictionary['shortcode'])
+    except Exception as error:  # pylint: disable=broad-except
+        log.exception('#%s: %s - Retrieving failed', number, picture_dictionary['shortcode'])
+        return picture_dictionary['shortcode'], repr(error)
+    return picture_dictionary['shortcode'], None
 
 def mp_retrieve_user(user_list):
     """
     Function to support multiprocessing and avoid getting a pickle error for pictures
     :param user_list: Tuple that contains a position number and the user dictionary,
     e.g. (1, {'username': 'giorgio'}
-    :return: None
+    :return: Tuple of the username and None or the error message
 
     Todo: Adding the process id and picture number for an improved progress tracking
     """
     log = logging.getLogger(__name__)
     number, user_dictionary = user_list
     log.info('#%s: %s - Retrieving data from Instagram', number, user_dictionary['username'])
-    retr.retrieve_user(user_dictionary['username'])
+    try:
+        retr.retrieve_user(user_dictionary['username'])
+    except Exception as error:  # pylint: disable=broad-except
+        log.exception('#%s: %s - Retrieving failed', number, user_dictionary['username'])
+        return user_dictionary['username'], repr(error)
+    return user_dictionary['username'], None
 
 
 parser = argparse.ArgumentParser()
+parser.add_argument('--codec', choices=('plain', 'gzip', 'zstd'), default='plain',
+                    help='Format of the stored JSON files')
+parser.add_argument('--zstd-dictionary', default=None,
+                    help='Trained zstd dictionary for the zstd codec')
+parser.add_argument('--known-keys', default=None,
+                    help='Directory of a local index of existing keys, which lets extraction '
+                         'skip known entities without a DynamoDB lookup')
+parser.add_argument('--known-keys-error-rate', type=float, default=0.001,
+                    help='False positive rate of the Bloom filters of the known keys index')
+parser.add_argument('--known-keys-inexact', action='store_true',
+                    help='Trust the Bloom filters without the exact key set, new keys are '
+                         'skipped with the false positive rate')
+parser.add_argument('--json-backend', choices=('auto', 'orjson', 'simdjson', 'json'),
+                    default='auto', help='JSON decoder for the extraction, auto picks the '
+                                         'fastest installed one')
+parser.add_argument('--subtree-json', action='store_true',
+                    help='Decode only the GraphQL part of the stored JSONs')
+parser.add_argument('--fast-discovery', action='store_true',
+                    help='Write discovered items with unconditional batch writes. Only safe '
+                         'when no other runner discovers the same keys at the same time')
+parser.add_argument('--regions', default='./config/regions.geojson',
+                    help='GeoJSON file of the regions whose pictures are extracted')
+parser.add_argument('--timeseries', default=None,
+                    help='Directory of a local time series store for the weekly snapshots, '
+                         'which are then written to DynamoDB with the sync command')
+parser.add_argument('--scan-segments', type=int, default=1,
+                    help='Scan the tables in this many parallel segments')
+parser.add_argument('--status-index', action='store_true',
+                    help='Query the pending items from the sparse status index instead of '
+                         'scanning the tables, see the index command')
+parser.add_argument('--archive', choices=('objects', 'segments'), default='objects',
+                    help='Archive each JSON as its own S3 object or packed into segments. '
+                         'Segments of process pool workers are uploaded on the next start')
 subparser = parser.add_subparsers()
 
 # Parser for running one-off searches / test
@@ -67,8 +255,89 @@ parser_get.set_defaults(command='get')
 # Parser for running the program
 parser_run = subparser.add_parser('run')
 parser_run.add_argument('category', choices=('location', 'user', 'picture'))
+parser_run.add_argument('--asyncio', action='store_true',
+                        help='Retrieve with asyncio from one process instead of a process pool')
+parser_run.add_argument('--concurrency', type=int, default=1000,
+                        help='Maximum requests in flight with --asyncio')
+parser_run.add_argument('--proxy-concurrency', type=int, default=10,
+                        help='Maximum requests in flight per proxy with --asyncio')
+parser_run.add_argument('--stream-images', action='store_true',
+                        help='Stream pictures straight into S3 without a local copy')
+parser_run.add_argument('--upload-threads', type=int, default=10,
+                        help='Background threads for picture uploads with --asyncio')
+parser_run.add_argument('--dedupe-images', action='store_true',
+                        help='Store pictures by content hash and skip known pictures')
+parser_run.add_argument('--extract-processes', type=int, default=1,
+                        help='Processes for the extraction phase')
+parser_run.add_argument('--extract-threads', type=int, default=1,
+                        help='Threads per process for the extraction phase')
+parser_run.add_argument('--pipeline', action='store_true',
+                        help='Extract every fetched JSON right away instead of scanning for '
+                             'retrieved items afterwards, needs --asyncio')
+parser_run.add_argument('--pipeline-queue', type=int, default=100,
+                        help='Maximum fetched JSONs waiting for extraction with --pipeline')
+parser_run.add_argument('--archive-threads', type=int, default=10,
+                        help='Background threads for archiving the JSONs with --pipeline')
+parser_run.add_argument('--resume', action='store_true',
+                        help='Continue the last interrupted run of the category, not with '
+                             '--queue')
+parser_run.add_argument('--journal', default='./tmp/jobs.sqlite',
+                        help='SQLite journal of the scan positions and item states of the runs')
+parser_run.add_argument('--queue', default=None,
+                        help='SQLite work queue shared by several runners on this host, '
+                             'instead of the journal')
+parser_run.add_argument('--queue-timeout', type=int, default=600,
+                        help='Seconds a leased key stays invisible to the other runners, the '
+                             'leases of keys in flight are renewed')
 parser_run.set_defaults(command='run')
 
+# Parser for training a zstd dictionary on the stored JSON files
+parser_dictionary = subparser.add_parser('dictionary')
+parser_dictionary.add_argument('category', choices=('location', 'user', 'picture'))
+parser_dictionary.add_argument('output', help='File the dictionary is written to')
+parser_dictionary.add_argument('--samples', type=int, default=2000,
+                               help='Maximum number of JSON files to train on')
+parser_dictionary.set_defaults(command='dictionary')
+
+# Parser for re-extracting the archived JSONs into columnar files
+parser_bulk = subparser.add_parser('bulk')
+parser_bulk.add_argument('category', choices=('location', 'user', 'picture'))
+parser_bulk.add_argument('output', help='Directory the columnar files are written to')
+parser_bulk.add_argument('--source', choices=('objects', 'segments'), default='objects',
+                         help='Read the JSON directory or the local segments')
+parser_bulk.add_argument('--processes', type=int, default=None,
+                         help='Number of processes, default is the number of CPUs')
+parser_bulk.add_argument('--chunk-size', type=int, default=10000,
+                         help='Records per output file when reading the JSON directory')
+parser_bulk.set_defaults(command='bulk')
+
+# Parser for syncing the weekly snapshots of the time series store to DynamoDB
+parser_sync = subparser.add_parser('sync')
+parser_sync.add_argument('category', choices=('location', 'user'))
+parser_sync.set_defaults(command='sync')
+
+# Parser for the growth of a location or user from the time series store
+parser_growth = subparser.add_parser('growth')
+parser_growth.add_argument('category', choices=('location', 'user'))
+parser_growth.add_argument('key', help='Location ID or username')
+parser_growth.add_argument('--metric', default=None,
+                           help='Metric, default is media_count or followed_by_count')
+parser_growth.add_argument('--days', type=int, default=None,
+                           help='Only the last days, default is all snapshots')
+parser_growth.set_defaults(command='growth')
+
+# Parser for creating and filling the sparse status index
+parser_index = subparser.add_parser('index')
+parser_index.add_argument('category', choices=('location', 'user', 'picture'))
+parser_index.add_argument('--backfill', action='store_true',
+                          help='Set the status of the pending items written before the index')
+parser_index.set_defaults(command='index')
+
+# Parser for loading the existing keys into the known keys index
+parser_warm = subparser.add_parser('warm')
+parser_warm.add_argument('category', choices=('location', 'user', 'picture'))
+parser_warm.set_defaults(command='warm')
+
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
@@ -77,15 +346,70 @@ if __name__ == '__main__':
     logging.info(args.__dict__)
 
     # Initialize profiles
-    sr = Search()
-    retr = Retrieve(useproxy=True, awsprofile='default', storage_directory='.')
-    ex = Extract(awsprofile='default', storage_directory='.')
+    sr = Search(segments=args.scan_segments)
+    # Background uploads only work from this process, the process pool would drop them
+    upload_threads = 0
+    archive_threads = 0
+    if getattr(args, 'asyncio', False):
+        upload_threads = args.upload_threads
+    if getattr(args, 'pipeline', False):
+        if not args.asyncio:
+            parser.error('--pipeline needs --asyncio')
+        archive_threads = args.archive_threads
+    retr = Retrieve(useproxy=True, awsprofile='default', storage_directory='.',
+                    keep_local_pictures=not getattr(args, 'stream_images', False),
+                    upload_threads=upload_threads,
+                    dedupe_images=getattr(args, 'dedupe_images', False),
+                    codec=args.codec,
+                    zstd_dictionary=args.zstd_dictionary,
+                    archive=args.archive,
+                    archive_threads=archive_threads)
+    # The retrieval workers are forked from this process, so the pool is created before any
+    # thread is started and only when the retrieval runs on it
+    pool = None
+    if args.command == 'run' and not args.asyncio:
+        pool = mp.Pool()
+    extract_options = {
+        'awsprofile': 'default',
+        'storage_directory': '.',
+        'zstd_dictionary': args.zstd_dictionary,
+        'knownkeys_directory': args.known_keys,
+        'knownkeys_error_rate': args.known_keys_error_rate,
+        'knownkeys_exact': not args.known_keys_inexact,
+        'json_backend': args.json_backend,
+        'subtree_json': args.subtree_json,
+        'strict_discovery': not args.fast_discovery,
+        'regions_file': args.regions,
+        'timeseries_directory': args.timeseries
+    }
+    ex = Extract(**extract_options)
+    extractpool = ExtractPool(extract_options,
+                              processes=getattr(args, 'extract_processes', 1),
+                              threads=getattr(args, 'extract_threads', 1),
+                              writestats=ex.writestats)
+    pipeline = None
+    if getattr(args, 'pipeline', False):
+        pipeline = Pipeline(extract_options,
+                            threads=args.extract_threads,
+                            queue_size=args.pipeline_queue,
+                            writestats=ex.writestats)
+        retr.pipeline = pipeline
+        pipeline.start()
     dynamo = boto3.resource('dynamodb')
     tbl_user = dynamo.Table('test4')
     tbl_pictures = dynamo.Table('test2')
     tbl_locations = dynamo.Table('test3')
 
-    pool = mp.Pool()
+    journal = None
+    workqueue = None
+    if args.command == 'run' and args.queue is not None:
+        if args.resume:
+            parser.error('--resume only applies to the journal, the queue always continues '
+                         'its backlog')
+        workqueue = WorkQueue(args.queue, visibility_timeout=args.queue_timeout)
+    elif args.command == 'run':
+        journal = JobJournal(args.journal)
+        journal.start(args.category, resume=args.resume)
 
     # one location
     if args.command == 'get' and args.category == 'location':
@@ -110,11 +434,18 @@ if __name__ == '__main__':
         logging.info(70 * '*')
         logging.info('=== LOCATIONS - STARTING TO RETRIEVE FROM INSTAGRAM ===')
         logging.info(70 * '*')
-        response = sr.scan_key_with_filter(tbl_locations,
-                                           'id',
-                                           'discovered')
-        retrlocations = list(enumerate(response, 1))
-        pool.map(mp_retrieve_location, retrlocations)
+        response = work(sr, tbl_locations, 'id', int, 'location', 'discovered',
+                        status_index=args.status_index)
+        if args.asyncio:
+            asyncretr = AsyncRetrieve(retr,
+                                      concurrency=args.concurrency,
+                                      proxy_concurrency=args.proxy_concurrency)
+            asyncretr.run('location', (item['id'] for item in response),
+                          finished(args.category, 'discovered'))
+        else:
+            retrieve_lazily(mp_retrieve_location, response,
+                            done=finished(args.category, 'discovered'))
+        finish_phase(args.category, 'discovered')
 
         logging.info(60 * '*')
         logging.info('=== LOCATIONS - RETRIEVING FROM INSTAGRAM COMPLETED ===')
@@ -124,18 +455,20 @@ if __name__ == '__main__':
         logging.info('=== LOCATIONS - EXTRACTING INFORMATION ===')
         logging.info(60 * '*')
 
-        extrlocations = sr.scan_key_with_filter(tbl_locations,
-                                                'id',
-                                                'retrieved')
-        # extrlocations = sr.incomplete(category='location',
-        #                               step='retrieved')
-        extrlocations_total = len(extrlocations)
-        for location in list(enumerate(extrlocations)):
-            location_number, location_id = location
-            logging.info('[%s]/[%s]: %s - Extracting location details',
-                         location_number, extrlocations_total, location_id['id'])
-            ex.location_details(location_id['id'])
-
+        if pipeline is not None:
+            extractstats = pipeline.close()
+        else:
+            extrlocations = work(sr, tbl_locations, 'id', int, 'location',
+                                 'retrieved', status_index=args.status_index)
+            # extrlocations = sr.incomplete(category='location',
+            #                               step='retrieved')
+            extractstats = extractpool.run('location', (item['id'] for item in extrlocations),
+                                           finished(args.category, 'retrieved'))
+        finish_phase(args.category, 'retrieved')
+
+        logging.info('%s extracted, %s without JSON, %s failed: %s',
+                     extractstats['completed'], extractstats['missing'], extractstats['failed'],
+                     [key for key, _ in extractstats['errors']])
         logging.info(60 * '*')
         logging.info('=== LOCATIONS - EXTRACTING COMPLETED ===')
         logging.info(60 * '*')
@@ -146,12 +479,18 @@ if __name__ == '__main__':
         logging.info('=== PICTURES - STARTING TO RETRIEVE FROM INSTAGRAM ===')
         logging.info(70 * '*')
 
-        response = sr.scan_key_with_filter(tbl_pictures,
-                                           'shortcode',
-                                           'discovered',
-                                           items=10)
-        retrpictures = list(enumerate(response, 1))
-        pool.map(mp_retrieve_picture, retrpictures)
+        response = work(sr, tbl_pictures, 'shortcode', str, 'picture',
+                        'discovered', items=10, status_index=args.status_index)
+        if args.asyncio:
+            asyncretr = AsyncRetrieve(retr,
+                                      concurrency=args.concurrency,
+                                      proxy_concurrency=args.proxy_concurrency)
+            asyncretr.run('picture', (item['shortcode'] for item in response),
+                          finished(args.category, 'discovered'))
+        else:
+            retrieve_lazily(mp_retrieve_picture, response,
+                            done=finished(args.category, 'discovered'))
+        finish_phase(args.category, 'discovered')
 
         logging.info(60 * '*')
         logging.info('=== PICTURES - RETRIEVING FROM INSTAGRAM COMPLETED ===')
@@ -161,18 +500,21 @@ if __name__ == '__main__':
         logging.info('=== PICTURES - EXTRACTING INFORMATION ===')
         logging.info(60 * '*')
 
-        extrpictures = sr.scan_key_with_filter(tbl_pictures,
-                                               'shortcode',
-                                               'retrieved')
-        # extrpictures = sr.incomplete(category='picture',
-        #                              step='retrieved')
-        extrpictures_total = len(extrpictures)
-        for picture in list(enumerate(extrpictures, 1)):
-            picture_number, picture_name = picture
-            logging.info('[%s]/[%s]: %s - Extracting user details',
-                         picture_number, extrpictures_total, picture_name['shortcode'])
-            ex.picture_details(picture_name['shortcode'])
-
+        if pipeline is not None:
+            extractstats = pipeline.close()
+        else:
+            extrpictures = work(sr, tbl_pictures, 'shortcode', str, 'picture',
+                                'retrieved', status_index=args.status_index)
+            # extrpictures = sr.incomplete(category='picture',
+            #                              step='retrieved')
+            extractstats = extractpool.run('picture',
+                                           (item['shortcode'] for item in extrpictures),
+                                           finished(args.category, 'retrieved'))
+        finish_phase(args.category, 'retrieved')
+
+        logging.info('%s extracted, %s without JSON, %s failed: %s',
+                     extractstats['completed'], extractstats['missing'], extractstats['failed'],
+                     [key for key, _ in extractstats['errors']])
         logging.info(60 * '*')
         logging.info('=== PICTURES - EXTRACTING COMPLETED ===')
         logging.info(60 * '*')
@@ -184,11 +526,18 @@ if __name__ == '__main__':
         logging.info('=== USERS - STARTING TO RETRIEVE FROM INSTAGRAM ===')
         logging.info(70 * '*')
 
-        response = sr.scan_key_with_filter(tbl_user,
-                                           'username',
-                                           'discovered')
-        retrusers = list(enumerate(response, 1))
-        pool.map(mp_retrieve_user, retrusers)
+        response = work(sr, tbl_user, 'username', str, 'user', 'discovered',
+                        status_index=args.status_index)
+        if args.asyncio:
+            asyncretr = AsyncRetrieve(retr,
+                                      concurrency=args.concurrency,
+                                      proxy_concurrency=args.proxy_concurrency)
+            asyncretr.run('user', (item['username'] for item in response),
+                          finished(args.category, 'discovered'))
+        else:
+            retrieve_lazily(mp_retrieve_user, response,
+                            done=finished(args.category, 'discovered'))
+        finish_phase(args.category, 'discovered')
 
         logging.info(60 * '*')
         logging.info('=== USERS - RETRIEVING FROM INSTAGRAM COMPLETED ===')
@@ -198,23 +547,107 @@ if __name__ == '__main__':
         logging.info('=== USERS - EXTRACTING INFORMATION ===')
         logging.info(60 * '*')
 
-        extrusers = sr.scan_key_with_filter(tbl_user,
-                                            'username',
-                                            'retrieved')
-        extrusers_total = len(extrusers)
-        for user in list(enumerate(extrusers, 1)):
-            user_number, user_name = user
-            logging.info('[%s]/[%s]: %s - Extracting user details',
-                         user_number, extrusers_total, user_name['username'])
-            ex.user_details(user_name['username'])
-
+        if pipeline is not None:
+            extractstats = pipeline.close()
+        else:
+            extrusers = work(sr, tbl_user, 'username', str, 'user', 'retrieved',
+                             status_index=args.status_index)
+            extractstats = extractpool.run('user', (item['username'] for item in extrusers),
+                                           finished(args.category, 'retrieved'))
+        finish_phase(args.category, 'retrieved')
+
+        logging.info('%s extracted, %s without JSON, %s failed: %s',
+                     extractstats['completed'], extractstats['missing'], extractstats['failed'],
+                     [key for key, _ in extractstats['errors']])
         logging.info(60 * '*')
         logging.info('=== USERS - EXTRACTING COMPLETED ===')
         logging.info(60 * '*')
 
+    # train a zstd dictionary
+    elif args.command == 'dictionary':
+        directory = os.path.join('.', retr.storage_json[args.category])
+        samplefiles = glob.glob(os.path.join(directory, '*.json*'))[:args.samples]
+        samplecount = train_dictionary(samplefiles, args.output)
+        logging.info('Dictionary trained on %s files written to %s', samplecount, args.output)
+
+    # re-extract the archive into columnar files
+    elif args.command == 'bulk':
+        bulk = BulkExtract(storage_directory='.',
+                           processes=args.processes,
+                           chunk_size=args.chunk_size,
+                           json_backend=args.json_backend,
+                           zstd_dictionary=args.zstd_dictionary,
+                           regions_file=args.regions)
+        bulkstats = bulk.run(args.category, args.output, args.source)
+        logging.info('%s rows in %s files written to %s, %s records failed',
+                     bulkstats['rows'], bulkstats['files'], args.output, bulkstats['failed'])
+
+    # weekly snapshots from the time series store
+    elif args.command in ('sync', 'growth') and ex.timeseries is None:
+        logging.info('%s needs --timeseries', args.command)
+
+    elif args.command == 'sync':
+        snapshotcount = ex.sync_snapshots(args.category)
+        logging.info('%s %s snapshots written to DynamoDB', snapshotcount, args.category)
+
+    elif args.command == 'growth':
+        metric = args.metric
+        if metric is None:
+            metric = {'location': 'media_count', 'user': 'followed_by_count'}[args.category]
+        since = None
+        if args.days is not None:
+            since = int(time.time()) - args.days * 86400
+        logging.info('%s %s: %s', args.key, metric,
+                     ex.timeseries[args.category].growth(args.key, metric, since))
+
+    # sparse status index of the pending items
+    elif args.command == 'index':
+        sr.create_status_index(args.category)
+        if args.backfill:
+            statuscounts = sr.backfill_status(args.category)
+            logging.info('%s discovered and %s retrieved %s items backfilled',
+                         statuscounts['discovered'], statuscounts['retrieved'], args.category)
+
+    # load the existing keys into the known keys index
+    elif args.command == 'warm':
+        if ex.knownkeys is None:
+            logging.info('warm needs --known-keys')
+        else:
+            keycount = ex.warm_knownkeys(args.category)
+            logging.info('%s %s keys loaded into %s', keycount, args.category, args.known_keys)
+
     # weekly
 
     # all five minutes
 
     else:
-        logging.info('No valid category')
\ No newline at end of file
+        logging.info('No valid category')
+
+    if journal is not None:
+        for phase in ('discovered', 'retrieved'):
+            phasestats = journal.summary(phase)
+            logging.info('Run #%s %s: %s completed, %s failed, %s unfinished', journal.run, phase,
+                         phasestats['completed'], phasestats['failed'],
+                         phasestats['pending'] + phasestats['dispatched'])
+        journal.finish()
+    if workqueue is not None:
+        workqueue.close()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    retr.close()
+    retr.proxypool.save()
+    ex.close()
+    # The sessions of the process pool live in its workers, only this process is counted
+    if pool is None:
+        sessionstats = retr.sessionpool.stats()
+        logging.info('%s requests over %s connections, %s reused',
+                     sessionstats['requests'], sessionstats['connections'],
+                     sessionstats['reused'])
+    writestats = ex.writestats.summary()
+    logging.info('%s records with %s attributes written in %s round trips, %s saved',
+                 writestats['records'], writestats['attributes'], writestats['roundtrips'],
+                 writestats['saved'])
+    if ex.knownkeys is not None:
+        logging.info('%s lookups skipped by the known keys index', ex.knownkeys.skipped)
\ No newline at end of file
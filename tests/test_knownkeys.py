@@ -0,0 +1,42 @@
+import multiprocessing as mp
+
+from app.knownkeys import KnownKeys, ScalableBloomFilter
+
+
+def addkeys(directory, keys):
+    knownkeys = KnownKeys(directory, capacity=1000, exact=False)
+    knownkeys.add('te_post', keys)
+    knownkeys.save()
+
+
+def test_saves_of_several_indexes_are_merged(tmp_path):
+    directory = str(tmp_path)
+    # Both indexes load the filter before either of them saves
+    first = KnownKeys(directory, capacity=1000, exact=False)
+    second = KnownKeys(directory, capacity=1000, exact=False)
+    first.add('te_post', ['a1', 'a2'])
+    second.add('te_post', ['b1', 'b2', 'b3'])
+    first.save()
+    second.save()
+    first.add('te_post', ['a3'])
+    first.save()
+
+    saved = ScalableBloomFilter.load(str(tmp_path / 'te_post.bloom'))
+    for key in ['a1', 'a2', 'a3', 'b1', 'b2', 'b3']:
+        assert key in saved
+    # The number of keys after a merge is estimated from the set bits
+    assert abs(sum(bloomfilter.count for bloomfilter in saved.filters) - 6) <= 1
+
+
+def test_workers_keep_each_others_keys(tmp_path):
+    directory = str(tmp_path)
+    chunks = [['w{}-{}'.format(worker, number) for number in range(300)] for worker in range(4)]
+    with mp.get_context('fork').Pool(4) as pool:
+        pool.starmap(addkeys, [(directory, chunk) for chunk in chunks])
+
+    # Without the exact key set every key must be answered by the filter alone
+    knownkeys = KnownKeys(directory, capacity=1000, exact=False)
+    keys = [key for chunk in chunks for key in chunk]
+    assert knownkeys.unknown('te_post', keys) == []
+    saved = ScalableBloomFilter.load(str(tmp_path / 'te_post.bloom'))
+    assert abs(sum(bloomfilter.count for bloomfilter in saved.filters) - len(keys)) < 60
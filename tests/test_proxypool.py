@@ -0,0 +1,46 @@
+import json
+import threading
+
+from app.proxypool import ProxyPool
+
+PROXIES = [('10.0.0.{}:8080'.format(number), 'agent') for number in range(4)]
+
+
+def test_concurrent_reports_save_once_per_interval(tmp_path, monkeypatch):
+    statefile = tmp_path / 'proxypool.json'
+    pool = ProxyPool(PROXIES, statefile=str(statefile), save_interval=0)
+    saves = []
+    save = pool.save
+    monkeypatch.setattr(pool, 'save', lambda: saves.append(1) or save())
+    barrier = threading.Barrier(8)
+    errors = []
+
+    def report():
+        barrier.wait()
+        try:
+            for _ in range(50):
+                pool.report_success(pool.choose(), 0.1)
+        except Exception as error:  # pylint: disable=broad-except
+            errors.append(error)
+
+    threads = [threading.Thread(target=report) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(saves) > 0
+    assert sorted(json.loads(statefile.read_text())) == sorted(proxy for proxy, _ in PROXIES)
+    assert [path.name for path in tmp_path.iterdir()] == ['proxypool.json']
+
+
+def test_failed_save_does_not_fail_the_report(tmp_path):
+    # The state file lies below a regular file, so the directory can not be created
+    blocker = tmp_path / 'blocker'
+    blocker.write_text('')
+    pool = ProxyPool(PROXIES, statefile=str(tmp_path / 'proxypool.json'), save_interval=0)
+    pool.statefile = str(blocker / 'proxypool.json')
+    pool.report_success(PROXIES[0], 0.1)
+    pool.report_failure(PROXIES[1], 'timeout')
+    assert pool.stats[PROXIES[0][0]].successes == 1
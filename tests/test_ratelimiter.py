@@ -0,0 +1,42 @@
+import multiprocessing as mp
+import time
+
+from app.retrieve import RateLimiter
+
+PROXY = '10.0.0.1:8080'
+
+
+def acquire(ratelimiter, count):
+    for _ in range(count):
+        ratelimiter.acquire(PROXY)
+
+
+def toomanyrequests(ratelimiter):
+    ratelimiter.on_toomanyrequests(PROXY)
+
+
+def run(target, *args, processes=1):
+    workers = [mp.get_context('fork').Process(target=target, args=args)
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+
+
+def test_processes_share_the_proxy_rate():
+    ratelimiter = RateLimiter(requests_per_second=1000, proxy_requests_per_second=20,
+                              proxies=[PROXY])
+    starttime = time.time()
+    run(acquire, ratelimiter, 5, processes=4)
+    # 20 requests at 20 per second with one token saved up, four separate buckets take 0.2s
+    assert time.time() - starttime >= 0.9
+
+
+def test_backoff_of_one_process_applies_to_all():
+    ratelimiter = RateLimiter(proxy_requests_per_second=4, proxies=[PROXY])
+    run(toomanyrequests, ratelimiter)
+    assert ratelimiter.bucket(PROXY).rate == 2
+    assert ratelimiter.bucket(PROXY).toomanyrequests == 1
+    assert ratelimiter.bucket(PROXY).blocked_until > 0
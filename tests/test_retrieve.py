@@ -0,0 +1,42 @@
+import io
+from unittest import mock
+
+import pytest
+import requests
+
+from app.imagestore import ImageStore
+from app.retrieve import grabimage
+
+IMAGELINK = 'https://scontent.cdninstagram.com/v/t51/12345_n.jpg?oh=abc'
+PICTUREJSON = '{"display_url":"' + IMAGELINK + '"}'
+
+
+def response(status, content, contenttype):
+    resp = requests.Response()
+    resp.status_code = status
+    resp.url = IMAGELINK
+    resp.headers['Content-Type'] = contenttype
+    resp.raw = io.BytesIO(content)
+    return resp
+
+
+def grab(tmp_path, resp, imagestore, s3_link):
+    session = mock.Mock()
+    session.get.return_value = resp
+    grabimage(str(tmp_path / 'pictures'), s3_link, 'pictures', 'B1', PICTUREJSON, None,
+              session=session, keep_local=False, imagestore=imagestore)
+
+
+@pytest.mark.parametrize('status, contenttype', [(403, 'text/html'), (404, 'text/html'),
+                                                  (503, 'text/html'), (200, 'text/html')])
+def test_error_page_is_not_stored(tmp_path, status, contenttype):
+    imagestore = ImageStore(str(tmp_path / 'imagestore.sqlite'))
+    s3_link = mock.Mock()
+    with pytest.raises((requests.exceptions.HTTPError, ValueError)):
+        grab(tmp_path, response(status, b'<html>Error</html>', contenttype), imagestore,
+             s3_link)
+    s3_link.upload_fileobj.assert_not_called()
+
+    # The real image is still stored by the next attempt
+    grab(tmp_path, response(200, b'\xff\xd8\xffimage', 'image/jpeg'), imagestore, s3_link)
+    s3_link.upload_fileobj.assert_called_once()
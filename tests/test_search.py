@@ -0,0 +1,64 @@
+import logging
+
+import pytest
+
+from botocore.exceptions import ClientError
+
+from app import search as searchmodule
+from app.search import ScanProgress, Search
+
+
+def clienterror(code):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, 'Scan')
+
+
+class FailingTable():
+    """
+    Table whose scan raises the given errors before it answers
+    """
+    name = 'test3'
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def scan(self, **parameters):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return {'Items': [{'id': 1}], 'Count': 1, 'ScannedCount': 1,
+                'ConsumedCapacity': {'CapacityUnits': 0.5}}
+
+
+def pages(table, retries=8):
+    search = Search.__new__(Search)
+    search.log = logging.getLogger(__name__)
+    return list(search.segment_pages(table, 'id', 'all', ScanProgress(10), retries=retries))
+
+
+@pytest.fixture(autouse=True)
+def nosleep(monkeypatch):
+    monkeypatch.setattr(searchmodule.time, 'sleep', lambda seconds: None)
+
+
+def test_throttled_scan_is_retried():
+    table = FailingTable([clienterror('ProvisionedThroughputExceededException'),
+                          clienterror('ThrottlingException')])
+    assert pages(table) == [[{'id': 1}]]
+    assert table.calls == 3
+
+
+@pytest.mark.parametrize('code', ['ValidationException', 'ResourceNotFoundException',
+                                  'AccessDeniedException'])
+def test_permanent_error_is_raised(code):
+    table = FailingTable([clienterror(code)])
+    with pytest.raises(ClientError):
+        pages(table)
+    assert table.calls == 1
+
+
+def test_retries_are_bounded():
+    table = FailingTable([clienterror('RequestLimitExceeded')] * 10)
+    with pytest.raises(ClientError):
+        pages(table, retries=3)
+    assert table.calls == 4
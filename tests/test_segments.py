@@ -0,0 +1,44 @@
+import multiprocessing as mp
+import os
+from unittest import mock
+
+from app.segments import SegmentWriter
+
+# The writer of the test, inherited by the forked workers like Retrieve in run.py
+WRITER = {}
+
+
+def archive(keyid):
+    WRITER['writer'].append(keyid, 1500000000, b'{"id": %d}' % keyid)
+
+
+def test_segments_of_finished_workers_are_uploaded(tmp_path):
+    s3_link = mock.Mock()
+    writer = WRITER['writer'] = SegmentWriter(str(tmp_path), 'location', s3_link,
+                                              'json/location', max_age=3600)
+    # Each worker writes its own segment and ends without sealing it
+    with mp.get_context('fork').Pool(2) as pool:
+        pool.map(archive, range(10), chunksize=1)
+        pool.close()
+        pool.join()
+    segments = [filename for filename in os.listdir(tmp_path / 'open')
+                if filename.endswith('.seg')]
+    assert len(segments) > 0
+
+    # As Retrieve.close after the pool was joined
+    writer.close()
+    writer.recover()
+    assert os.listdir(tmp_path / 'open') == []
+    assert len(s3_link.upload_file.call_args_list) == 2 * len(segments)
+
+
+def test_current_segment_is_not_recovered(tmp_path):
+    s3_link = mock.Mock()
+    writer = SegmentWriter(str(tmp_path), 'location', s3_link, 'json/location', max_age=3600)
+    writer.append(1, 1500000000, b'{"id": 1}')
+    writer.recover()
+    s3_link.upload_file.assert_not_called()
+    writer.append(2, 1500000000, b'{"id": 2}')
+    writer.close()
+    assert os.listdir(tmp_path / 'open') == []
+    assert s3_link.upload_file.call_count == 2
@@ -0,0 +1,30 @@
+from app.tags import batch_tags, post_tags
+
+
+def post(*texts, comments=()):
+    return {
+        'edge_media_to_caption': {'edges': [{'node': {'text': text}} for text in texts]},
+        'edge_media_to_comment': {'edges': [{'node': {'text': text}} for text in comments]}
+    }
+
+
+def test_batch_tags_matches_post_tags():
+    posts = [post('Sunset #Zürich @anna.b', comments=['#zurich2019 #ZÜRICH']),
+             post('', comments=['hi @Anna.B.']),
+             post('mail me at me@example.com #Ｚürich')]
+    assert batch_tags(posts) == [post_tags(datastore) for datastore in posts]
+    assert batch_tags(posts)[0] == ({'zürich', 'zurich2019'}, {'anna.b'})
+
+
+def test_batch_tags_share_one_string():
+    # Built at runtime, so the tags are not shared by the compiler
+    first, second = batch_tags([post('#' + 'Aare' * 2), post('#' + 'AARE' * 2)])
+    tag, = first[0]
+    other, = second[0]
+    assert tag == other == 'aareaare'
+    assert tag is other
+
+
+def test_batch_tags_keeps_broken_posts_apart():
+    tags = batch_tags([post('#one'), {'edge_media_to_caption': {}}, post('#two')])
+    assert tags == [({'one'}, set()), None, ({'two'}, set())]
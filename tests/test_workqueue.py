@@ -0,0 +1,51 @@
+import functools
+import logging
+
+from app.search import Search
+from app.workqueue import WorkQueue
+
+
+class PendingTable():
+    """
+    Status index of a table in memory, the query returns pages of two keys
+    """
+    name = 'test3'
+
+    def __init__(self, keys):
+        self.keys = list(keys)
+
+    def query(self, **parameters):
+        start = 0
+        if 'ExclusiveStartKey' in parameters:
+            start = self.keys.index(parameters['ExclusiveStartKey']['id']) + 1
+        end = min(start + 2, start + parameters.get('Limit', 2), len(self.keys))
+        response = {'Items': [{'id': key} for key in self.keys[start:end]],
+                    'ConsumedCapacity': {'CapacityUnits': 0.5}}
+        if end < len(self.keys):
+            response['LastEvaluatedKey'] = {'id': self.keys[end - 1]}
+        return response
+
+
+def status_search(table):
+    search = Search.__new__(Search)
+    search.log = logging.getLogger(__name__)
+    search.tables = {'location': (table, 'id')}
+    return search
+
+
+def test_status_index_queue_is_refilled(tmp_path):
+    table = PendingTable([1, 2, 3, 4, 5])
+    search = status_search(table)
+    workqueue = WorkQueue(str(tmp_path / 'queue.sqlite'))
+    pages = functools.partial(search.pending_pages, 'location', 'discovered')
+
+    keys = [item['id'] for item in workqueue.consume('location-discovered', pages, 'id', int)]
+    assert keys == [1, 2, 3, 4, 5]
+    for key in keys:
+        workqueue.done('location-discovered', key)
+
+    # The finished keys leave the index, a new pending item appears
+    table.keys = [6]
+    keys = [item['id'] for item in workqueue.consume('location-discovered', pages, 'id', int)]
+    assert keys == [6]
+    workqueue.close()